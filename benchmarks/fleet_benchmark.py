@@ -0,0 +1,176 @@
+"""Fleet throughput benchmark against simulated loopback sensors.
+
+Example:
+    python benchmarks/fleet_benchmark.py --sensors 200 --handshake-latency 0.3 --command-latency 0.05 \
+        --packet-loss 0.02 --dead-fraction 0.05 --flows ping tests tools
+    python benchmarks/fleet_benchmark.py --sensors 200 --transport openssh
+"""
+import argparse
+import contextlib
+import io
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from simulated_sensors import SimulatedSensorFleet  # noqa: E402
+
+BENCHMARK_TESTS = {
+    'Connectivity': [
+        {'name': 'Ping Google DNS', 'command': 'ping -c 4 8.8.8.8'},
+    ],
+    'Tools': [
+        {'name': 'Stress present', 'command': 'stress --version'},
+        {'name': 'Kernel', 'command': 'uname -a'},
+        {'name': 'Clock', 'command': 'date'},
+    ],
+}
+
+
+def configure_environment(args, work_dir: str, sensors: list) -> None:
+    """Point every script at the simulated fleet and keep all state inside work_dir."""
+    sensors_file = os.path.join(work_dir, 'sensors.yaml')
+    with open(sensors_file, 'w') as file:
+        yaml.safe_dump(sensors, file)
+    os.environ.update({
+        'SSH_PORT': str(args.port),
+        'SENSOR_DETAILS_PATH': sensors_file,
+        'PASSWORD_SENSORZ': 'sensorz',
+        'REPORTS_DIRECTORY': os.path.join(work_dir, 'reports'),
+        'ROUTE_CACHE_PATH': os.path.join(work_dir, 'route_cache.json'),
+        'NEGATIVE_CACHE_PATH': os.path.join(work_dir, 'negative_cache.json'),
+        'INVENTORY_CACHE_PATH': os.path.join(work_dir, 'inventory_cache.json'),
+        'STATE_DB_PATH': os.path.join(work_dir, 'sensor_state.db'),
+        'STATE_DIFF_DIRECTORY': os.path.join(work_dir, 'diffs'),
+        'PACKAGE_CACHE_DIR': os.path.join(work_dir, 'packages'),
+        'PING_METRICS_DIRECTORY': os.path.join(work_dir, 'ping_metrics'),
+        'OUTPUT_STORE_DIR': os.path.join(work_dir, 'outputs'),
+        'SENSOR_TIMINGS_PATH': os.path.join(work_dir, 'sensor_timings.json'),
+        'TRACE_DIRECTORY': os.path.join(work_dir, 'traces'),
+        'REACHABILITY_TIMEOUT': str(args.connect_timeout),
+        'SSH_CONNECT_TIMEOUT': str(args.connect_timeout),
+        'FLEET_MAX_CONCURRENCY': str(args.concurrency),
+        'FLEET_SUBNET_CONCURRENCY': str(args.concurrency),
+        'SSH_POOL_MAX_CONNECTIONS': str(max(args.sensors, 1)),
+        'SSH_TRANSPORT': args.transport,
+        'SSH_CONTROL_DIR': os.path.join(work_dir, 'ssh'),
+        # Every simulated sensor generates a new host key per run.
+        'SSH_STRICT_HOST_KEY_CHECKING': 'no',
+        # The simulated sensors' iperf3 reports a canned rate without connecting to the server.
+        'IPERF_SERVERS': '127.0.0.1',
+        'IPERF_DURATION': '1',
+    })
+
+
+def load_flows() -> dict:
+    """Import the scripts (after the environment is set) and return {flow name: callable(sensors)}."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        import check_ping_sensors
+        import check_sensors_tools_installed
+        import sensor_tests
+        from fleet_engine import run_fleet
+        from throughput import run_throughput_stage
+    return {
+        'ping': check_ping_sensors.execute_tests,
+        'tests': lambda sensors: sensor_tests.execute_tests(sensors, BENCHMARK_TESTS),
+        'tools': lambda sensors: run_fleet(sensors, check_sensors_tools_installed.process_sensor),
+        'throughput': lambda sensors: run_throughput_stage(
+            sensors, os.path.join(os.path.dirname(os.environ['SENSOR_DETAILS_PATH']), 'throughput.jsonl')),
+    }
+
+
+def run_benchmark(args) -> list:
+    fleet = SimulatedSensorFleet(args.sensors, port=args.port, handshake_latency=args.handshake_latency,
+                                 command_latency=args.command_latency, packet_loss=args.packet_loss,
+                                 retransmit_delay=args.retransmit_delay, dead_fraction=args.dead_fraction,
+                                 ping_loss_fraction=args.ping_loss_fraction, seed=args.seed,
+                                 busybox_fraction=args.busybox_fraction,
+                                 installed_tools=('stress', 'iperf3') if 'throughput' in args.flows else ('stress',))
+    work_dir = tempfile.mkdtemp(prefix='fleet-benchmark-')
+    sensors = fleet.start()
+    try:
+        configure_environment(args, work_dir, sensors)
+        flows = load_flows()
+        logging.getLogger().setLevel(logging.WARNING)
+        from ssh_transport import get_transport
+        from tracing import get_tracer
+
+        rows = []
+        tracemalloc.start()
+        for name in args.flows:
+            if args.fresh_connections:
+                get_transport().close_all()
+            get_tracer().spans.clear()
+            tracemalloc.reset_peak()
+            opened_before = get_transport().connections_opened
+            accepted_before = fleet.connections_accepted
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                flows[name](sensors)
+            elapsed = time.perf_counter() - started
+            operations = get_tracer().summary().get('operation', {})
+            rows.append({
+                'flow': name,
+                'transport': args.transport,
+                'sensors': len(sensors),
+                'seconds': round(elapsed, 2),
+                'sensors_per_minute': round(len(sensors) / elapsed * 60, 1),
+                'connections_opened': get_transport().connections_opened - opened_before,
+                'connections_accepted': fleet.connections_accepted - accepted_before,
+                'peak_python_mb': round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1),
+                'p50_s': operations.get('p50', 0.0),
+                'p95_s': operations.get('p95', 0.0),
+                'max_s': operations.get('max', 0.0),
+            })
+        tracemalloc.stop()
+        return rows
+    finally:
+        fleet.stop()
+
+
+def print_rows(rows: list) -> None:
+    columns = list(rows[0])
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[column]).ljust(width) for column, width in zip(columns, widths)))
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sensors', type=int, default=50)
+    parser.add_argument('--flows', nargs='+', choices=['ping', 'tests', 'tools', 'throughput'],
+                        default=['ping', 'tests', 'tools'])
+    parser.add_argument('--port', type=int, default=2222)
+    parser.add_argument('--handshake-latency', type=float, default=0.0, help="seconds added to every auth")
+    parser.add_argument('--command-latency', type=float, default=0.0, help="seconds added to every command")
+    parser.add_argument('--packet-loss', type=float, default=0.0,
+                        help="chance a connection or command pays --retransmit-delay")
+    parser.add_argument('--retransmit-delay', type=float, default=1.0)
+    parser.add_argument('--dead-fraction', type=float, default=0.0, help="fraction of sensors with no listener")
+    parser.add_argument('--ping-loss-fraction', type=float, default=0.0,
+                        help="fraction of sensors whose canned ping loses packets")
+    parser.add_argument('--busybox-fraction', type=float, default=0.0,
+                        help="fraction of sensors whose canned ping prints busybox output")
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--connect-timeout', type=float, default=5.0)
+    parser.add_argument('--fresh-connections', action='store_true',
+                        help="close pooled connections between flows, as separate script runs would")
+    parser.add_argument('--transport', choices=['paramiko', 'openssh'], default='paramiko',
+                        help="SSH backend: pooled paramiko transports or system ssh with ControlMaster")
+    parser.add_argument('--seed', type=int, default=0)
+    print_rows(run_benchmark(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+"""Loopback SSH servers that stand in for sensors in the fleet benchmark.
+
+Every simulated sensor listens on its own 127.0.1.x address and runs the commands it receives with a local
+shell whose PATH only holds a handful of real utilities plus canned stand-ins for ping, sudo, apt-get and
+dpkg. apt-get and dpkg installs create stub binaries, so the tool audit sees its own installs on the next
+probe. Commands run in the sensor's home directory, which is also the root of its SFTP server.
+"""
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import paramiko
+
+# Real utilities the remote scripts rely on.
+PASSTHROUGH_UTILITIES = ['sh', 'timeout', 'base64', 'date', 'mktemp', 'rm', 'find', 'sleep', 'cat', 'head',
+                         'tail', 'gzip', 'sha256sum', 'uname', 'echo', 'dirname', 'chmod', 'grep', 'mkdir', 'basename',
+                         'cut', 'printf', 'wc', 'cp', 'tr', 'true']
+
+SUDO_STUB = """#!/bin/sh
+while [ $# -gt 0 ] && [ "${1#*=}" != "$1" ]; do export "$1"; shift; done
+exec "$@"
+"""
+
+APT_GET_STUB = """#!/bin/sh
+case "$1" in
+update)
+    echo "Hit:1 http://deb.debian.org/debian buster InRelease"
+    echo "Reading package lists... Done"
+    ;;
+install)
+    shift
+    count=0
+    for package in "$@"; do
+        case "$package" in -*) continue ;; esac
+        binary=$package
+        [ "$package" = dnsutils ] && binary=dig
+        printf '#!/bin/sh\\necho "%s 1.0"\\n' "$binary" > "$(dirname "$0")/$binary"
+        chmod +x "$(dirname "$0")/$binary"
+        echo "Setting up $package (1.0) ..."
+        count=$((count + 1))
+    done
+    echo "0 upgraded, $count newly installed, 0 to remove and 0 not upgraded."
+    ;;
+esac
+"""
+
+DPKG_STUB = """#!/bin/sh
+case "$1" in
+--print-architecture)
+    echo amd64
+    ;;
+-i)
+    shift
+    for deb in "$@"; do
+        package=$(basename "$deb" | cut -d_ -f1)
+        binary=$package
+        [ "$package" = dnsutils ] && binary=dig
+        printf '#!/bin/sh\\necho "%s 1.0"\\n' "$binary" > "$(dirname "$0")/$binary"
+        chmod +x "$(dirname "$0")/$binary"
+        echo "Setting up $package (1.0) ..."
+    done
+    ;;
+esac
+"""
+
+PING_STUB = """#!/bin/sh
+received=%(received)d
+echo "PING 8.8.8.8 (8.8.8.8) 56(84) bytes of data."
+seq=1
+while [ $seq -le $received ]; do
+    echo "64 bytes from 8.8.8.8: icmp_seq=$seq ttl=117 time=%(rtt)s ms"
+    seq=$((seq + 1))
+done
+echo ""
+echo "--- 8.8.8.8 ping statistics ---"
+echo "4 packets transmitted, $received received, %(loss)d%% packet loss, time 3004ms"
+[ $received -gt 0 ] && echo "rtt min/avg/max/mdev = %(rtt)s/%(rtt)s/%(rtt)s/0.000 ms"
+[ $received -gt 0 ]
+"""
+
+# The same in busybox's format, as printed by sensors without iputils.
+BUSYBOX_PING_STUB = """#!/bin/sh
+received=%(received)d
+echo "PING 8.8.8.8 (8.8.8.8): 56 data bytes"
+seq=0
+while [ $seq -lt $received ]; do
+    echo "64 bytes from 8.8.8.8: seq=$seq ttl=117 time=%(rtt)s ms"
+    seq=$((seq + 1))
+done
+echo ""
+echo "--- 8.8.8.8 ping statistics ---"
+echo "4 packets transmitted, $received packets received, %(loss)d%% packet loss"
+[ $received -gt 0 ] && echo "round-trip min/avg/max = %(rtt)s/%(rtt)s/%(rtt)s ms"
+[ $received -gt 0 ]
+"""
+
+# Canned `iperf3 -c HOST -t N -J [-R]`: takes the test's duration and reports a fixed rate per direction.
+# `iperf3 -s -D` returns at once, as a daemonised server would.
+IPERF3_STUB = """#!/bin/sh
+duration=10; rate=94000000
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -t) duration=$2; shift ;;
+        -R) rate=87000000 ;;
+        -s) exit 0 ;;
+    esac
+    shift
+done
+sleep "$duration"
+printf '{"start": {}, "end": {"sum_sent": {"seconds": %s, "bits_per_second": %s, "retransmits": 0}, ' \
+    "$duration" "$rate"
+printf '"sum_received": {"seconds": %s, "bits_per_second": %s}}}\n' "$duration" "$rate"
+"""
+
+
+class SimulatedSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class SimulatedSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP server confined to the sensor's home directory; relative paths start there."""
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.home = server.home
+
+    def _local(self, path):
+        return os.path.join(self.home, os.path.normpath('/' + path).lstrip('/'))
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._local(path), flags | getattr(os, 'O_BINARY', 0), 0o644)
+            mode = 'wb' if flags & os.O_WRONLY else 'r+b' if flags & os.O_RDWR else 'rb'
+            handle = SimulatedSFTPHandle(flags)
+            handle.readfile = handle.writefile = os.fdopen(fd, mode)
+            return handle
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        try:
+            os.remove(self._local(path))
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+
+class SimulatedSensor(paramiko.ServerInterface):
+    """paramiko server side of one simulated sensor."""
+
+    def __init__(self, fleet, bin_dir):
+        self.fleet = fleet
+        self.bin_dir = bin_dir
+        self.home = os.path.dirname(bin_dir)
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        time.sleep(self.fleet.handshake_latency)
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._run, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def _run(self, channel, command):
+        time.sleep(self.fleet.command_latency + self.fleet.loss_delay())
+        process = subprocess.Popen(['/bin/sh', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, cwd=self.home, env={'PATH': self.bin_dir, 'HOME': self.home})
+
+        def pump_stdin():
+            try:
+                while True:
+                    data = channel.recv(32768)
+                    if not data:
+                        break
+                    process.stdin.write(data)
+                    process.stdin.flush()
+            except (OSError, EOFError):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        def pump(stream, send):
+            for chunk in iter(lambda: stream.read1(32768), b''):
+                send(chunk)
+
+        threads = [threading.Thread(target=pump_stdin, daemon=True),
+                   threading.Thread(target=pump, args=(process.stdout, channel.sendall), daemon=True),
+                   threading.Thread(target=pump, args=(process.stderr, channel.sendall_stderr), daemon=True)]
+        for thread in threads:
+            thread.start()
+        exit_status = process.wait()
+        threads[1].join()
+        threads[2].join()
+        channel.send_exit_status(exit_status)
+        channel.shutdown_write()
+        channel.close()
+
+
+class SimulatedSensorFleet:
+    """Start `count` simulated sensors on loopback and hand out matching inventory entries.
+
+    handshake_latency and command_latency add fixed delays to auth and to every command. packet_loss is
+    the chance that a connection or command pays an extra retransmit_delay. A dead_fraction of the
+    sensors has no listener at all, so connecting to them is refused. A busybox_fraction of the sensors,
+    spread evenly over the fleet, prints busybox ping output instead of iputils'.
+    """
+
+    def __init__(self, count: int, port: int = 2222, handshake_latency: float = 0.0, command_latency: float = 0.0,
+                 packet_loss: float = 0.0, retransmit_delay: float = 1.0, dead_fraction: float = 0.0,
+                 installed_tools: tuple = ('stress',), ping_loss_fraction: float = 0.0, seed: int = 0,
+                 busybox_fraction: float = 0.0):
+        self.count = count
+        self.port = port
+        self.handshake_latency = handshake_latency
+        self.command_latency = command_latency
+        self.packet_loss = packet_loss
+        self.retransmit_delay = retransmit_delay
+        self.dead_fraction = dead_fraction
+        self.installed_tools = installed_tools
+        self.ping_loss_fraction = ping_loss_fraction
+        self.busybox_fraction = busybox_fraction
+        self.connections_accepted = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._transports = []
+        self._root = None
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+    def loss_delay(self) -> float:
+        with self._lock:
+            return self.retransmit_delay if self._random.random() < self.packet_loss else 0.0
+
+    def _ping_stub(self, index: int) -> str:
+        busybox = int((index + 1) * self.busybox_fraction) > int(index * self.busybox_fraction)
+        return BUSYBOX_PING_STUB if busybox else PING_STUB
+
+    def _make_bin_dir(self, index: int, ping_received: int) -> str:
+        bin_dir = os.path.join(self._root, f"sensor-{index}", 'bin')
+        os.makedirs(bin_dir)
+        for utility in PASSTHROUGH_UTILITIES:
+            path = shutil.which(utility)
+            if path:
+                os.symlink(path, os.path.join(bin_dir, utility))
+        stubs = {
+            'sudo': SUDO_STUB,
+            'apt-get': APT_GET_STUB,
+            'dpkg': DPKG_STUB,
+            'ping': self._ping_stub(index) % {'received': ping_received, 'loss': (4 - ping_received) * 25,
+                                              'rtt': '12.345'},
+        }
+        stubs.update({('dig' if tool == 'dnsutils' else tool): f'#!/bin/sh\necho "{tool} 1.0"\n'
+                      for tool in self.installed_tools})
+        if 'iperf3' in self.installed_tools:
+            stubs['iperf3'] = IPERF3_STUB
+        for name, content in stubs.items():
+            path = os.path.join(bin_dir, name)
+            with open(path, 'w') as file:
+                file.write(content)
+            os.chmod(path, 0o755)
+        return bin_dir
+
+    def _serve(self, listener: socket.socket, bin_dir: str) -> None:
+        while True:
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections_accepted += 1
+            time.sleep(self.loss_delay())
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SimulatedSFTPServer)
+            self._transports.append(transport)
+            try:
+                transport.start_server(server=SimulatedSensor(self, bin_dir))
+            except (paramiko.SSHException, EOFError, OSError):
+                transport.close()
+
+    def start(self) -> list:
+        """Start the listeners and return inventory entries in the sensor YAML format."""
+        self._root = tempfile.mkdtemp(prefix='simulated-sensors-')
+        sensors = []
+        for index in range(self.count):
+            ip_address = f"127.0.{1 + index // 250}.{1 + index % 250}"
+            sensors.append({
+                'hostname': f"SIM-{index:04d} (Simulated, Connected via loopback)",
+                'ip_address_sensor': ip_address,
+                'username_sensorz': 'sensorz',
+                'Password_sensorz': 'sensorz',
+            })
+            if self._random.random() < self.dead_fraction:
+                continue
+            ping_received = 4 if self._random.random() >= self.ping_loss_fraction else 2
+            bin_dir = self._make_bin_dir(index, ping_received)
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((ip_address, self.port))
+            listener.listen(64)
+            self._listeners.append(listener)
+            threading.Thread(target=self._serve, args=(listener, bin_dir), daemon=True).start()
+        return sensors
+
+    def stop(self) -> None:
+        for listener in self._listeners:
+            listener.close()
+        for transport in self._transports:
+            transport.close()
+        if self._root:
+            shutil.rmtree(self._root, ignore_errors=True)
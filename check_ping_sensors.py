@@ -1,16 +1,24 @@
-import concurrent.futures
 import logging
 import os
 import subprocess
 from datetime import datetime
 from functools import wraps
 
-import paramiko
 import yaml
 from dotenv import load_dotenv
 
-# Initialize a list to track unreachable sensors.
-sensor_status = []
+from fleet_engine import run_fleet
+from inventory import select_sensors
+from negative_cache import get_negative_cache
+from output_groups import OutputGroups, mask_ping_timings
+from ping_metrics import PingRun, latency_report, load_history, parse_ping_output, ping_passed
+from reachability import preflight, unreachable_entry
+from result_stream import ResultSink, iter_results, write_grouped_yaml
+from route_cache import remember_route, resolve_sensor
+from ssh_transport import get_transport
+from state_store import get_state_store, incremental_mode
+from tracing import get_tracer, span
+
 total_sensors_tested = 0
 
 # Setup logging to display informational messages and timestamps.
@@ -24,11 +32,13 @@ password_sensorz = os.getenv('PASSWORD_SENSORZ')
 # Ensure that both required environment variables are set.
 assert sensors_file_path and password_sensorz, "Required environment variables are not set."
 
+ping_reports_directory = os.getenv('PING_REPORTS_DIRECTORY',
+                                   "C:/Users/Roy Avrahami/OneDrive - Sensorz/Automated Ping Test For Sensors")
+
 
-def load_sensor_details(file_path: str) -> dict:
-    """Load sensor details from a YAML file."""
-    with open(file_path) as file:
-        return yaml.safe_load(file)
+def load_sensor_details(file_path: str) -> list:
+    """Load the sensors matching SENSOR_SELECTOR (all by default) from the inventory."""
+    return select_sensors(file_path)
 
 
 def can_ping(ip_address: str) -> bool:
@@ -37,13 +47,33 @@ def can_ping(ip_address: str) -> bool:
     return response.returncode == 0
 
 
+class RetryFailed(Exception):
+    """Raised by @retry when both of a sensor's addresses failed; entry describes it for the reports."""
+
+    def __init__(self, entry: dict):
+        super().__init__(entry['reason'])
+        self.entry = entry
+
+
+def failure_entry(sensor: dict, error: Exception) -> dict:
+    """Report entry of a sensor whose operation raised: the retry's own entry, or an unreachable one."""
+    return error.entry if isinstance(error, RetryFailed) else unreachable_entry(sensor, str(error))
+
+
 def retry(f):
-    """Decorator to retry sensor operations with an updated IP address."""
+    """Decorator to run sensor operations on the sensor's best known address, retrying on the other prefix.
+
+    Raises RetryFailed when both addresses failed.
+    """
 
     @wraps(f)
     def wrapper_retry(sensor, *args, **kwargs):
+        # Work on copies so the shared sensor dict keeps its configured address.
+        sensor = resolve_sensor(sensor)
         try:
-            return f(sensor, *args, **kwargs)
+            result = f(sensor, *args, **kwargs)
+            remember_route(sensor)
+            return result
         except Exception as e:
             logging.error(f"First attempt failed for {sensor['ip_address_sensor']}: {e}")
             original_ip = sensor['ip_address_sensor']
@@ -51,71 +81,139 @@ def retry(f):
             updated_sensor = update_ip_prefix(sensor, new_prefix=new_prefix)
             if can_ping(updated_sensor['ip_address_sensor']):
                 try:
-                    return f(updated_sensor, *args, **kwargs)
+                    result = f(updated_sensor, *args, **kwargs)
+                    remember_route(updated_sensor)
+                    return result
                 except Exception as second_try_error:
                     logging.error(f"Retry attempt failed for {updated_sensor['ip_address_sensor']}: {second_try_error}")
             else:
                 logging.error(f"IP {updated_sensor['ip_address_sensor']} is not pingable.")
-            sensor_status.append({
+            # The caller's error handling records the failure, so concurrent callers share no state.
+            raise RetryFailed({
                 'hostname': sensor.get('hostname', 'Unknown hostname'),
                 'original_ip': original_ip,
                 'updated_ip': updated_sensor['ip_address_sensor'],
                 'reason': 'Failed to ping after IP update'
             })
-            return None
 
     return wrapper_retry
 
 
 def update_ip_prefix(sensor: dict, new_prefix: str) -> dict:
+    """Return a copy of the sensor with its IP moved to the given prefix."""
     parts = sensor['ip_address_sensor'].split('.')
     parts[0], parts[1] = new_prefix.split('.')[:2]
-    sensor['ip_address_sensor'] = '.'.join(parts)
-    return sensor
+    return dict(sensor, ip_address_sensor='.'.join(parts))
 
 
 @retry
 def ping_test(sensor: dict) -> dict:
     """Execute a ping test from a sensor."""
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(hostname=sensor['ip_address_sensor'], username=sensor['username_sensorz'],
-                   password=password_sensorz, timeout=20)
-    stdin, stdout, stderr = client.exec_command("ping -c 4 8.8.8.8")
-    output = stdout.read().decode()
-    ping_status = "Pass" if "4 packets transmitted, 4 received" in output else "Failed"
-    client.close()
+    with span('ping_test', sensor['ip_address_sensor']):
+        _, output, _ = get_transport().exec_command(sensor['ip_address_sensor'], sensor['username_sensorz'],
+                                                   password_sensorz, "ping -c 4 8.8.8.8", timeout=20)
+    metrics = parse_ping_output(output)
     return {
         'hostname': sensor.get('hostname', 'Unknown'),
         'ip': sensor['ip_address_sensor'],
-        'ping_status': ping_status,
-        'output': output
+        'ping_status': "Pass" if ping_passed(metrics) else "Failed",
+        'output': output,
+        'metrics': metrics
     }
 
 
-def execute_tests(sensor_details: list) -> dict:
-    """Execute ping tests and handle results."""
-    results = {'Passed': [], 'Failed': []}
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(ping_test, sensor): sensor for sensor in sensor_details}
-        for future in concurrent.futures.as_completed(futures):
-            var = futures[future]
-            result = future.result()
-            if result:
-                results['Passed' if result['ping_status'] == 'Pass' else 'Failed'].append(result)
-
-    # Include sensors that failed to ping after IP update
-    results['Failed'].extend(sensor_status)
+def execute_tests(sensor_details: list, sink: ResultSink = None) -> dict:
+    """Execute ping tests and handle results.
 
-    return results
+    Without a sink the results are returned as {'Passed': [...], 'Failed': [...]}. With a sink each result is
+    written to it as {'group': ..., 'result': ...} the moment it completes and only the counts are returned.
+    In incremental mode sensors with a fresh passing ping are not contacted and their last result is reused.
+    """
+    results = {'Passed': [], 'Failed': []}
+    counts = {'Passed': 0, 'Failed': 0}
+    negative_cache = get_negative_cache()
+    store = get_state_store()
+
+    def record(group, result):
+        counts[group] += 1
+        if sink:
+            sink.write({'group': group, 'result': result})
+        else:
+            results[group].append(result)
+
+    def on_result(sensor, result):
+        negative_cache.record_success(sensor)
+        store.set(sensor, 'ping', result, ok=result['ping_status'] == 'Pass')
+        store.record_inventory(sensor)
+        record('Passed' if result['ping_status'] == 'Pass' else 'Failed', result)
+
+    def on_error(sensor, e):
+        # Timed out sensors are reported rather than dropped, so a run cut short by its deadline says so.
+        negative_cache.record_failure(sensor, str(e))
+        record('Failed', failure_entry(sensor, e))
+
+    # Sweep the whole fleet first so dead and backing-off sensors never tie up a worker on connect timeouts.
+    alive, dead, skipped = preflight(sensor_details)
+    if incremental_mode():
+        alive, unchanged = store.plan(alive, ['ping'])
+        for sensor in unchanged:
+            record('Passed', dict(store.get(sensor, 'ping'), cached=True))
+    run_fleet(alive, ping_test, on_result=on_result, on_error=on_error, collect=False)
+
+    for sensor in dead:
+        record('Failed', unreachable_entry(sensor))
+    for sensor in skipped:
+        record('Failed', negative_cache.skipped_entry(sensor))
+
+    return counts if sink else results
+
+
+def ping_output_groups(results) -> OutputGroups:
+    """Group the ping outputs of the results, ignoring round-trip times."""
+    groups = OutputGroups(normalize=mask_ping_timings)
+    for result in results:
+        if 'output' in result:
+            groups.add('ping', result['hostname'], result['output'], result['ping_status'])
+    return groups
+
+
+def compact_ping_result(result: dict, groups: OutputGroups) -> dict:
+    """Replace an output that other sensors share with a reference to the output groups."""
+    if 'output' not in result:
+        return result
+    return dict(result, output=groups.compact('ping', result['output']))
 
 
 def save_report(test_results, report_path):
-    """Save the test results to a specified file."""
+    """Save the test results to a specified file, with shared outputs listed once under Output groups."""
     timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
     filename = f"{report_path}/Ping_Test_Report_{timestamp}.yaml"
+    groups = ping_output_groups(result for results in test_results.values() for result in results)
+    compacted = {status: [compact_ping_result(result, groups) for result in results]
+                 for status, results in test_results.items()}
     with open(filename, 'w') as file:
-        yaml.safe_dump(test_results, file)
+        yaml.safe_dump(compacted, file)
+        yaml.safe_dump({'Output groups': groups.summary()}, file, sort_keys=False)
+    logging.info(f"Report saved to {filename}")
+
+
+def save_streamed_report(stream_path, report_path, timestamp):
+    """Build the YAML report from a result stream without loading it into memory.
+
+    Outputs that several sensors share (timings aside) are written once under Output groups, with the
+    sensors whose output differs listed. A Latency section with the fleet and per-tag latency distributions,
+    outliers and trends against earlier runs is appended, and this run's metrics are added to the history.
+    """
+    filename = f"{report_path}/Ping_Test_Report_{timestamp}.yaml"
+    groups = ping_output_groups(record['result'] for record in iter_results(stream_path))
+    write_grouped_yaml(stream_path, filename, ['Passed', 'Failed'],
+                       transform=lambda result: compact_ping_result(result, groups))
+    run = PingRun.from_results(record['result'] for record in iter_results(stream_path))
+    history = load_history(limit=int(os.getenv('PING_TREND_RUNS', '30')))
+    with open(filename, 'a') as file:
+        yaml.safe_dump({'Output groups': groups.summary()}, file, sort_keys=False)
+        yaml.safe_dump({'Latency': latency_report(run, history)}, file, sort_keys=False)
+    run.save()
     logging.info(f"Report saved to {filename}")
 
 
@@ -123,21 +221,32 @@ def main():
     """Main function to load sensor details and execute tests."""
     print("Starting connection and ping tests...")
     sensor_details = load_sensor_details(sensors_file_path)
-    test_results = execute_tests(sensor_details)
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    store = get_state_store()
+    store.start_run('check_ping_sensors')
+
+    # Results are appended to the stream as they complete, so a crashed run keeps what it already had.
+    stream_path = f"{ping_reports_directory}/Ping_Test_Results_{timestamp}.jsonl"
+    with ResultSink(stream_path) as sink:
+        counts = execute_tests(sensor_details, sink)
 
     print("\nTest summary:")
     print(f"Total sensors tested: {len(sensor_details)}")
-    print(f"Sensors Passed All Tests: {len(test_results['Passed'])}")
-    print(f"Sensors Failed The Test: {len(test_results['Failed'])}")
+    print(f"Sensors Passed All Tests: {counts['Passed']}")
+    print(f"Sensors Failed The Test: {counts['Failed']}")
 
     # Display details of sensors that passed and failed in the console
     for status in ['Passed', 'Failed']:
         print(f"\nSensors that {status.lower()}:")
-        for sensor in test_results[status]:
-            print(f"Hostname: {sensor.get('hostname')}, IP: {sensor.get('ip')}, Status: {sensor.get('ping_status')}")
-
-    report_path = "C:/Users/Roy Avrahami/OneDrive - Sensorz/Automated Ping Test For Sensors"
-    save_report(test_results, report_path)
+        for record in iter_results(stream_path):
+            if record['group'] == status:
+                sensor = record['result']
+                print(f"Hostname: {sensor.get('hostname')}, IP: {sensor.get('ip')}, Status: {sensor.get('ping_status')}")
+
+    save_streamed_report(stream_path, ping_reports_directory, timestamp)
+    store.finish_run()
+    store.write_diff_report()
+    get_tracer().export('check_ping_sensors')
 
 
 if __name__ == "__main__":
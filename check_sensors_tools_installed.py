@@ -1,10 +1,16 @@
-import concurrent.futures
 import logging
 import os
-import re
-import yaml
 from dotenv import load_dotenv
-import paramiko
+
+from fleet_engine import run_fleet
+from inventory import select_sensors
+from negative_cache import get_negative_cache
+from output_capture import capture_command
+from ping_metrics import parse_ping_output, ping_passed
+from reachability import preflight
+from state_store import get_state_store
+from tool_audit import TOOLS_TO_CHECK, audit_and_install
+from tracing import get_tracer
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -16,10 +22,9 @@ PASSWORD_SENSORZ = os.getenv('PASSWORD_SENSORZ')
 
 
 def load_sensor_details(file_path: str):
-    """Load sensor details from YAML file."""
+    """Load the sensors matching SENSOR_SELECTOR (all by default) from the inventory."""
     try:
-        with open(file_path) as file:
-            return yaml.safe_load(file)
+        return select_sensors(file_path)
     except FileNotFoundError as e:
         logging.error(f"Error loading sensor details: {e}")
         return []
@@ -29,70 +34,55 @@ def load_sensor_details(file_path: str):
 
 
 def run_ssh_command(ip_address_sensor: str, username_sensorz: str, sensorz_password: str, command: str):
-    """Execute an SSH command on the sensor."""
+    """Execute an SSH command on the sensor over its pooled connection, with bounded outputs."""
     try:
-        with paramiko.SSHClient() as client:
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(hostname=ip_address_sensor, username=username_sensorz, password=sensorz_password)
-            _, stdout, stderr = client.exec_command(command)
-            stdout_content = stdout.read().decode() if stdout else ''
-            stderr_content = stderr.read().decode() if stderr else ''
-            return stdout_content, stderr_content
+        _, stdout_content, stderr_content = capture_command(
+            ip_address_sensor, username_sensorz, sensorz_password, command)
+        return stdout_content, stderr_content
     except Exception as e:
         logging.error(f"SSH command execution failed for {ip_address_sensor}: {e}")
         return '', str(e)
 
 
-def detect_package_manager_and_install(ip_address_sensor: str, username_sensorz: str, sensorz_password: str, tool: str):
-    """Detect the package manager and install the required tool."""
-    apt_check_command = "which apt"
-    stdout, _ = run_ssh_command(ip_address_sensor, username_sensorz, sensorz_password, apt_check_command)
-    if stdout.strip():
-        install_command = f"sudo apt-get update && sudo apt-get install {tool} -y"
-    else:
-        install_command = f"sudo yum makecache fast && sudo yum install {tool} -y"
-    stdout, stderr = run_ssh_command(ip_address_sensor, username_sensorz, sensorz_password, install_command)
-    if stderr.strip():
-        logging.error(f"Error installing {tool} on {ip_address_sensor}: {stderr}")
-    return stderr
-
-
 def process_sensor(sensor: dict):
     """Process each sensor for checking and installing tools and performing ping test."""
     ip_address_sensor = sensor['ip_address_sensor']
     username_sensorz = sensor['username_sensorz']
     hostname = sensor.get('hostname', 'Unknown Hostname')
 
-    tools_to_check = ['stress', 'iperf3', 'mtr', 'dnsutils']
-    installed_tools = []
-    already_installed = []
-    failed_to_install = []
-
-    for tool in tools_to_check:
-        stdout, _ = run_ssh_command(ip_address_sensor, username_sensorz, PASSWORD_SENSORZ, f'which {tool}')
-        if stdout.strip():
-            already_installed.append(tool)
-            logging.info(f"{hostname} ({ip_address_sensor}): {tool} - already installed")
-        else:
-            stderr = detect_package_manager_and_install(ip_address_sensor, username_sensorz, PASSWORD_SENSORZ, tool)
-            if 'is already the newest version' in stderr or 'newly installed' in stderr:
-                installed_tools.append(tool)
-                logging.info(f"{hostname} ({ip_address_sensor}): {tool} - installed")
-            else:
-                failed_to_install.append(tool)
-                logging.error(f"{hostname} ({ip_address_sensor}): {tool} - failed to install")
+    # Probe every tool and the package manager in one round trip, then install whatever is missing in one go.
+    try:
+        audit = audit_and_install(ip_address_sensor, username_sensorz, PASSWORD_SENSORZ, TOOLS_TO_CHECK,
+                                  sensor=sensor)
+        installed_tools, already_installed, failed_to_install = \
+            audit['installed'], audit['already_installed'], audit['failed']
+    except Exception as e:
+        logging.error(f"Tool audit failed for {ip_address_sensor}: {e}")
+        installed_tools, already_installed, failed_to_install = [], [], list(TOOLS_TO_CHECK)
+
+    for tool in already_installed:
+        logging.info(f"{hostname} ({ip_address_sensor}): {tool} - already installed")
+    for tool in installed_tools:
+        logging.info(f"{hostname} ({ip_address_sensor}): {tool} - installed")
+    for tool in failed_to_install:
+        logging.error(f"{hostname} ({ip_address_sensor}): {tool} - failed to install")
 
     # Perform ping test
     logging.info(f"{hostname} ({ip_address_sensor}): Starting ping test")
     stdout, _ = run_ssh_command(ip_address_sensor, username_sensorz, PASSWORD_SENSORZ, 'ping -c 4 8.8.8.8')
-    ping_results = re.search(r'--- 8.8.8.8 ping statistics ---\n(.*)', stdout, re.DOTALL)
-    ping_output = ping_results.group(1).strip() if ping_results else 'Ping test failed'
+    metrics = parse_ping_output(stdout)
+    if metrics['transmitted']:
+        ping_output = (f"{metrics['received']}/{metrics['transmitted']} received, {metrics['loss_pct']}% loss, "
+                       f"rtt min/avg/max/mdev = {metrics['rtt_min']}/{metrics['rtt_avg']}/{metrics['rtt_max']}/"
+                       f"{metrics['rtt_mdev']} ms")
+    else:
+        ping_output = 'Ping test failed'
 
     summary = f"\nSummary of Operations for {ip_address_sensor} ({hostname}):\n" \
               f"  Installed in this cycle: {', '.join(installed_tools) or 'None'}\n" \
               f"  Already installed: {', '.join(already_installed) or 'None'}\n" \
               f"  Failed to install: {', '.join(failed_to_install) or 'None'}\n" \
-              f"  Ping test: {'Successful' if '0% packet loss' in ping_output else 'Failed'}\n" \
+              f"  Ping test: {'Successful' if ping_passed(metrics) else 'Failed'}\n" \
               f"  Ping output: {ping_output}\n"
     return summary
 
@@ -103,13 +93,30 @@ def main():
         logging.error("No sensor details found.")
         return
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_sensor, sensor) for sensor in sensor_details]
-        summaries = [future.result() for future in concurrent.futures.as_completed(futures)]
+    store = get_state_store()
+    store.start_run('check_sensors_tools_installed')
+    alive, dead, skipped = preflight(sensor_details)
+    negative_cache = get_negative_cache()
+
+    def on_error(sensor, e):
+        negative_cache.record_failure(sensor, str(e))
+        return f"\nFailed to process {sensor['ip_address_sensor']}: {e}\n"
+
+    summaries = run_fleet(alive, process_sensor, on_error=on_error,
+                          on_result=lambda sensor, _: negative_cache.record_success(sensor))
+    summaries.extend(f"\nSkipped {sensor['ip_address_sensor']} ({sensor.get('hostname', 'Unknown Hostname')}): "
+                     f"not reachable in pre-flight sweep\n" for sensor in dead)
+    for sensor in skipped:
+        entry = negative_cache.skipped_entry(sensor)
+        summaries.append(f"\nSkipped {sensor['ip_address_sensor']} ({entry['hostname']}): {entry['reason']}\n"
+                         f"  Last known state: {entry['last_state']}\n")
 
     # Print summaries after collecting all of them
     for summary in summaries:
         print(summary)
+    store.finish_run()
+    store.write_diff_report()
+    get_tracer().export('check_sensors_tools_installed')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+import base64
+import json
+import logging
+import math
+import os
+import shlex
+
+from output_capture import capture_command
+from tracing import span
+
+DEFAULT_TEST_TIMEOUT = 120
+
+# Exit status GNU timeout uses when it had to kill the command.
+TIMEOUT_EXIT_CODE = 124
+
+# Where the sensor keeps the full output of the last run's truncated tests, as <test id>.stdout/.stderr.
+REMOTE_OUTPUT_DIR = '/var/tmp/sensorz-outputs'
+
+
+def flatten_tests(tests: dict) -> list:
+    """Return [(category, test)] in tests.json order; the list index is the test's id in the payload."""
+    return [(category, test) for category, test_commands in tests.items() for test in test_commands]
+
+
+def output_bounds() -> tuple:
+    """Head and tail bytes of each output sent back, the same bounds as output_capture.BoundedCapture."""
+    return int(os.getenv('OUTPUT_HEAD_BYTES', '8192')), int(os.getenv('OUTPUT_TAIL_BYTES', '8192'))
+
+
+def build_remote_script(tests: dict, default_timeout: float = DEFAULT_TEST_TIMEOUT, head_bytes: int = 8192,
+                        tail_bytes: int = 8192) -> str:
+    """Compile every test into one POSIX shell script that prints a single JSON document.
+
+    Each test runs under `timeout`, and its exit code, elapsed milliseconds and base64-encoded
+    stdout/stderr are emitted as one element of the "results" array, so no output needs escaping.
+    Outputs larger than head_bytes + tail_bytes are cut to their head and tail on the sensor before
+    encoding, and kept whole under REMOTE_OUTPUT_DIR until the next run.
+
+    Only tools busybox also has are used: times come from /proc/uptime (date +%s%N is GNU only) and
+    base64 output is joined with tr instead of -w0. A sensor whose timeout does not take `timeout N CMD`
+    (older busybox wants -t) gets {"unsupported": "timeout"} instead of results.
+    """
+    lines = [
+        'timeout 1 true 2>/dev/null || { echo \'{"unsupported":"timeout"}\'; exit 0; }',
+        # now_ms: milliseconds since boot at centisecond resolution, or since the epoch at second resolution.
+        'now_ms() {',
+        '    if read -r up _ </proc/uptime 2>/dev/null; then',
+        '        cs=${up%.*}${up#*.}; cs=${cs#"${cs%%[!0]*}"}; echo $(( ${cs:-0} * 10 ))',
+        '    else echo $(( $(date +%s) * 1000 )); fi',
+        '}',
+        'out=$(mktemp) err=$(mktemp)',
+        'trap \'rm -f "$out" "$err"\' EXIT',
+        f'keep={REMOTE_OUTPUT_DIR}; rm -rf "$keep"; mkdir -p "$keep"',
+        # bounded FILE KEEP: print the size of FILE, then its head and tail base64-encoded, saving it as KEEP
+        # when it is cut.
+        'bounded() {',
+        '    size=$(wc -c <"$1")',
+        f'    if [ "$size" -le {head_bytes + tail_bytes} ]; then',
+        '        printf \'%d,"%s"\' "$size" "$(base64 <"$1" | tr -d \'\\n\')"; return',
+        '    fi',
+        '    cp "$1" "$2"',
+        f'    cut=$({{ head -c {head_bytes} "$1"; tail -c {tail_bytes} "$1"; }} | base64 | tr -d \'\\n\')',
+        '    printf \'%d,"%s"\' "$size" "$cut"',
+        '}',
+        'printf \'{"results":[\'',
+        'sep=',
+    ]
+    for index, (_, test) in enumerate(flatten_tests(tests)):
+        timeout = int(math.ceil(test.get('timeout', default_timeout)))
+        lines += [
+            't0=$(now_ms)',
+            f'timeout {timeout} sh -c {shlex.quote(test["command"])} >"$out" 2>"$err" </dev/null; rc=$?',
+            'ms=$(( $(now_ms) - t0 ))',
+            f'printf \'%s{{"id":{index},"exit_code":%d,"elapsed_ms":%d,"stdout":[%s],"stderr":[%s]}}\' '
+            f'"$sep" "$rc" "$ms" "$(bounded "$out" "$keep/{index}.stdout")" "$(bounded "$err" "$keep/{index}.stderr")"',
+            'sep=,',
+        ]
+    lines.append('printf \']}\\n\'')
+    return '\n'.join(lines) + '\n'
+
+
+def remote_output(record: dict, stream: str, head_bytes: int) -> str:
+    """Decode one [size, base64] output of the payload, marking where the sensor cut it."""
+    size, encoded = record[stream]
+    data = base64.b64decode(encoded)
+    if size <= len(data):
+        return data.decode(errors='replace')
+    return (f"{data[:head_bytes].decode(errors='replace')}\n"
+            f"... [{size - len(data)} bytes omitted, full output on the sensor: "
+            f"{REMOTE_OUTPUT_DIR}/{record['id']}.{stream}] ...\n"
+            f"{data[head_bytes:].decode(errors='replace')}")
+
+
+def parse_remote_results(tests: dict, payload: str, default_timeout: float = DEFAULT_TEST_TIMEOUT,
+                         head_bytes: int = 8192) -> dict:
+    """Map the script's JSON document back onto the sensor_result["results"][category] structure."""
+    records = {record['id']: record for record in json.loads(payload)['results']}
+    results = {category: [] for category in tests}
+    for index, (category, test) in enumerate(flatten_tests(tests)):
+        record = records.get(index)
+        if record is None:
+            results[category].append({"test_name": test['name'], "output": "Test did not run", "status": "Failed"})
+            continue
+        stdout = remote_output(record, 'stdout', head_bytes)
+        stderr = remote_output(record, 'stderr', head_bytes)
+        passed = record['exit_code'] == 0
+        if record['exit_code'] == TIMEOUT_EXIT_CODE:
+            output = "Timed out after {}s\n{}".format(test.get('timeout', default_timeout), stdout)
+        else:
+            output = stdout if passed else (stderr or stdout)
+        results[category].append({
+            "test_name": test['name'],
+            "output": output,
+            "status": "Passed" if passed else "Failed",
+            "exit_code": record['exit_code'],
+            "elapsed_ms": record['elapsed_ms'],
+        })
+    return results
+
+
+def failed_results(tests: dict, message: str) -> dict:
+    """Mark every test as failed with the same message, e.g. when the sensor could not be reached."""
+    return {category: [{"test_name": test['name'], "output": message, "status": "Failed"} for test in test_commands]
+            for category, test_commands in tests.items()}
+
+
+def run_compiled_tests(ip_address_sensor: str, username_sensorz: str, password_sensorz: str, tests: dict) -> dict:
+    """Run all tests for a sensor in one round trip and one sudo, returning results per category.
+
+    Returns None when the sensor cannot run the compiled script, so the caller runs the tests one by one.
+    """
+    default_timeout = float(os.getenv('SENSOR_TEST_TIMEOUT', str(DEFAULT_TEST_TIMEOUT)))
+    head_bytes, tail_bytes = output_bounds()
+    script = build_remote_script(tests, default_timeout, head_bytes, tail_bytes)
+    overall_timeout = sum(test.get('timeout', default_timeout) for _, test in flatten_tests(tests)) + 60
+    try:
+        with span('test_suite', ip_address_sensor):
+            # The payload is parsed as one JSON document, so it is never truncated here; every output in it is
+            # already bounded on the sensor.
+            _, stdout, stderr = capture_command(ip_address_sensor, username_sensorz, password_sensorz, "sudo sh -s",
+                                                timeout=overall_timeout, stdin_data=script.encode(), bounded=False)
+    except Exception as e:
+        logging.error("Connection or execution failed for {}: {}".format(ip_address_sensor, str(e)))
+        return failed_results(tests, str(e))
+    if '"unsupported"' in stdout[:100]:
+        logging.warning("{} cannot run compiled tests ({}), running them one by one".format(
+            ip_address_sensor, json.loads(stdout)['unsupported']))
+        return None
+    try:
+        return parse_remote_results(tests, stdout, default_timeout, head_bytes)
+    except (ValueError, KeyError) as e:
+        logging.error("Unreadable test payload from {}: {} {}".format(ip_address_sensor, e, stderr))
+        return failed_results(tests, stderr or "Unreadable test results: {}".format(e))
@@ -4,22 +4,32 @@ import socket
 import subprocess
 from functools import wraps
 
-import concurrent.futures  # Corrected import
 import paramiko
-import yaml
 from dotenv import load_dotenv
 
+from fleet_engine import run_fleet
+from inventory import select_sensors
+from link_throttle import get_link_throttle
+from negative_cache import get_negative_cache
+from output_capture import capture_command
+from reachability import preflight
+from route_cache import remember_route, resolve_sensor
+from state_store import get_state_store, incremental_mode
+from tool_audit import TOOLS_TO_CHECK, audit_and_install, download_limit_options
+from tracing import get_tracer
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Enable verbose logging for Paramiko
-paramiko.util.log_to_file('paramiko.log', level='DEBUG')
-
 # Load environment variables
 load_dotenv(dotenv_path=r'config/.env')
 sensors_file_path = os.getenv('SENSOR_DETAILS_PATH')
 PASSWORD_SENSORZ = os.getenv('PASSWORD_SENSORZ')
 
+# Per-phase timings come from the tracing module; paramiko's DEBUG log is only for protocol debugging.
+if os.getenv('PARAMIKO_DEBUG_LOG'):
+    paramiko.util.log_to_file(os.getenv('PARAMIKO_DEBUG_LOG'), level='DEBUG')
+
 
 def can_ping(ip_address: str) -> tuple:
     """Check if an IP address is reachable using ping and return the ping output and success status."""
@@ -51,28 +61,33 @@ def can_connect(ip_address: str, port: int = 80, timeout: int = 30) -> bool:
         return False
 
 
-def update_ip_prefix(sensor: dict, new_prefix: str) -> None:
-    """Update the IP prefix of a sensor based on its current setting."""
+def update_ip_prefix(sensor: dict, new_prefix: str) -> dict:
+    """Return a copy of the sensor with its IP moved to the given prefix."""
     parts = sensor['ip_address_sensor'].split('.')
     parts[0], parts[1] = new_prefix.split('.')[:2]
-    sensor['ip_address_sensor'] = '.'.join(parts)
+    return dict(sensor, ip_address_sensor='.'.join(parts))
 
 
 def retry(f):
-    """Decorator to retry sensor operations with an updated IP address."""
+    """Decorator to run sensor operations on the sensor's best known address, retrying on the other prefix."""
 
     @wraps(f)
     def wrapper_retry(sensor, *args, **kwargs):
+        sensor = resolve_sensor(sensor)
         try:
-            return f(sensor, *args, **kwargs)
+            result = f(sensor, *args, **kwargs)
+            remember_route(sensor)
+            return result
         except Exception as e:
             logging.error(f"First attempt failed for {sensor['ip_address_sensor']}: {e}")
             original_ip = sensor['ip_address_sensor']
             new_prefix = '10.3' if original_ip.startswith('10.8') else '10.8'
-            update_ip_prefix(sensor, new_prefix)
+            sensor = update_ip_prefix(sensor, new_prefix)
             if can_ping(sensor['ip_address_sensor'])[0]:  # Check if the ping after update is successful
                 try:
-                    return f(sensor, *args, **kwargs)
+                    result = f(sensor, *args, **kwargs)
+                    remember_route(sensor)
+                    return result
                 except Exception as second_try_error:
                     logging.error(f"Retry attempt failed for {sensor['ip_address_sensor']}: {second_try_error}")
                     return f"Failed operation on {sensor['ip_address_sensor']}: {second_try_error}"
@@ -84,10 +99,9 @@ def retry(f):
 
 
 def load_sensor_details(file_path: str) -> list:
-    """Load sensor details from a YAML file."""
+    """Load the sensors matching SENSOR_SELECTOR (all by default) from the inventory."""
     try:
-        with open(file_path) as file:
-            return yaml.safe_load(file) or []
+        return select_sensors(file_path)
     except FileNotFoundError as e:
         logging.error(f"Error loading sensor details: {e}")
         return []
@@ -100,17 +114,14 @@ def run_ssh_command(ip_address_sensor: str, username_sensorz: str, password_sens
     """Execute an SSH command on the sensor and return the output and error message if any."""
     logging.info(f"Attempting to execute SSH command on {ip_address_sensor}: {command}")
     try:
-        with paramiko.SSHClient() as client:
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(hostname=ip_address_sensor, username=username_sensorz, password=password_sensorz, timeout=30)
-            stdin, stdout, stderr = client.exec_command(command)
-            stdout_result = stdout.read().decode()
-            stderr_result = stderr.read().decode()
-            logging.info(f"STDOUT: {stdout_result}")
-            if stderr_result:
-                logging.error(f"STDERR: {stderr_result}")
-                return stdout_result, f"SSH command error: {stderr_result}"
-            return stdout_result, "Success"
+        # stdout is parsed (e.g. apt list --upgradable), so it is only compressed, never truncated.
+        _, stdout_result, stderr_result = capture_command(
+            ip_address_sensor, username_sensorz, password_sensorz, command, timeout=30, bounded=False)
+        logging.info(f"STDOUT: {stdout_result}")
+        if stderr_result:
+            logging.error(f"STDERR: {stderr_result}")
+            return stdout_result, f"SSH command error: {stderr_result}"
+        return stdout_result, "Success"
     except paramiko.SSHException as e:
         error_message = f"SSH operation failed: {e}"
         logging.error(error_message)
@@ -127,15 +138,33 @@ def is_tool_installed(ip_address_sensor: str, username_sensorz: str, password_se
 
 def list_upgradable_packages(ip_address_sensor: str, username_sensorz: str, password_sensorz: str) -> tuple:
     """List upgradable packages on the sensor and return the output."""
+    options = download_limit_options('apt', get_link_throttle().download_limit_kb(ip_address_sensor))
     return run_ssh_command(ip_address_sensor, username_sensorz, password_sensorz,
-                           "sudo apt update && apt list --upgradable")
+                           f"sudo apt{options} update && apt list --upgradable")
+
+
+def ensure_tools_installed(ip_address_sensor: str, username_sensorz: str, password_sensorz: str, tools: list,
+                           refresh: bool = True, sensor: dict = None) -> dict:
+    """Probe all tools in one round trip and install the missing ones in a single transaction.
+
+    Returns a mapping of tool to its status string.
+    """
+    try:
+        audit = audit_and_install(ip_address_sensor, username_sensorz, password_sensorz, tools, refresh=refresh,
+                                  sensor=sensor)
+    except Exception as e:
+        logging.error(f"Tool audit failed on {ip_address_sensor}: {e}")
+        return {tool: f"Failed to install {tool}: {e}" for tool in tools}
+    statuses = {tool: "Already installed" for tool in audit['already_installed']}
+    statuses.update({tool: "Installed" for tool in audit['installed']})
+    statuses.update({tool: f"Failed to install {tool}: {audit['error'] or 'not found after install'}"
+                     for tool in audit['failed']})
+    return statuses
 
 
 def ensure_tool_installed(ip_address_sensor: str, username_sensorz: str, password_sensorz: str, tool: str) -> str:
     """Ensure a tool is installed on the sensor, installing it if necessary."""
-    if not is_tool_installed(ip_address_sensor, username_sensorz, password_sensorz, tool):
-        return install_tool(ip_address_sensor, username_sensorz, password_sensorz, tool)
-    return "Already installed"
+    return ensure_tools_installed(ip_address_sensor, username_sensorz, password_sensorz, [tool])[tool]
 
 
 def install_tool(ip_address_sensor: str, username_sensorz: str, password_sensorz: str, tool: str) -> str:
@@ -155,21 +184,39 @@ def parse_upgradable_packages(upgradable_output: str) -> list:
     return [line.split('/')[0] for line in lines if line and not line.startswith('Listing...')]
 
 
-def process_sensor(sensor: dict) -> str:
-    """Process each sensor for updates, tool checks, installations, and a ping test."""
+def process_sensor(sensor: dict, ping: bool = True) -> str:
+    """Process each sensor for updates, tool checks, installations, and a ping test.
+
+    ping=False skips the local ping for callers whose pre-flight sweep has just reached the sensor.
+    """
     ip_address_sensor = sensor['ip_address_sensor']
     username_sensorz = sensor['username_sensorz']
     password_sensorz = PASSWORD_SENSORZ
     logging.info(f"Processing sensor at {ip_address_sensor}")
-    ping_success, ping_output = can_ping(ip_address_sensor)
+    if ping:
+        ping_success, ping_output = can_ping(ip_address_sensor)
+    else:
+        ping_success, ping_output = True, "Skipped, reachable in the pre-flight sweep"
     if not ping_success:
         return f"Failed to ping {ip_address_sensor}: {ping_output}"
-    upgradable_output, update_errors = list_upgradable_packages(ip_address_sensor, username_sensorz, password_sensorz)
-    upgradable_packages = parse_upgradable_packages(upgradable_output)
-    tools_to_check = ['stress', 'iperf3', 'mtr', 'dnsutils']
+    store = get_state_store()
+    upgradable_packages = store.get(sensor, 'upgradable') if incremental_mode() else None
+    if upgradable_packages is None:
+        upgradable_output, update_errors = list_upgradable_packages(ip_address_sensor, username_sensorz,
+                                                                    password_sensorz)
+        upgradable_packages = parse_upgradable_packages(upgradable_output)
+        # apt always warns about its unstable CLI on stderr, so judge the check by the listing itself. The
+        # listing only follows a successful `apt update`, so yum sensors and failed updates refresh on install.
+        lists_refreshed = 'Listing...' in upgradable_output
+        store.set(sensor, 'upgradable', upgradable_packages, ok=lists_refreshed)
+    else:
+        update_errors = "Package update skipped, upgradable packages are from the last run."
+        lists_refreshed = False
     installed_tools, already_installed, failed_to_install = [], [], []
-    for tool in tools_to_check:
-        result = ensure_tool_installed(ip_address_sensor, username_sensorz, password_sensorz, tool)
+    # When the package lists were just refreshed by list_upgradable_packages, the install skips its own update.
+    tool_statuses = ensure_tools_installed(ip_address_sensor, username_sensorz, password_sensorz, TOOLS_TO_CHECK,
+                                           refresh=not lists_refreshed, sensor=sensor)
+    for tool, result in tool_statuses.items():
         if "Installed" in result:
             installed_tools.append(tool)
         elif "Already installed" in result:
@@ -195,11 +242,28 @@ def main():
     if not sensor_details:
         logging.error("No sensor details found.")
         return
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_sensor, sensor) for sensor in sensor_details]
-        summaries = [future.result() for future in futures]
+    store = get_state_store()
+    store.start_run('detect_package_manager_and_install')
+    alive, dead, skipped = preflight(sensor_details)
+    negative_cache = get_negative_cache()
+
+    def on_error(sensor, e):
+        negative_cache.record_failure(sensor, str(e))
+        return f"Failed operation on {sensor['ip_address_sensor']}: {e}"
+
+    summaries = run_fleet(alive, process_sensor, on_error=on_error,
+                          on_result=lambda sensor, _: negative_cache.record_success(sensor))
+    summaries.extend(f"Failed to ping {sensor['ip_address_sensor']}: not reachable in pre-flight sweep"
+                     for sensor in dead)
+    for sensor in skipped:
+        entry = negative_cache.skipped_entry(sensor)
+        summaries.append(f"Skipped {sensor['ip_address_sensor']}: {entry['reason']} "
+                         f"(last known state: {entry['last_state']})")
     for summary in summaries:
         print(summary)
+    store.finish_run()
+    store.write_diff_report()
+    get_tracer().export('detect_package_manager_and_install')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+import asyncio
+import concurrent.futures
+import ipaddress
+import logging
+import os
+import time
+
+from link_throttle import get_link_throttle
+from sensor_timings import get_sensor_timings
+from ssh_transport import get_transport
+from tracing import span
+
+
+class StragglerTimeout(TimeoutError):
+    """A sensor's operation ran past its budget or the run deadline and was abandoned.
+
+    started is False for sensors the deadline reached before they got a worker.
+    """
+
+    def __init__(self, message: str, started: bool = True):
+        super().__init__(message)
+        self.started = started
+
+
+def subnet_of(sensor: dict, prefix_length: int) -> str:
+    """Return the subnet (e.g. 10.8.0.0/24) a sensor's address belongs to."""
+    ip_address = sensor.get('ip_address_sensor', '')
+    try:
+        return str(ipaddress.ip_network(f"{ip_address}/{prefix_length}", strict=False))
+    except ValueError:
+        return ip_address
+
+
+def release_sensor_connection(sensor: dict) -> None:
+    """Close a sensor's pooled transport so a worker blocked on it returns promptly."""
+    if sensor.get('ip_address_sensor') and sensor.get('username_sensorz'):
+        get_transport().discard(sensor['ip_address_sensor'], sensor['username_sensorz'])
+
+
+class FleetEngine:
+    """Run one operation per sensor from an asyncio loop with global, per-subnet and per-link-class limits.
+
+    Coroutine workers are awaited directly. Blocking workers (the paramiko based ones) run on an executor
+    sized to the global limit, so the number of threads never exceeds the number of operations in flight.
+
+    Sensors start slowest and flakiest first according to their recorded timings, and each gets a budget
+    derived from its usual duration (at most operation_timeout). With a run_deadline, whatever is still
+    running or waiting when it passes is abandoned as a straggler, so the run always returns on time.
+    """
+
+    def __init__(self, max_concurrency: int = None, subnet_concurrency: int = None, subnet_prefix: int = None,
+                 operation_timeout: float = None, run_deadline: float = None, timings=None):
+        self.max_concurrency = max_concurrency or int(os.getenv('FLEET_MAX_CONCURRENCY', '64'))
+        self.subnet_concurrency = subnet_concurrency or int(os.getenv('FLEET_SUBNET_CONCURRENCY', '16'))
+        self.subnet_prefix = subnet_prefix or int(os.getenv('FLEET_SUBNET_PREFIX', '24'))
+        self.operation_timeout = operation_timeout or float(os.getenv('FLEET_OPERATION_TIMEOUT', '600'))
+        # Seconds the whole run may take; 0 means no deadline.
+        self.run_deadline = run_deadline or float(os.getenv('FLEET_RUN_DEADLINE', '0'))
+        self.timings = timings or get_sensor_timings()
+        self.throttle = get_link_throttle()
+        self.stragglers = []
+
+    async def _run_one(self, sensor, worker, args, executor, global_limit, subnet_limits, link_limits,
+                       operation_name, deadline, started):
+        subnet_limit = subnet_limits.setdefault(subnet_of(sensor, self.subnet_prefix),
+                                                asyncio.Semaphore(self.subnet_concurrency))
+        link = self.throttle.register(sensor)
+        link_limit = link_limits.setdefault(
+            link, asyncio.Semaphore(self.throttle.concurrency_limit(link) or self.max_concurrency))
+        # Narrowest limits first, so a sensor queued behind its link or subnet does not hold a global slot.
+        async with link_limit, subnet_limit, global_limit:
+            started.add(id(sensor))
+            budget = self.timings.budget(sensor, operation_name, self.operation_timeout)
+            limited = deadline is not None and deadline - time.monotonic() < budget
+            if limited:
+                budget = max(0.0, deadline - time.monotonic())
+            if asyncio.iscoroutinefunction(worker):
+                operation = asyncio.ensure_future(worker(sensor, *args))
+            else:
+                operation = asyncio.get_running_loop().run_in_executor(executor, worker, sensor, *args)
+            clock = time.perf_counter()
+            try:
+                with span('operation', sensor.get('ip_address_sensor')):
+                    done, _ = await asyncio.wait({operation}, timeout=budget)
+                    if not done:
+                        raise StragglerTimeout(f"Timed out after {budget:.0f}s "
+                                               f"({'run deadline' if limited else 'sensor budget'})")
+                    result = operation.result()
+            except (StragglerTimeout, asyncio.CancelledError):
+                operation.cancel()
+                release_sensor_connection(sensor)
+                self.timings.record(sensor, operation_name, time.perf_counter() - clock, ok=False)
+                self.throttle.record(sensor, ok=False)
+                raise
+            except Exception:
+                self.timings.record(sensor, operation_name, time.perf_counter() - clock, ok=False)
+                self.throttle.record(sensor, ok=False)
+                raise
+            self.timings.record(sensor, operation_name, time.perf_counter() - clock, ok=True)
+            self.throttle.record(sensor, ok=True)
+            return result
+
+    async def run(self, sensors: list, worker, *args, on_result=None, on_error=None, collect: bool = True,
+                  operation_name: str = None) -> list:
+        """Run worker(sensor, *args) for every sensor and return the results in completion order.
+
+        on_result(sensor, result) is called as each operation finishes. on_error(sensor, exc) turns a
+        failure or timeout into a result; without it failures are logged and left out. Stragglers are
+        reported to on_error as StragglerTimeout. With collect=False results are only handed to on_result,
+        so nothing accumulates in memory. Timings are kept per operation_name (default: the worker's name).
+        """
+        operation_name = operation_name or getattr(worker, '__name__', 'operation')
+        deadline = time.monotonic() + self.run_deadline if self.run_deadline else None
+        global_limit = asyncio.Semaphore(self.max_concurrency)
+        subnet_limits, link_limits = {}, {}
+        started = set()
+        self.stragglers = []
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency)
+        tasks = {asyncio.ensure_future(self._run_one(sensor, worker, args, executor, global_limit, subnet_limits,
+                                                     link_limits, operation_name, deadline, started)): sensor
+                 for sensor in self.timings.order(sensors, operation_name)}
+        results = []
+
+        def finish(sensor, result=None, error=None):
+            if error is not None:
+                if isinstance(error, StragglerTimeout):
+                    self.stragglers.append(sensor)
+                logging.error(f"{sensor.get('hostname', 'Unknown')} ({sensor.get('ip_address_sensor')}): {error}")
+                result = on_error(sensor, error) if on_error else None
+            if result is None:
+                return
+            if on_result:
+                on_result(sensor, result)
+            if collect:
+                results.append(result)
+
+        try:
+            pending = set(tasks)
+            while pending:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        finish(tasks[task], task.result())
+                    except Exception as e:
+                        finish(tasks[task], error=e)
+                if not done and pending:
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.wait(pending)
+                    for task in pending:
+                        sensor = tasks[task]
+                        state = 'still running' if id(sensor) in started else 'not started'
+                        finish(sensor, error=StragglerTimeout(
+                            f"Run deadline of {self.run_deadline:.0f}s reached ({state})", id(sensor) in started))
+                    pending = set()
+        finally:
+            for task in tasks:
+                task.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.timings.save()
+        if self.stragglers:
+            logging.warning(f"{len(self.stragglers)} of {len(tasks)} sensors timed out; their results are partial")
+        return results
+
+    def run_sync(self, sensors: list, worker, *args, on_result=None, on_error=None, collect: bool = True,
+                 operation_name: str = None) -> list:
+        """Blocking wrapper around run() for the scripts' synchronous entry points."""
+        return asyncio.run(self.run(sensors, worker, *args, on_result=on_result, on_error=on_error,
+                                    collect=collect, operation_name=operation_name))
+
+
+def run_fleet(sensors: list, worker, *args, on_result=None, on_error=None, collect: bool = True,
+              operation_name: str = None, **limits) -> list:
+    """Run worker over the fleet with a FleetEngine configured from limits or config/.env."""
+    return FleetEngine(**limits).run_sync(sensors, worker, *args, on_result=on_result, on_error=on_error,
+                                          collect=collect, operation_name=operation_name)
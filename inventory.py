@@ -0,0 +1,203 @@
+"""Sensor inventory with tags, lookup indexes and a compiled on-disk cache.
+
+Tags come from the attributes in parentheses after the sensor name, e.g.
+"SENS-WA10-398A-0156 (Terrace, Connected with PoE, Connected with cell dongle)":
+
+* "Connected with/via/to X" attributes give the slug of X plus each of its words:
+  cell-dongle, cell, dongle, poe, openvpn, new-ps, new, ps, ...
+* Group attributes, whose parts are separated by " / ", give the slug of each part: "QA Lab / Sensorz"
+  gives qa-lab and sensorz.
+* Every other attribute gives one slug, so free text such as "BananaPi stuck 04/04/24" stays
+  bananapi-stuck-04-04-24 rather than matching tag:04.
+* A "tags" list on the inventory entry is added as is.
+
+Selectors combine terms with &&, ||, ! and parentheses, e.g. "tag:poe && !tag:cell". Terms are tag:<tag>,
+host:<glob> (matched against the sensor name), ip:<glob or CIDR>, or a bare tag.
+"""
+import fnmatch
+import hashlib
+import ipaddress
+import logging
+import os
+import re
+
+import yaml
+
+from state_files import load_json_state, save_json_state
+
+# Bump when the tag parsing or the cache file changes so stale caches are rebuilt.
+CACHE_VERSION = 2
+CONNECTION_PREFIX = re.compile(r'^connected\s+(with|via|to)\s+', re.IGNORECASE)
+GROUP_SEPARATOR = re.compile(r'\s+/\s+')
+# The cache holds whole inventory entries, credentials included, so only the owner may read it.
+CACHE_FILE_MODE = 0o600
+SELECTOR_TOKEN = re.compile(r'\s*(&&|\|\||!|\(|\)|[^\s()!&|]+)')
+
+
+def slugify(text: str) -> str:
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-')
+
+
+def split_hostname(hostname: str) -> tuple:
+    """Split "NAME (attr, attr, ...)" into the sensor name and its attributes."""
+    name, _, rest = (hostname or '').partition('(')
+    attributes = [attribute.strip() for attribute in rest.rsplit(')', 1)[0].split(',')] if rest else []
+    return name.strip(), [attribute for attribute in attributes if attribute]
+
+
+def parse_tags(sensor: dict) -> list:
+    """Return the sorted tags of an inventory entry."""
+    tags = {slugify(str(tag)) for tag in sensor.get('tags') or []}
+    for attribute in split_hostname(sensor.get('hostname', ''))[1]:
+        connection = CONNECTION_PREFIX.sub('', attribute)
+        if connection != attribute:
+            slug = slugify(connection)
+            tags.add(slug)
+            tags.update(slug.split('-'))
+        else:
+            tags.update(slugify(part) for part in GROUP_SEPARATOR.split(attribute))
+    tags.discard('')
+    return sorted(tags)
+
+
+class Inventory:
+    """Sensor list with hostname, name, IP and tag indexes. Selections return the original entries in order."""
+
+    def __init__(self, sensors: list, tags: list = None):
+        self.sensors = sensors
+        self.tags = tags if tags is not None else [parse_tags(sensor) for sensor in sensors]
+        self.by_hostname, self.by_name, self.by_ip, self.by_tag = {}, {}, {}, {}
+        for index, sensor in enumerate(sensors):
+            self.by_hostname[sensor.get('hostname')] = index
+            self.by_name[split_hostname(sensor.get('hostname', ''))[0]] = index
+            self.by_ip[sensor.get('ip_address_sensor')] = index
+            for tag in self.tags[index]:
+                self.by_tag.setdefault(tag, set()).add(index)
+
+    def __len__(self):
+        return len(self.sensors)
+
+    def get(self, key: str) -> dict:
+        """Look a sensor up by full hostname, sensor name or IP address."""
+        for index in (self.by_hostname, self.by_name, self.by_ip):
+            if key in index:
+                return self.sensors[index[key]]
+        return None
+
+    def tags_of(self, sensor: dict) -> list:
+        return self.tags[self.by_hostname[sensor.get('hostname')]]
+
+    def select(self, selector: str = None) -> list:
+        """Return the sensors matching a selector, or all sensors for an empty selector."""
+        if not selector or not selector.strip():
+            return list(self.sensors)
+        return [self.sensors[index] for index in sorted(self._evaluate(selector))]
+
+    def _match_term(self, term: str) -> set:
+        kind, _, value = term.partition(':') if ':' in term else ('tag', '', term)
+        if kind == 'tag':
+            return set(self.by_tag.get(slugify(value), ()))
+        if kind == 'host':
+            return {index for name, index in self.by_name.items() if fnmatch.fnmatch(name.lower(), value.lower())}
+        if kind == 'ip':
+            if '/' in value:
+                network = ipaddress.ip_network(value, strict=False)
+                return {index for ip, index in self.by_ip.items() if ip and ipaddress.ip_address(ip) in network}
+            return {index for ip, index in self.by_ip.items() if ip and fnmatch.fnmatch(ip, value)}
+        raise ValueError(f"Unknown selector term {term!r}")
+
+    def _evaluate(self, selector: str) -> set:
+        tokens = SELECTOR_TOKEN.findall(selector)
+        if ''.join(tokens) != re.sub(r'\s+', '', selector):
+            raise ValueError(f"Cannot parse selector {selector!r}")
+        position = 0
+
+        def peek():
+            return tokens[position] if position < len(tokens) else None
+
+        def take():
+            nonlocal position
+            position += 1
+            return tokens[position - 1]
+
+        def parse_or():
+            matched = parse_and()
+            while peek() == '||':
+                take()
+                matched = matched | parse_and()
+            return matched
+
+        def parse_and():
+            matched = parse_not()
+            while peek() == '&&':
+                take()
+                matched = matched & parse_not()
+            return matched
+
+        def parse_not():
+            if peek() == '!':
+                take()
+                return set(range(len(self.sensors))) - parse_not()
+            if peek() == '(':
+                take()
+                matched = parse_or()
+                if take() != ')':
+                    raise ValueError(f"Unbalanced parentheses in selector {selector!r}")
+                return matched
+            if peek() in (None, '&&', '||', ')'):
+                raise ValueError(f"Missing term in selector {selector!r}")
+            return self._match_term(take())
+
+        try:
+            matched = parse_or()
+        except IndexError:
+            raise ValueError(f"Unbalanced parentheses in selector {selector!r}")
+        if peek() is not None:
+            raise ValueError(f"Unexpected {peek()!r} in selector {selector!r}")
+        return matched
+
+
+def file_digest(path: str) -> str:
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def load_inventory(path: str = None, cache_path: str = None) -> Inventory:
+    """Load the sensor YAML through a compiled JSON cache.
+
+    The cache is reused while the file's mtime and size are unchanged; if they changed but the content hash
+    did not (a touch or a checkout), the cache is re-stamped instead of re-parsing the YAML.
+    """
+    path = path or os.getenv('SENSOR_DETAILS_PATH')
+    cache_path = cache_path or os.getenv('INVENTORY_CACHE_PATH', 'state/inventory_cache.json')
+    stat = os.stat(path)
+    cache = load_json_state(cache_path)
+    stamp = {'version': CACHE_VERSION, 'source': os.path.abspath(path), 'mtime': stat.st_mtime, 'size': stat.st_size}
+    if cache and all(cache.get(key) == value for key, value in stamp.items()):
+        return Inventory(cache['sensors'], cache['tags'])
+
+    digest = file_digest(path)
+    if cache.get('version') == CACHE_VERSION and cache.get('source') == stamp['source'] \
+            and cache.get('sha256') == digest:
+        save_json_state(cache_path, dict(cache, **stamp), mode=CACHE_FILE_MODE)
+        return Inventory(cache['sensors'], cache['tags'])
+
+    with open(path) as file:
+        sensors = yaml.safe_load(file) or []
+    inventory = Inventory(sensors)
+    try:
+        save_json_state(cache_path, dict(stamp, sha256=digest, sensors=sensors, tags=inventory.tags),
+                        mode=CACHE_FILE_MODE)
+    except (OSError, TypeError) as e:
+        logging.error(f"Could not write inventory cache {cache_path}: {e}")
+    logging.info(f"Compiled inventory of {len(inventory)} sensors from {path}")
+    return inventory
+
+
+def select_sensors(path: str = None, selector: str = None) -> list:
+    """Load the inventory and return the sensors matching the selector (SENSOR_SELECTOR by default)."""
+    selector = os.getenv('SENSOR_SELECTOR') if selector is None else selector
+    sensors = load_inventory(path).select(selector)
+    if selector:
+        logging.info(f"Selector {selector!r} matched {len(sensors)} sensors")
+    return sensors
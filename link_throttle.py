@@ -0,0 +1,184 @@
+"""Per-link-class concurrency limits and byte budgets.
+
+Every sensor belongs to one link class, taken from its inventory tags (see inventory.parse_tags); a sensor
+with several links gets the most constrained one, e.g. "Connected with PoE, Connected with cell dongle" is
+a cell sensor:
+    cell      cell dongles
+    openvpn   sensors behind the OpenVPN concentrator
+    ethernet  PoE and Ethernet
+    default   everything else
+
+LINK_CONCURRENCY caps how many sensors of a class are worked on at once and LINK_BANDWIDTH is the byte rate
+(bytes/s) a class shares, both as "class=value,..." (0 = unlimited). Command output and pushed files are
+charged to a token bucket per class that allows LINK_BURST_SECONDS of burst. Package downloads run on the
+sensor and are capped there at the sensor's share of its class's rate.
+
+A class whose operations fail or time out halves its rate, and every success wins back a tenth of the
+configured rate, so a link that starts collapsing is backed off instead of retried at full speed.
+"""
+import os
+import threading
+import time
+
+from inventory import parse_tags
+from reachability import candidate_addresses
+
+# Most constrained first: a sensor gets the first class any of its tags belongs to.
+LINK_CLASS_TAGS = {
+    'cell': {'cell', 'cell-dongle'},
+    'openvpn': {'openvpn', 'vpn'},
+    'ethernet': {'poe', 'ethernet', 'ethernet-dongle'},
+}
+DEFAULT_LINK_CLASS = 'default'
+
+DEFAULT_LINK_CONCURRENCY = {'cell': 4, 'openvpn': 16}
+DEFAULT_LINK_BANDWIDTH = {'cell': 256 * 1024, 'openvpn': 4 * 1024 * 1024}
+
+# A backed off class never drops below this fraction of its configured rate.
+MIN_RATE_FRACTION = 0.05
+
+
+def link_class(sensor: dict) -> str:
+    tags = set(parse_tags(sensor))
+    for name, class_tags in LINK_CLASS_TAGS.items():
+        if tags & class_tags:
+            return name
+    return DEFAULT_LINK_CLASS
+
+
+def parse_limits(value: str, defaults: dict) -> dict:
+    """Parse "class=number,..." on top of the defaults."""
+    limits = dict(defaults)
+    for item in value.split(','):
+        name, _, number = item.partition('=')
+        if name.strip() and number.strip():
+            limits[name.strip()] = float(number)
+    return limits
+
+
+class TokenBucket:
+    """Byte budget refilled at rate bytes/s up to burst bytes.
+
+    consume() takes the bytes even when that drives the bucket into debt and then sleeps the debt off, so
+    chunks larger than the burst still pass and the long-run rate holds.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.ceiling = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int) -> float:
+        """Charge amount bytes, wait until the bucket is out of debt and return the seconds waited."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def back_off(self) -> None:
+        with self._lock:
+            self.rate = max(self.ceiling * MIN_RATE_FRACTION, self.rate / 2)
+
+    def recover(self) -> None:
+        with self._lock:
+            self.rate = min(self.ceiling, self.rate + self.ceiling / 10)
+
+
+class ThrottledCapture:
+    """Capture wrapper that charges every chunk to a bucket before passing it on.
+
+    Waiting here stops the channel being read, so SSH flow control slows the sensor down too.
+    """
+
+    def __init__(self, capture, bucket: TokenBucket):
+        self.capture = capture
+        self.bucket = bucket
+
+    def write(self, chunk: bytes) -> None:
+        self.bucket.consume(len(chunk))
+        self.capture.write(chunk)
+
+    def finish(self) -> str:
+        return self.capture.finish()
+
+
+class LinkThrottle:
+    """Link class of every known sensor address, with each class's concurrency limit and byte bucket."""
+
+    def __init__(self, concurrency: dict = None, bandwidth: dict = None, burst_seconds: float = None):
+        self.concurrency = concurrency or parse_limits(os.getenv('LINK_CONCURRENCY', ''), DEFAULT_LINK_CONCURRENCY)
+        self.bandwidth = bandwidth or parse_limits(os.getenv('LINK_BANDWIDTH', ''), DEFAULT_LINK_BANDWIDTH)
+        burst_seconds = burst_seconds or float(os.getenv('LINK_BURST_SECONDS', '2'))
+        self.buckets = {name: TokenBucket(rate, rate * burst_seconds)
+                        for name, rate in self.bandwidth.items() if rate > 0}
+        self._classes = {}
+        self._lock = threading.Lock()
+
+    def register(self, sensor: dict) -> str:
+        """Remember the link class of both of a sensor's addresses and return it."""
+        name = link_class(sensor)
+        with self._lock:
+            for ip_address in candidate_addresses(sensor):
+                self._classes[ip_address] = name
+        return name
+
+    def class_of(self, ip_address: str) -> str:
+        with self._lock:
+            return self._classes.get(ip_address, DEFAULT_LINK_CLASS)
+
+    def concurrency_limit(self, name: str) -> int:
+        """Sensors of a class worked on at once; 0 means only the fleet-wide limits apply."""
+        return int(self.concurrency.get(name, 0))
+
+    def throttled(self, ip_address: str, capture):
+        """Wrap a capture so the output it receives is charged to the address's link class."""
+        bucket = self.buckets.get(self.class_of(ip_address))
+        return ThrottledCapture(capture, bucket) if bucket else capture
+
+    def transfer_callback(self, ip_address: str):
+        """Return a paramiko-style progress callback(transferred, total) that charges each new byte, or None."""
+        bucket = self.buckets.get(self.class_of(ip_address))
+        if not bucket:
+            return None
+        charged = [0]
+
+        def callback(transferred: int, total: int) -> None:
+            bucket.consume(transferred - charged[0])
+            charged[0] = transferred
+
+        return callback
+
+    def download_limit_kb(self, ip_address: str) -> int:
+        """KiB/s a single sensor of the address's class may download at: its share of the class's rate."""
+        name = self.class_of(ip_address)
+        bucket = self.buckets.get(name)
+        if not bucket:
+            return 0
+        return max(1, int(bucket.rate / max(1, self.concurrency_limit(name)) / 1024))
+
+    def record(self, sensor: dict, ok: bool) -> None:
+        """Back a class off after a failed or timed out operation, recover it after a successful one."""
+        bucket = self.buckets.get(link_class(sensor))
+        if bucket and ok:
+            bucket.recover()
+        elif bucket:
+            bucket.back_off()
+
+
+_shared_throttle = None
+_shared_throttle_lock = threading.Lock()
+
+
+def get_link_throttle() -> LinkThrottle:
+    global _shared_throttle
+    with _shared_throttle_lock:
+        if _shared_throttle is None:
+            _shared_throttle = LinkThrottle()
+        return _shared_throttle
@@ -1,26 +1,56 @@
-import subprocess
+import argparse
+import os
 import sys
 
-print(f"Using Python interpreter: {sys.executable}")
-
+from pipeline import OPTIONAL_STAGES, STAGES, run_pipeline
 
-def run_script(script_path):
-    python_executable = sys.executable  # Gets the Python interpreter path currently running the script
-    result = subprocess.run([python_executable, script_path], capture_output=True, text=True)
-    print('STDOUT:', result.stdout)
-    print('STDERR:', result.stderr)
+print(f"Using Python interpreter: {sys.executable}")
 
 
 def main():
-    scripts = [
-        r'C:\Users\Roy Avrahami\PycharmProjects\sensorz_qa_roy\check_ping_sensors.py',
-        r'C:\Users\Roy Avrahami\PycharmProjects\sensorz_qa_roy\detect_package_manager_and_install.py',
-        r'C:\Users\Roy Avrahami\PycharmProjects\sensorz_qa_roy\ssh_commands_test_sensors_tests.py'
-    ]
-
-    for script in scripts:
-        print(f"Running script: {script}")
-        run_script(script)
+    parser = argparse.ArgumentParser(description="Run the sensor checks in one process over shared connections.")
+    parser.add_argument('--stages', nargs='+', choices=STAGES + OPTIONAL_STAGES, default=STAGES,
+                        help=f"stages to run for every sensor (default: {' '.join(STAGES)})")
+    parser.add_argument('--select', default=None,
+                        help='only run on matching sensors, e.g. "tag:poe && !tag:cell" (default: SENSOR_SELECTOR)')
+    parser.add_argument('--incremental', action='store_true',
+                        help="only re-check stale facts and sensors that failed or changed since the last run")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running: probe the sensors on intervals and serve their status over a local API")
+    parser.add_argument('--shards', type=int, default=0,
+                        help="split the fleet across this many worker processes and merge their results")
+    parser.add_argument('--shard', default=None,
+                        help="only run shard i/N into --run-dir, e.g. on one of several controllers")
+    parser.add_argument('--run-dir', default=None, help="directory the shards of a sharded run write to")
+    parser.add_argument('--merge', default=None, metavar='RUN_DIR',
+                        help="build the reports of a sharded run from its shard directories")
+    parser.add_argument('--strategy', choices=['hash', 'subnet', 'tag'], default=None,
+                        help="how sensors are split across shards (default: SHARD_STRATEGY or hash)")
+    args = parser.parse_args()
+    if args.incremental:
+        os.environ['INCREMENTAL'] = '1'
+    if args.daemon:
+        from monitor_daemon import run_daemon
+        run_daemon(args.select)
+        return
+    if args.shard:
+        if not args.run_dir:
+            parser.error("--shard needs --run-dir")
+        from sharding import parse_shard, run_shard
+        manifest = run_shard(*parse_shard(args.shard), args.run_dir, args.stages, args.select, args.strategy)
+        print(f"shard manifest: {manifest}")
+        return
+
+    if args.merge:
+        from sharding import merge_shards
+        reports = merge_shards(args.merge)
+    elif args.shards > 1:
+        from sharding import run_local_shards
+        reports = run_local_shards(args.shards, args.stages, args.select, args.strategy, args.run_dir)
+    else:
+        reports = run_pipeline(args.stages, selector=args.select)
+    for stage, report in reports.items():
+        print(f"{stage} report: {report}")
 
 
 if __name__ == '__main__':
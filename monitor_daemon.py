@@ -0,0 +1,375 @@
+"""Long-running monitor that keeps warm SSH sessions to the fleet and runs checks on per-check intervals.
+
+The checks are 'ping' (check_ping_sensors.ping_test) and one 'tests:<category>' check for every category of
+the test definitions named in MONITOR_TEST_CATEGORIES. Each sensor's checks are rescheduled after every run
+with +/- MONITOR_JITTER of their interval, so the fleet's probes stay spread out instead of running in waves.
+Sensors backing off in the negative cache are not probed until their retry time.
+The latest result and the last MONITOR_HISTORY outcomes of every sensor and check are kept in memory and
+served over a local HTTP API:
+
+    GET  /status                  summary per check plus every sensor's latest outcomes
+    GET  /sensors/<hostname>      a sensor's latest results and history
+    POST /trigger?check=ping&select=tag:poe
+                                  run a check (default: all) now on all or the selected sensors
+    POST /reload                  reload the inventory
+
+The API listens on MONITOR_HTTP_ADDRESS (default 127.0.0.1:8765), or on the Unix socket MONITOR_SOCKET if set.
+"""
+import collections
+import concurrent.futures
+import heapq
+import http.server
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import signal
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import check_ping_sensors
+import sensor_tests
+from inventory import Inventory, select_sensors
+from link_throttle import get_link_throttle
+from negative_cache import get_negative_cache, sensor_key
+from ssh_transport import get_transport
+from state_store import get_state_store
+
+
+def check_interval(name: str, default: float) -> float:
+    """Interval of a check in seconds, overridable per check with MONITOR_INTERVAL_<NAME>."""
+    override = os.getenv(f"MONITOR_INTERVAL_{re.sub(r'[^A-Z0-9]+', '_', name.upper())}")
+    return float(override) if override else default
+
+
+class MonitorCheck:
+    """A probe run on every sensor: run(sensor) returns a result and passed(result) judges it."""
+
+    def __init__(self, name: str, interval: float, run, passed, record=None):
+        self.name = name
+        self.interval = interval
+        self.run = run
+        self.passed = passed
+        self.record = record
+
+
+def ping_probe(sensor: dict) -> dict:
+    # A sensor that fails on both addresses raises RetryFailed, which _probe records as an error.
+    result = check_ping_sensors.ping_test(sensor)
+    if result['ping_status'] != 'Pass':
+        get_negative_cache().record_failure(sensor, 'Ping failed')
+    return result
+
+
+def record_ping(sensor: dict, result: dict) -> None:
+    get_state_store().set(sensor, 'ping', result, ok=result['ping_status'] == 'Pass')
+
+
+def tests_passed(result: dict) -> bool:
+    return all(test['status'] == 'Passed' for tests in result['results'].values() for test in tests)
+
+
+def build_checks() -> dict:
+    """Return {name: MonitorCheck} for ping and the categories in MONITOR_TEST_CATEGORIES."""
+    checks = {'ping': MonitorCheck('ping', check_interval('ping', float(os.getenv('MONITOR_PING_INTERVAL', '60'))),
+                                   ping_probe, lambda result: result['ping_status'] == 'Pass', record_ping)}
+    categories = [category.strip() for category in os.getenv('MONITOR_TEST_CATEGORIES', '').split(',')
+                  if category.strip()]
+    if not categories:
+        return checks
+    tests = sensor_tests.load_tests(os.getenv('TESTS_DEFINITIONS_PATH'))
+    default_interval = float(os.getenv('MONITOR_TEST_INTERVAL', '300'))
+    for category in categories:
+        if category not in tests:
+            raise ValueError(f"Test category {category!r} is not in the test definitions")
+        name = f"tests:{category}"
+        checks[name] = MonitorCheck(name, check_interval(name, default_interval),
+                                    lambda sensor, suite={category: tests[category]}:
+                                    sensor_tests.run_test_on_sensor(sensor, suite), tests_passed)
+    return checks
+
+
+class MonitorState:
+    """Latest result and a bounded history of outcomes per sensor and check.
+
+    Only the latest result is kept whole; history entries hold the time, status, duration and error, so
+    memory stays proportional to fleet size times MONITOR_HISTORY.
+    """
+
+    def __init__(self, history: int = None):
+        self.history = history or int(os.getenv('MONITOR_HISTORY', '20'))
+        self._latest = {}
+        self._outcomes = {}
+        self._lock = threading.Lock()
+
+    def record(self, hostname: str, check: str, status: str, duration: float, result=None, error: str = None):
+        outcome = {'time': time.time(), 'status': status, 'duration': round(duration, 3)}
+        if error:
+            outcome['error'] = error
+        with self._lock:
+            outcomes = self._outcomes.setdefault((hostname, check), collections.deque(maxlen=self.history))
+            previous = outcomes[-1]['status'] if outcomes else None
+            outcomes.append(outcome)
+            self._latest[(hostname, check)] = dict(outcome, result=result)
+        if previous and previous != status:
+            logging.warning(f"{hostname} {check}: {previous} -> {status}")
+
+    def forget(self, hostnames) -> None:
+        """Drop the results of sensors that left the inventory."""
+        with self._lock:
+            for key in [key for key in self._outcomes if key[0] in hostnames]:
+                self._outcomes.pop(key)
+                self._latest.pop(key, None)
+
+    def status(self) -> dict:
+        with self._lock:
+            latest = list(self._latest.items())
+        checks, sensors = {}, {}
+        for (hostname, check), entry in latest:
+            counts = checks.setdefault(check, {'Pass': 0, 'Fail': 0, 'Error': 0})
+            counts[entry['status']] += 1
+            sensors.setdefault(hostname, {})[check] = {key: value for key, value in entry.items() if key != 'result'}
+        return {'checks': checks, 'sensors': sensors}
+
+    def sensor(self, hostname: str) -> dict:
+        with self._lock:
+            return {check: {'latest': self._latest.get((name, check)), 'history': list(outcomes)}
+                    for (name, check), outcomes in self._outcomes.items() if name == hostname}
+
+
+class MonitorDaemon:
+    """Schedule every check on every sensor and run the due ones on a bounded worker pool."""
+
+    def __init__(self, checks: dict, selector: str = None, max_concurrency: int = None, jitter: float = None):
+        self.checks = checks
+        self.selector = selector
+        self.jitter = float(os.getenv('MONITOR_JITTER', '0.1')) if jitter is None else jitter
+        self.state = MonitorState()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency or int(os.getenv('FLEET_MAX_CONCURRENCY', '64')))
+        self.sensors = {}
+        self._queue = []
+        self._due = {}
+        self._running = set()
+        self._rerun = set()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+
+    def _schedule(self, key: str, check: str, due: float) -> None:
+        """Set when a sensor's check next runs. Caller holds the condition."""
+        self._due[(key, check)] = due
+        heapq.heappush(self._queue, (due, next(self._sequence), key, check))
+        self._condition.notify()
+
+    def next_run(self, check: str) -> float:
+        return time.time() + self.checks[check].interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def load_inventory(self) -> int:
+        """(Re)load the selected sensors; new sensors get their first runs spread over each interval."""
+        sensors = {sensor_key(sensor): dict(sensor, Password_sensorz=sensor.get('Password_sensorz') or
+                                            check_ping_sensors.password_sensorz)
+                   for sensor in select_sensors(check_ping_sensors.sensors_file_path, self.selector)}
+        pool = get_transport()
+        # Keep one warm transport per sensor between probes instead of evicting and reconnecting.
+        pool.max_connections = max(pool.max_connections, len(sensors))
+        longest = max(check.interval for check in self.checks.values()) * (1 + self.jitter)
+        pool.idle_timeout = max(pool.idle_timeout, 2 * longest)
+        # Probes run outside the fleet engine, so their output is charged to the link classes from here.
+        for sensor in sensors.values():
+            get_link_throttle().register(sensor)
+        with self._condition:
+            removed = set(self.sensors) - set(sensors)
+            added = set(sensors) - set(self.sensors)
+            self.sensors = sensors
+            for key in removed:
+                for check in self.checks:
+                    self._due.pop((key, check), None)
+            now = time.time()
+            for key in added:
+                for name, check in self.checks.items():
+                    self._schedule(key, name, now + random.uniform(0, check.interval))
+        self.state.forget(removed)
+        logging.info(f"Monitoring {len(sensors)} sensors ({len(added)} added, {len(removed)} removed) "
+                     f"with checks {', '.join(self.checks)}")
+        return len(sensors)
+
+    def trigger(self, checks: list = None, selector: str = None) -> int:
+        """Run checks now on all or the selected sensors; returns the number of sensors."""
+        unknown = set(checks or []) - set(self.checks)
+        if unknown:
+            raise ValueError(f"Unknown checks: {', '.join(sorted(unknown))}")
+        with self._condition:
+            sensors = list(self.sensors.values())
+        if selector:
+            sensors = Inventory(sensors).select(selector)
+        now = time.time()
+        with self._condition:
+            for sensor in sensors:
+                for check in checks or self.checks:
+                    self._schedule(sensor_key(sensor), check, now)
+        return len(sensors)
+
+    def _probe(self, key: str, check_name: str) -> None:
+        check = self.checks[check_name]
+        sensor = self.sensors.get(key)
+        started = time.perf_counter()
+        try:
+            if sensor is None:
+                return
+            try:
+                result = check.run(sensor)
+            except Exception as e:
+                get_negative_cache().record_failure(sensor, str(e))
+                self.state.record(key, check_name, 'Error', time.perf_counter() - started, error=str(e))
+                return
+            passed = check.passed(result)
+            # A failed check must not clear the failures it recorded; failed pings are recorded by ping_probe.
+            if passed:
+                get_negative_cache().record_success(sensor)
+            if check.record:
+                check.record(sensor, result)
+            self.state.record(key, check_name, 'Pass' if passed else 'Fail', time.perf_counter() - started, result)
+        finally:
+            with self._condition:
+                self._running.discard((key, check_name))
+                if key in self.sensors:
+                    rerun = (key, check_name) in self._rerun
+                    self._rerun.discard((key, check_name))
+                    self._schedule(key, check_name, time.time() if rerun else self.next_run(check_name))
+
+    def run_forever(self) -> None:
+        """Dispatch due checks until stop() is called."""
+        while not self._stopped.is_set():
+            with self._condition:
+                while not self._stopped.is_set() and (not self._queue or self._queue[0][0] > time.time()):
+                    self._condition.wait(self._queue[0][0] - time.time() if self._queue else None)
+                if self._stopped.is_set():
+                    break
+                due, _, key, check = heapq.heappop(self._queue)
+                if self._due.get((key, check)) != due or key not in self.sensors:
+                    continue
+                backoff = get_negative_cache().entry(self.sensors[key])
+                if backoff and backoff['retry_at'] > time.time():
+                    # Backing off after repeated failures: the next run waits for the sensor's retry time.
+                    self._schedule(key, check, max(self.next_run(check), backoff['retry_at']))
+                    continue
+                if (key, check) in self._running:
+                    # Triggered while still running: run once more as soon as the current run finishes.
+                    self._rerun.add((key, check))
+                    continue
+                self._running.add((key, check))
+            self.executor.submit(self._probe, key, check)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class MonitorRequestHandler(http.server.BaseHTTPRequestHandler):
+    """JSON API of the daemon; serve_api sets the monitor attribute on a subclass."""
+
+    monitor = None
+
+    def _reply(self, code: int, payload) -> None:
+        body = json.dumps(payload, default=str).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/status':
+            self._reply(200, dict(self.monitor.state.status(), checks_configured={
+                name: check.interval for name, check in self.monitor.checks.items()}))
+        elif url.path.startswith('/sensors/'):
+            hostname = urllib.parse.unquote(url.path[len('/sensors/'):])
+            if hostname not in self.monitor.sensors:
+                self._reply(404, {'error': f"Unknown sensor {hostname}"})
+            else:
+                self._reply(200, self.monitor.state.sensor(hostname))
+        else:
+            self._reply(404, {'error': f"Unknown path {url.path}"})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            if url.path == '/trigger':
+                checks = [check for value in query.get('check', []) for check in value.split(',') if check]
+                sensors = self.monitor.trigger(checks or None, query.get('select', [None])[0])
+                self._reply(202, {'triggered': sensors})
+            elif url.path == '/reload':
+                self._reply(200, {'sensors': self.monitor.load_inventory()})
+            else:
+                self._reply(404, {'error': f"Unknown path {url.path}"})
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        logging.debug(f"API: {format % args}")
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            request, _ = super().get_request()
+            # BaseHTTPRequestHandler expects a (host, port) client address.
+            return request, ('local', 0)
+
+
+def serve_api(monitor: MonitorDaemon):
+    """Start the API server on a background thread and return it."""
+    handler = type('BoundMonitorRequestHandler', (MonitorRequestHandler,), {'monitor': monitor})
+    socket_path = os.getenv('MONITOR_SOCKET')
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, handler)
+        logging.info(f"Monitor API listening on {socket_path}")
+    else:
+        host, _, port = os.getenv('MONITOR_HTTP_ADDRESS', '127.0.0.1:8765').rpartition(':')
+        server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+        logging.info(f"Monitor API listening on http://{host or '127.0.0.1'}:{server.server_address[1]}")
+    threading.Thread(target=server.serve_forever, name='monitor-api', daemon=True).start()
+    return server
+
+
+def run_daemon(selector: str = None) -> None:
+    """Run the monitor until SIGINT/SIGTERM; SIGHUP reloads the inventory."""
+    monitor = MonitorDaemon(build_checks(), selector)
+    store = get_state_store()
+    store.start_run('monitor')
+    monitor.load_inventory()
+    server = serve_api(monitor)
+
+    def shutdown(signum, frame):
+        logging.info("Stopping monitor")
+        monitor.stop()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=monitor.load_inventory).start())
+    try:
+        monitor.run_forever()
+    finally:
+        server.shutdown()
+        server.server_close()
+        store.finish_run()
+        get_negative_cache().save()
+
+
+if __name__ == '__main__':
+    run_daemon()
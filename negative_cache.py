@@ -0,0 +1,99 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from state_files import load_json_state, save_json_state
+
+
+def sensor_key(sensor: dict) -> str:
+    return sensor.get('hostname') or sensor['ip_address_sensor']
+
+
+class NegativeCache:
+    """Persistent circuit breaker for sensors that keep failing.
+
+    Each consecutive failure doubles the sensor's backoff (from base_backoff up to max_backoff). While a
+    sensor is backing off it only gets the cheap pre-flight probe; once the backoff expires it gets one
+    full attempt, and any success clears its record.
+    """
+
+    def __init__(self, path: str = None, base_backoff: float = None, max_backoff: float = None):
+        self.path = path or os.getenv('NEGATIVE_CACHE_PATH', 'state/negative_cache.json')
+        self.base_backoff = base_backoff or float(os.getenv('NEGATIVE_CACHE_BASE_BACKOFF', '900'))
+        self.max_backoff = max_backoff or float(os.getenv('NEGATIVE_CACHE_MAX_BACKOFF', str(24 * 3600)))
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._entries = load_json_state(self.path)
+
+    def save(self) -> None:
+        with self._lock:
+            entries = dict(self._entries)
+        with self._save_lock:
+            save_json_state(self.path, entries)
+
+    def entry(self, sensor: dict) -> dict:
+        with self._lock:
+            return self._entries.get(sensor_key(sensor))
+
+    def in_backoff(self, sensor: dict) -> bool:
+        entry = self.entry(sensor)
+        return bool(entry) and time.time() < entry['retry_at']
+
+    def record_failure(self, sensor: dict, reason: str, save: bool = True) -> None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(sensor_key(sensor), {'failures': 0})
+            failures = entry['failures'] + 1
+            backoff = min(self.base_backoff * 2 ** (failures - 1), self.max_backoff)
+            self._entries[sensor_key(sensor)] = {
+                'failures': failures,
+                'last_failure': now,
+                'retry_at': now + backoff,
+                'last_state': reason,
+                'ip_address': sensor['ip_address_sensor'],
+            }
+        logging.info(f"{sensor_key(sensor)}: failure #{failures}, backing off for {backoff:.0f}s")
+        if save:
+            self.save()
+
+    def record_probe(self, sensor: dict, state: str, save: bool = True) -> None:
+        """Update the last-known state of a backing-off sensor without touching its backoff."""
+        with self._lock:
+            entry = self._entries.get(sensor_key(sensor))
+            if entry:
+                entry['last_state'] = state
+        if save:
+            self.save()
+
+    def record_success(self, sensor: dict) -> None:
+        with self._lock:
+            cleared = self._entries.pop(sensor_key(sensor), None)
+        if cleared:
+            logging.info(f"{sensor_key(sensor)}: reachable again, clearing {cleared['failures']} recorded failures")
+            self.save()
+
+    def skipped_entry(self, sensor: dict) -> dict:
+        """Describe a skipped sensor for the reports, with its last-known state."""
+        entry = self.entry(sensor) or {}
+        retry_at = datetime.fromtimestamp(entry.get('retry_at', time.time())).strftime('%Y-%m-%d %H:%M:%S')
+        return {
+            'hostname': sensor.get('hostname', 'Unknown hostname'),
+            'original_ip': sensor['ip_address_sensor'],
+            'updated_ip': entry.get('ip_address', sensor['ip_address_sensor']),
+            'reason': f"Skipped after {entry.get('failures', 0)} consecutive failures, next attempt after {retry_at}",
+            'last_state': entry.get('last_state', 'Unknown'),
+        }
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_negative_cache() -> NegativeCache:
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = NegativeCache()
+        return _shared_cache
@@ -0,0 +1,172 @@
+"""Bounded capture of remote command output with a content-addressed spill store.
+
+Outputs up to OUTPUT_HEAD_BYTES + OUTPUT_TAIL_BYTES are kept as they are. Larger outputs keep only their
+head and tail in memory and in the reports; the full output streams to a gzip file named after its
+sha256 under OUTPUT_STORE_DIR, and the truncated text points at it as output:<sha256>.
+
+With OUTPUT_COMPRESSION=1 the sensor gzips a command's stdout before sending it and the controller
+inflates it as it arrives.
+"""
+import gzip
+import hashlib
+import os
+import shlex
+import threading
+import uuid
+import zlib
+
+from link_throttle import get_link_throttle
+from ssh_pool import FullCapture
+from ssh_transport import get_transport
+
+REFERENCE_PREFIX = 'output:'
+
+
+def compression_enabled() -> bool:
+    return os.getenv('OUTPUT_COMPRESSION', '').lower() in ('1', 'true', 'yes')
+
+
+class OutputStore:
+    """gzip files keyed by the sha256 of their uncompressed content; identical outputs are stored once."""
+
+    def __init__(self, directory: str = None):
+        self.directory = directory or os.getenv('OUTPUT_STORE_DIR', 'state/outputs')
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], f"{digest}.gz")
+
+    def open_spill(self) -> tuple:
+        """Return (temporary path, gzip file) for an output whose digest is not known yet."""
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = os.path.join(self.directory, f"spill-{uuid.uuid4().hex}.tmp")
+        return temp_path, gzip.open(temp_path, 'wb', compresslevel=6)
+
+    def commit_spill(self, spill: tuple, digest: str) -> str:
+        temp_path, file = spill
+        file.close()
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        return path
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self.path(digest)):
+            spill = self.open_spill()
+            spill[1].write(data)
+            self.commit_spill(spill, digest)
+        return digest
+
+    def intern(self, text: str) -> str:
+        """Store a text once and return its output:<sha256> reference."""
+        return REFERENCE_PREFIX + self.put(text.encode(errors='replace'))
+
+    def get(self, digest: str) -> bytes:
+        """Return a stored output by digest or by an output:<digest> reference."""
+        digest = digest[len(REFERENCE_PREFIX):] if digest.startswith(REFERENCE_PREFIX) else digest
+        with gzip.open(self.path(digest), 'rb') as file:
+            return file.read()
+
+
+class BoundedCapture:
+    """Capture one output stream in bounded memory.
+
+    Everything is buffered until the stream outgrows head_bytes + tail_bytes; from then on the stream goes
+    to the spill store and only the head and a rolling tail are kept.
+    """
+
+    def __init__(self, head_bytes: int = None, tail_bytes: int = None, store: OutputStore = None):
+        self.head_bytes = int(os.getenv('OUTPUT_HEAD_BYTES', '8192')) if head_bytes is None else head_bytes
+        self.tail_bytes = int(os.getenv('OUTPUT_TAIL_BYTES', '8192')) if tail_bytes is None else tail_bytes
+        self.store = store or get_output_store()
+        self.total = 0
+        self.digest = None
+        self._hash = hashlib.sha256()
+        self._buffer = bytearray()
+        self._head = b''
+        self._spill = None
+
+    def write(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        self.total += len(chunk)
+        self._hash.update(chunk)
+        self._buffer += chunk
+        if self._spill is None:
+            if len(self._buffer) <= self.head_bytes + self.tail_bytes:
+                return
+            self._spill = self.store.open_spill()
+            self._spill[1].write(self._buffer)
+            self._head = bytes(self._buffer[:self.head_bytes])
+        else:
+            self._spill[1].write(chunk)
+        del self._buffer[:max(0, len(self._buffer) - self.tail_bytes)]
+
+    @property
+    def truncated(self) -> bool:
+        return self._spill is not None
+
+    def finish(self) -> str:
+        if self._spill is None:
+            return self._buffer.decode(errors='replace')
+        self.digest = self._hash.hexdigest()
+        self.store.commit_spill(self._spill, self.digest)
+        omitted = self.total - len(self._head) - len(self._buffer)
+        return (f"{self._head.decode(errors='replace')}\n"
+                f"... [{omitted} bytes omitted, full output: {REFERENCE_PREFIX}{self.digest}] ...\n"
+                f"{self._buffer.decode(errors='replace')}")
+
+
+class GunzipCapture:
+    """Inflate a gzip stream on the fly into another capture."""
+
+    def __init__(self, capture):
+        self.capture = capture
+        self._inflater = zlib.decompressobj(wbits=31)
+
+    def write(self, chunk: bytes) -> None:
+        self.capture.write(self._inflater.decompress(chunk))
+
+    def finish(self) -> str:
+        self.capture.write(self._inflater.flush())
+        return self.capture.finish()
+
+
+def gzip_remote_stdout(command: str) -> str:
+    """Wrap a command so the sensor gzips its stdout while the command's exit status is preserved."""
+    return (f'out=$(mktemp) || exit 1; sh -c {shlex.quote(command)} > "$out"; status=$?; '
+            f'gzip -1c < "$out"; rm -f "$out"; exit $status')
+
+
+def capture_command(ip_address_sensor: str, username_sensorz: str, password_sensorz: str, command: str,
+                    timeout: float = None, stdin_data: bytes = None, bounded: bool = True,
+                    compress: bool = None) -> tuple:
+    """Run a command over the pool and return (exit_status, stdout, stderr) with bounded, spilled outputs.
+
+    bounded=False keeps stdout whole, for outputs that are parsed rather than shown. compress defaults
+    to OUTPUT_COMPRESSION. The bytes read are charged to the sensor's link class budget (link_throttle).
+    """
+    compress = compression_enabled() if compress is None else compress
+    stdout_capture = BoundedCapture() if bounded else FullCapture()
+    if compress:
+        command, stdout_capture = gzip_remote_stdout(command), GunzipCapture(stdout_capture)
+    throttle = get_link_throttle()
+    return get_transport().exec_command(ip_address_sensor, username_sensorz, password_sensorz, command,
+                                        timeout=timeout, stdin_data=stdin_data,
+                                        stdout_capture=throttle.throttled(ip_address_sensor, stdout_capture),
+                                        stderr_capture=throttle.throttled(ip_address_sensor, BoundedCapture()))
+
+
+_shared_store = None
+_shared_store_lock = threading.Lock()
+
+
+def get_output_store() -> OutputStore:
+    global _shared_store
+    with _shared_store_lock:
+        if _shared_store is None:
+            _shared_store = OutputStore()
+        return _shared_store
@@ -0,0 +1,102 @@
+"""Grouping of identical outputs across sensors for the reports.
+
+Most sensors return the same output for the same test. OutputGroups counts the sensors behind every
+distinct output of a test and interns each shared output once in the output store, so the reports can
+say "412 sensors: output A, 3 sensors: output B (listed)" and let per-sensor sections point at the
+shared output instead of repeating it. Tests whose sensors disagree are listed first.
+
+Only outputs of at least OUTPUT_GROUP_MIN_BYTES are interned and replaced by a reference; shorter ones,
+such as version strings, cost less than the reference would.
+"""
+import hashlib
+import os
+import re
+
+import yaml
+
+from output_capture import get_output_store
+
+# Round-trip times vary between otherwise identical ping outputs; everything else (loss, ttl) is kept.
+PING_TIMINGS = re.compile(r'(time[=<]|time |= )[\d./]+')
+
+
+def mask_ping_timings(output: str) -> str:
+    return PING_TIMINGS.sub(r'\1#', output)
+
+
+class OutputGroups:
+    """Sensors per distinct output, per test key.
+
+    With normalize, outputs that normalize to the same text share a group, represented by the first
+    output seen.
+    """
+
+    def __init__(self, normalize=None, min_sensors: int = None, limit: int = None, store=None,
+                 min_bytes: int = None):
+        self.normalize = normalize
+        self.min_sensors = min_sensors or int(os.getenv('OUTPUT_GROUP_MIN_SENSORS', '2'))
+        self.min_bytes = min_bytes or int(os.getenv('OUTPUT_GROUP_MIN_BYTES', '256'))
+        self.limit = limit or int(os.getenv('OUTPUT_GROUP_LIMIT', '20'))
+        self.store = store or get_output_store()
+        self._groups = {}
+
+    def _digest(self, output: str) -> str:
+        text = self.normalize(output) if self.normalize else output
+        return hashlib.sha256(text.encode(errors='replace')).hexdigest()
+
+    def _referenced(self, output: str) -> bool:
+        return len(output.encode(errors='replace')) >= self.min_bytes
+
+    def _reference(self, group: dict) -> str:
+        if 'reference' not in group:
+            group['reference'] = self.store.intern(group['output'])
+        return group['reference']
+
+    def add(self, key: str, hostname: str, output, status: str = None) -> None:
+        output = '' if output is None else str(output)
+        group = self._groups.setdefault(key, {}).setdefault(
+            self._digest(output), {'output': output, 'sensors': [], 'statuses': {}})
+        group['sensors'].append(hostname)
+        group['statuses'][status] = group['statuses'].get(status, 0) + 1
+
+    def compact(self, key: str, output) -> str:
+        """Return the output, or a reference to it if it is long and at least min_sensors sensors share it."""
+        output = '' if output is None else str(output)
+        if not self._referenced(output):
+            return output
+        group = self._groups.get(key, {}).get(self._digest(output))
+        if not group or len(group['sensors']) < self.min_sensors:
+            return output
+        return f"[same output on {len(group['sensors'])} sensors, see output groups: {self._reference(group)}]"
+
+    def summary(self) -> list:
+        """Distinct outputs per key by descending sensor count, keys whose sensors disagree most first.
+
+        The sensors of the most common output are only counted when it is shared; those of every other
+        output are listed. Outputs beyond `limit` per key are folded into one 'other outputs' entry.
+        """
+        summary = []
+        for key, groups in self._groups.items():
+            ordered = sorted(groups.values(), key=lambda group: -len(group['sensors']))
+            outputs = []
+            for index, group in enumerate(ordered[:self.limit]):
+                entry = {'sensors': len(group['sensors']), 'statuses': dict(group['statuses'])}
+                if self._referenced(group['output']):
+                    entry['reference'] = self._reference(group)
+                entry['output'] = group['output']
+                if index or len(group['sensors']) < self.min_sensors:
+                    entry['hostnames'] = sorted(group['sensors'])
+                outputs.append(entry)
+            if len(ordered) > self.limit:
+                outputs.append({'other_outputs': len(ordered) - self.limit,
+                                'sensors': sum(len(group['sensors']) for group in ordered[self.limit:])})
+            total = sum(len(group['sensors']) for group in ordered)
+            summary.append({'test': key, 'sensors': total, 'distinct_outputs': len(ordered),
+                            'differing_sensors': total - len(ordered[0]['sensors']), 'outputs': outputs})
+        summary.sort(key=lambda item: (-item['differing_sensors'], item['test']))
+        return summary
+
+    def write_yaml(self, report_path: str) -> str:
+        with open(report_path, 'w') as report:
+            yaml.safe_dump({'Output groups': self.summary()}, report, sort_keys=False)
+        return report_path
@@ -0,0 +1,212 @@
+"""Controller-side package cache that pushes packages to sensors instead of letting each sensor download them.
+
+The repository holds the packages a tool needs (the tool and its dependencies) per platform:
+
+    <repository>/<distro>-<version>/<arch>/<tool>/*.deb|*.rpm
+
+PACKAGE_REPOSITORY is either a local directory in that layout or an http(s) base URL with an index.json
+({tool: [file names]}) in every <distro>-<version>/<arch> directory. It can be filled with
+`apt-get download` / `yumdownloader --resolve` on a machine of the same platform.
+
+Packages are fetched into the cache once per platform, gzip-compressed, and pushed over SFTP only to
+sensors that do not already hold a copy with the right checksum. They are then installed offline.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shlex
+import shutil
+import threading
+import urllib.error
+import urllib.request
+
+from link_throttle import get_link_throttle
+from ssh_transport import get_transport
+from state_store import get_state_store
+from tracing import span
+
+PACKAGE_TYPES = {'apt': 'deb', 'yum': 'rpm'}
+
+OFFLINE_INSTALL_COMMANDS = {
+    'deb': 'sudo DEBIAN_FRONTEND=noninteractive dpkg -i',
+    'rpm': 'sudo rpm -Uvh --replacepkgs',
+}
+
+PLATFORM_PROBE = ('. /etc/os-release 2>/dev/null; echo "distro=${ID:-unknown}-${VERSION_ID:-unknown}"; '
+                  'echo "arch=$(dpkg --print-architecture 2>/dev/null || uname -m)"')
+
+
+def distribution_mode() -> str:
+    """'sftp' pushes cached packages to the sensors; anything else lets the sensors use their package manager."""
+    return os.getenv('PACKAGE_DISTRIBUTION', 'apt')
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PackageCache:
+    """Per-platform package cache on the controller. Each tool is fetched from the repository at most once."""
+
+    def __init__(self, directory: str = None, repository: str = None):
+        self.directory = directory or os.getenv('PACKAGE_CACHE_DIR', 'state/packages')
+        self.repository = repository if repository is not None else os.getenv('PACKAGE_REPOSITORY', '')
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+        self._unavailable = set()
+
+    def _fetch_lock(self, key: tuple) -> threading.Lock:
+        with self._lock:
+            return self._fetch_locks.setdefault(key, threading.Lock())
+
+    def _repository_files(self, platform: str, tool: str) -> list:
+        if self.repository.startswith(('http://', 'https://')):
+            with urllib.request.urlopen(f"{self.repository.rstrip('/')}/{platform}/index.json", timeout=60) as index:
+                return json.load(index).get(tool, [])
+        tool_directory = os.path.join(self.repository, platform, tool)
+        return sorted(os.listdir(tool_directory)) if os.path.isdir(tool_directory) else []
+
+    def _download(self, platform: str, tool: str, name: str, destination: str) -> None:
+        if self.repository.startswith(('http://', 'https://')):
+            with urllib.request.urlopen(f"{self.repository.rstrip('/')}/{platform}/{tool}/{name}",
+                                        timeout=300) as response, open(destination, 'wb') as file:
+                shutil.copyfileobj(response, file)
+        else:
+            shutil.copyfile(os.path.join(self.repository, platform, tool, name), destination)
+
+    def packages(self, platform: str, tool: str, package_type: str) -> list:
+        """Return the cached packages of a tool as [{'name', 'sha256', 'path'}] with path to the .gz copy.
+
+        Fetches and compresses them on first use. An empty list means the repository has nothing for it.
+        """
+        tool_directory = os.path.join(self.directory, platform, tool)
+        manifest_path = os.path.join(tool_directory, 'manifest.json')
+        with self._fetch_lock((platform, tool)):
+            if (platform, tool) in self._unavailable:
+                return []
+            if not os.path.exists(manifest_path):
+                self._fetch(platform, tool, tool_directory, manifest_path)
+            if not os.path.exists(manifest_path):
+                # Not in the repository; remembered for this run so every sensor does not ask again.
+                self._unavailable.add((platform, tool))
+                return []
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+        return [dict(entry, path=os.path.join(tool_directory, entry['name'] + '.gz'))
+                for entry in manifest if entry['name'].endswith('.' + package_type)]
+
+    def _fetch(self, platform: str, tool: str, tool_directory: str, manifest_path: str) -> None:
+        """Fetch and compress a tool's packages and write its manifest; on any failure leave nothing behind."""
+        try:
+            self._fetch_packages(platform, tool, tool_directory, manifest_path)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            # Without a manifest the tool is marked unavailable and goes through the sensor's package manager.
+            logging.error(f"Could not fetch the packages for {tool} on {platform} from {self.repository!r}: {e}")
+            shutil.rmtree(tool_directory, ignore_errors=True)
+
+    def _fetch_packages(self, platform: str, tool: str, tool_directory: str, manifest_path: str) -> None:
+        names = [name for name in self._repository_files(platform, tool) if name.endswith(('.deb', '.rpm'))]
+        if not names:
+            logging.warning(f"No packages for {tool} on {platform} in repository {self.repository!r}")
+            return
+        os.makedirs(tool_directory, exist_ok=True)
+        manifest = []
+        with span('package_fetch', platform):
+            for name in names:
+                raw_path = os.path.join(tool_directory, name)
+                self._download(platform, tool, name, raw_path)
+                manifest.append({'name': name, 'sha256': file_sha256(raw_path), 'size': os.path.getsize(raw_path)})
+                with open(raw_path, 'rb') as raw, gzip.open(raw_path + '.gz', 'wb') as compressed:
+                    shutil.copyfileobj(raw, compressed)
+                os.remove(raw_path)
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        logging.info(f"Cached {len(manifest)} packages for {tool} on {platform}")
+
+
+def sensor_platform(ip_address_sensor: str, username_sensorz: str, password_sensorz: str) -> str:
+    """Return the sensor's '<distro>-<version>/<arch>' platform key."""
+    _, stdout, _ = get_transport().exec_command(ip_address_sensor, username_sensorz, password_sensorz,
+                                               PLATFORM_PROBE, timeout=30)
+    values = dict(line.split('=', 1) for line in stdout.splitlines() if '=' in line)
+    return f"{values.get('distro', 'unknown')}/{values.get('arch', 'unknown')}"
+
+
+def remote_checksums(ip_address_sensor: str, username_sensorz: str, password_sensorz: str,
+                     remote_directory: str) -> dict:
+    """Return {file name: sha256} of the packages already staged on the sensor."""
+    directory = shlex.quote(remote_directory)
+    _, stdout, _ = get_transport().exec_command(
+        ip_address_sensor, username_sensorz, password_sensorz,
+        f"mkdir -p {directory} && cd {directory} && sha256sum -- *.deb *.rpm 2>/dev/null", timeout=60)
+    checksums = {}
+    for line in stdout.splitlines():
+        checksum, _, name = line.partition('  ')
+        if name:
+            checksums[name.lstrip('*')] = checksum
+    return checksums
+
+
+def stage_packages(ip_address_sensor: str, username_sensorz: str, password_sensorz: str, package_manager: str,
+                   tools: list, sensor: dict = None, cache: PackageCache = None) -> tuple:
+    """Push the cached packages the tools need to the sensor and build the offline install command.
+
+    Only packages the sensor does not already hold with a matching checksum are uploaded, gzip-compressed.
+    Returns (install_command, uncached_tools); install_command is empty when nothing is cached for the
+    tools, and uncached_tools are left to the sensor's own package manager.
+    """
+    package_type = PACKAGE_TYPES.get(package_manager)
+    if not package_type:
+        return '', list(tools)
+    cache = cache or get_package_cache()
+    remote_directory = os.getenv('PACKAGE_REMOTE_DIR', '.sensorz-packages')
+    store = get_state_store()
+    sensor = sensor or {'ip_address_sensor': ip_address_sensor}
+    platform = store.get(sensor, 'platform') or sensor_platform(ip_address_sensor, username_sensorz, password_sensorz)
+    store.set(sensor, 'platform', platform)
+
+    packages, uncached_tools = {}, []
+    for tool in tools:
+        tool_packages = cache.packages(platform, tool, package_type)
+        if not tool_packages:
+            uncached_tools.append(tool)
+        packages.update((package['name'], package) for package in tool_packages)
+    if not packages:
+        return '', uncached_tools
+
+    staged = remote_checksums(ip_address_sensor, username_sensorz, password_sensorz, remote_directory)
+    missing = [package for name, package in sorted(packages.items()) if staged.get(name) != package['sha256']]
+    if missing:
+        with span('package_push', ip_address_sensor), \
+                get_transport().sftp(ip_address_sensor, username_sensorz, password_sensorz) as sftp:
+            for package in missing:
+                sftp.put(package['path'], f"{remote_directory}/{package['name']}.gz",
+                         callback=get_link_throttle().transfer_callback(ip_address_sensor))
+        logging.info(f"Pushed {len(missing)} of {len(packages)} packages to {ip_address_sensor}")
+
+    directory = shlex.quote(remote_directory)
+    names = ' '.join(shlex.quote(name) for name in sorted(packages))
+    checksum_lines = ''.join(f"{package['sha256']}  {name}\\n" for name, package in sorted(packages.items()))
+    unpack = f"gzip -df {' '.join(shlex.quote(package['name'] + '.gz') for package in missing)} && " if missing else ''
+    install_command = (f"cd {directory} && {unpack}printf {shlex.quote(checksum_lines)} | sha256sum -c --quiet - && "
+                       f"{OFFLINE_INSTALL_COMMANDS[package_type]} {names}")
+    return install_command, uncached_tools
+
+
+_shared_package_cache = None
+_shared_package_cache_lock = threading.Lock()
+
+
+def get_package_cache() -> PackageCache:
+    global _shared_package_cache
+    with _shared_package_cache_lock:
+        if _shared_package_cache is None:
+            _shared_package_cache = PackageCache()
+        return _shared_package_cache
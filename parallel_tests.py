@@ -0,0 +1,26 @@
+import concurrent.futures
+
+
+def run_in_parallel(run_test, tests: list, max_channels: int) -> list:
+    """Run run_test(test) for every test on up to max_channels concurrent channels.
+
+    Tests marked "exclusive" (e.g. stress) wait for the running ones to finish and then run alone.
+    Results are returned in the original test order.
+    """
+    results = [None] * len(tests)
+    in_flight = []
+
+    def drain():
+        for index, future in in_flight:
+            results[index] = future.result()
+        in_flight.clear()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_channels) as executor:
+        for index, test in enumerate(tests):
+            if test.get('exclusive'):
+                drain()
+                results[index] = run_test(test)
+            else:
+                in_flight.append((index, executor.submit(run_test, test)))
+        drain()
+    return results
@@ -0,0 +1,217 @@
+"""Ping output parsing and fleet-wide latency statistics on columnar NumPy arrays.
+
+Each run is kept as one .npz file of per-sensor columns (loss, rtt min/avg/max/mdev) plus every packet's
+round-trip time in a flat array indexed by per-sensor offsets, so fleet, per-tag and cross-run statistics
+are array operations rather than loops over result dicts.
+"""
+import glob
+import logging
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+
+from inventory import parse_tags
+
+PACKETS_LINE = re.compile(r'(\d+) packets transmitted, (\d+) (?:packets )?received')
+LOSS = re.compile(r'([\d.]+)% packet loss')
+RTT_SUMMARY = re.compile(r'(?:rtt|round-trip) min/avg/max(?:/(?:mdev|stddev))? = ([\d./]+) ms')
+# iputils prints icmp_seq=N, busybox seq=N.
+PACKET_TIME = re.compile(r'(?:icmp_)?seq=\d+ .*?time[=<]([\d.]+) ?ms')
+
+PERCENTILES = (50, 90, 95, 99)
+# Upper edges (ms) of the latency histogram buckets in the reports.
+HISTOGRAM_EDGES_MS = (0, 10, 20, 50, 100, 200, 500, 1000, np.inf)
+
+
+def parse_ping_output(output: str) -> dict:
+    """Parse iputils or busybox ping output into loss, rtt summary and per-packet times (ms).
+
+    Missing values are None; a ping that never ran has transmitted 0.
+    """
+    packets = PACKETS_LINE.search(output or '')
+    loss = LOSS.search(output or '')
+    rtt = RTT_SUMMARY.search(output or '')
+    rtt_values = [float(value) for value in rtt.group(1).split('/')] if rtt else []
+    rtt_values += [None] * (4 - len(rtt_values))
+    return {
+        'transmitted': int(packets.group(1)) if packets else 0,
+        'received': int(packets.group(2)) if packets else 0,
+        'loss_pct': float(loss.group(1)) if loss else None,
+        'rtt_min': rtt_values[0],
+        'rtt_avg': rtt_values[1],
+        'rtt_max': rtt_values[2],
+        'rtt_mdev': rtt_values[3],
+        'times': [float(time) for time in PACKET_TIME.findall(output or '')],
+    }
+
+
+def ping_passed(metrics: dict) -> bool:
+    return metrics['transmitted'] > 0 and metrics['received'] == metrics['transmitted']
+
+
+class PingRun:
+    """Columnar ping metrics of one run."""
+
+    RTT_COLUMNS = ('rtt_min', 'rtt_avg', 'rtt_max', 'rtt_mdev')
+
+    def __init__(self, hostnames, loss, rtt, times, offsets, timestamp: float = None):
+        self.hostnames = np.asarray(hostnames, dtype=str)
+        self.loss = np.asarray(loss, dtype=np.float32)
+        self.rtt = np.asarray(rtt, dtype=np.float32).reshape(-1, 4)
+        self.times = np.asarray(times, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.timestamp = timestamp if timestamp is not None else datetime.now().timestamp()
+
+    @classmethod
+    def from_results(cls, results) -> 'PingRun':
+        """Build a run from ping results carrying a 'metrics' dict, e.g. the records of a ping result stream.
+
+        Results reused from an earlier run (marked 'cached') are skipped so the history never counts them twice.
+        """
+        hostnames, loss, rtt, times, offsets = [], [], [], [], [0]
+        for result in results:
+            metrics = result.get('metrics')
+            if not metrics or result.get('cached'):
+                continue
+            hostnames.append(result.get('hostname', 'Unknown'))
+            loss.append(np.nan if metrics['loss_pct'] is None else metrics['loss_pct'])
+            rtt.append([np.nan if metrics[column] is None else metrics[column] for column in cls.RTT_COLUMNS])
+            times.extend(metrics['times'])
+            offsets.append(len(times))
+        return cls(hostnames, loss, np.array(rtt, dtype=np.float32).reshape(-1, 4), times, offsets)
+
+    def __len__(self):
+        return len(self.hostnames)
+
+    @property
+    def rtt_avg(self) -> np.ndarray:
+        return self.rtt[:, 1]
+
+    def save(self, directory: str = None) -> str:
+        directory = directory or os.getenv('PING_METRICS_DIRECTORY', 'state/ping_metrics')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"ping_{datetime.fromtimestamp(self.timestamp):%Y-%m-%d_%H-%M-%S}.npz")
+        np.savez_compressed(path, hostnames=self.hostnames, loss=self.loss, rtt=self.rtt, times=self.times,
+                            offsets=self.offsets, timestamp=np.float64(self.timestamp))
+        return path
+
+    @classmethod
+    def load(cls, path: str) -> 'PingRun':
+        with np.load(path) as data:
+            return cls(data['hostnames'], data['loss'], data['rtt'], data['times'], data['offsets'],
+                       float(data['timestamp']))
+
+
+def load_history(directory: str = None, limit: int = None) -> list:
+    """Load the saved runs, oldest first, keeping at most the latest `limit`."""
+    directory = directory or os.getenv('PING_METRICS_DIRECTORY', 'state/ping_metrics')
+    paths = sorted(glob.glob(os.path.join(directory, 'ping_*.npz')))
+    if limit:
+        paths = paths[-limit:]
+    return [PingRun.load(path) for path in paths]
+
+
+def distribution(values: np.ndarray) -> dict:
+    """Percentiles, mean and count of the non-NaN values, rounded for the reports."""
+    values = values[~np.isnan(values)]
+    if not values.size:
+        return {'count': 0}
+    summary = {'count': int(values.size), 'mean': round(float(values.mean()), 3)}
+    summary.update({f"p{p}": round(float(v), 3) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))})
+    return summary
+
+
+def latency_histogram(times: np.ndarray) -> dict:
+    counts, _ = np.histogram(times, bins=np.asarray(HISTOGRAM_EDGES_MS))
+    labels = [f"<{int(edge)}ms" for edge in HISTOGRAM_EDGES_MS[1:-1]] + [f">={int(HISTOGRAM_EDGES_MS[-2])}ms"]
+    return dict(zip(labels, counts.tolist()))
+
+
+def tag_summaries(run: PingRun, tags_of=None) -> dict:
+    """Per-tag distribution of average rtt and loss; tags default to those parsed from the hostnames."""
+    tags_of = tags_of or (lambda hostname: parse_tags({'hostname': hostname}))
+    members = {}
+    for index, hostname in enumerate(run.hostnames):
+        for tag in tags_of(str(hostname)):
+            members.setdefault(tag, []).append(index)
+    summaries = {}
+    for tag, indexes in sorted(members.items()):
+        indexes = np.asarray(indexes)
+        summaries[tag] = {'rtt_avg_ms': distribution(run.rtt_avg[indexes]),
+                          'loss_pct': distribution(run.loss[indexes])}
+    return summaries
+
+
+def outliers(run: PingRun, threshold: float = None) -> list:
+    """Sensors whose average rtt is far above the fleet (robust z-score on median/MAD) or that lost packets."""
+    threshold = threshold or float(os.getenv('PING_OUTLIER_THRESHOLD', '3.5'))
+    rtt = run.rtt_avg
+    valid = ~np.isnan(rtt)
+    scores = np.zeros(len(run), dtype=np.float32)
+    if valid.any():
+        median = np.median(rtt[valid])
+        mad = np.median(np.abs(rtt[valid] - median))
+        if mad > 0:
+            scores[valid] = 0.6745 * (rtt[valid] - median) / mad
+    flagged = np.flatnonzero((scores > threshold) | (np.nan_to_num(run.loss, nan=100.0) > 0))
+    flagged = flagged[np.argsort(-scores[flagged], kind='stable')]
+    return [{'hostname': str(run.hostnames[index]),
+             'rtt_avg_ms': None if np.isnan(run.rtt_avg[index]) else round(float(run.rtt_avg[index]), 3),
+             'loss_pct': None if np.isnan(run.loss[index]) else round(float(run.loss[index]), 1),
+             'score': round(float(scores[index]), 2)} for index in flagged]
+
+
+def trends(runs: list, min_runs: int = 3, limit: int = 10) -> dict:
+    """Fleet median rtt per run and the sensors whose average rtt rises fastest across runs (ms per run).
+
+    Runs are aligned by hostname into a runs x sensors matrix; slopes are least-squares fits over each
+    sensor's non-missing runs.
+    """
+    if not runs:
+        return {}
+    hostnames = np.unique(np.concatenate([run.hostnames for run in runs]))
+    matrix = np.full((len(runs), len(hostnames)), np.nan, dtype=np.float64)
+    for row, run in enumerate(runs):
+        matrix[row, np.searchsorted(hostnames, run.hostnames)] = run.rtt_avg
+    valid = ~np.isnan(matrix)
+    counts = valid.sum(axis=0)
+    x = np.where(valid, np.arange(len(runs))[:, None], 0.0)
+    y = np.where(valid, matrix, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = x.sum(axis=0) / counts
+        y_mean = y.sum(axis=0) / counts
+        dx = np.where(valid, x - x_mean, 0.0)
+        slopes = (dx * (y - y_mean)).sum(axis=0) / (dx ** 2).sum(axis=0)
+    slopes[counts < min_runs] = np.nan
+    with np.errstate(all='ignore'):
+        fleet_medians = np.nanmedian(matrix, axis=1) if valid.any() else np.full(len(runs), np.nan)
+    ranked = [index for index in np.argsort(-np.nan_to_num(slopes, nan=-np.inf)) if slopes[index] > 0][:limit]
+    return {
+        'runs': len(runs),
+        'fleet_median_rtt_ms': [None if np.isnan(value) else round(float(value), 3) for value in fleet_medians],
+        'rising': [{'hostname': str(hostnames[index]), 'ms_per_run': round(float(slopes[index]), 3),
+                    'latest_rtt_avg_ms': None if np.isnan(matrix[-1, index]) else round(float(matrix[-1, index]), 3)}
+                   for index in ranked],
+    }
+
+
+def latency_report(run: PingRun, history: list = None) -> dict:
+    """Latency section of the ping report: fleet and per-tag distributions, outliers and trends."""
+    report = {
+        'fleet': {
+            'sensors': len(run),
+            'rtt_avg_ms': distribution(run.rtt_avg),
+            'rtt_max_ms': distribution(run.rtt[:, 2]),
+            'loss_pct': distribution(run.loss),
+            'packet_rtt_ms': distribution(run.times),
+            'packet_rtt_histogram': latency_histogram(run.times),
+        },
+        'by_tag': tag_summaries(run),
+        'outliers': outliers(run),
+    }
+    if history:
+        report['trends'] = trends(history + [run])
+    logging.info(f"Fleet ping latency: {report['fleet']['rtt_avg_ms']}, {len(report['outliers'])} outliers")
+    return report
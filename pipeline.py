@@ -0,0 +1,243 @@
+import concurrent.futures
+import logging
+import os
+import threading
+from contextlib import nullcontext
+from datetime import datetime
+
+import check_ping_sensors
+import detect_package_manager_and_install
+import sensor_tests
+from fleet_engine import run_fleet
+from inventory import select_sensors
+from negative_cache import get_negative_cache, sensor_key
+from reachability import preflight, unreachable_entry
+from result_stream import ResultSink
+from state_store import fingerprint, get_state_store, incremental_mode
+from throughput import run_throughput_stage, write_throughput_reports
+from tool_audit import TOOLS_TO_CHECK, cached_audit
+from tracing import get_tracer, span
+
+STAGES = ['ping', 'tools', 'tests']
+# Stages that only run when asked for.
+OPTIONAL_STAGES = ['throughput']
+
+
+class PipelineProgress:
+    """Log each sensor's stages as they finish, with a running fleet count.
+
+    Stages claim a sensor's result before writing it, so a sensor abandoned as a straggler gets exactly
+    one entry per stage: the result of a stage that made it in time, or a timed out entry otherwise.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.completed = 0
+        self._lock = threading.Lock()
+        self._claimed = {}
+        self._abandoned = set()
+
+    def claim(self, sensor: dict, stage: str) -> bool:
+        """Return True if the stage may write its result, i.e. the sensor has not been abandoned."""
+        with self._lock:
+            if sensor_key(sensor) in self._abandoned:
+                return False
+            self._claimed.setdefault(sensor_key(sensor), set()).add(stage)
+            return True
+
+    def abandon(self, sensor: dict, stages: list) -> list:
+        """Stop accepting results for a sensor and return the stages it never delivered."""
+        with self._lock:
+            self._abandoned.add(sensor_key(sensor))
+            claimed = self._claimed.get(sensor_key(sensor), set())
+        return [stage for stage in stages if stage not in claimed]
+
+    def stage_done(self, sensor: dict, stage: str, outcome: str) -> None:
+        logging.info(f"{sensor.get('hostname', 'Unknown')} ({sensor['ip_address_sensor']}): {stage} - {outcome}")
+
+    def sensor_done(self, sensor: dict) -> None:
+        with self._lock:
+            self.completed += 1
+            completed = self.completed
+        logging.info(f"[{completed}/{self.total}] {sensor.get('hostname', 'Unknown')} finished all stages")
+
+
+def cached_stage_result(sensor: dict, stage: str, tests: dict):
+    """Return what an incremental run can reuse for a stage instead of running it, or None.
+
+    Nothing is reused for a sensor whose inventory entry changed since it was last checked.
+    """
+    store = get_state_store()
+    if not incremental_mode() or store.inventory_changed(sensor):
+        return None
+    if stage == 'ping':
+        return store.get(sensor, 'ping')
+    if stage == 'tools':
+        return cached_audit(sensor, TOOLS_TO_CHECK) if store.is_fresh(sensor, 'upgradable') else None
+    cached = store.get(sensor, 'tests')
+    return cached['result'] if cached and cached['suite'] == fingerprint(tests) else None
+
+
+def run_ping_stage(sensor: dict, ping_sink: ResultSink, progress: PipelineProgress) -> None:
+    result = cached_stage_result(sensor, 'ping', None)
+    if result:
+        if progress.claim(sensor, 'ping'):
+            ping_sink.write({'group': 'Passed', 'result': dict(result, cached=True)})
+            progress.stage_done(sensor, 'ping', 'unchanged since last run')
+        return
+    with span('stage_ping', sensor['ip_address_sensor']):
+        # A sensor that fails on both addresses raises RetryFailed, which on_error reports and records.
+        result = check_ping_sensors.ping_test(sensor)
+    if progress.claim(sensor, 'ping'):
+        get_state_store().set(sensor, 'ping', result, ok=result['ping_status'] == 'Pass')
+        group = 'Passed' if result['ping_status'] == 'Pass' else 'Failed'
+        ping_sink.write({'group': group, 'result': result})
+        progress.stage_done(sensor, 'ping', result['ping_status'])
+
+
+def run_tools_stage(sensor: dict, progress: PipelineProgress) -> str:
+    if cached_stage_result(sensor, 'tools', None):
+        progress.stage_done(sensor, 'tools', 'unchanged since last run')
+        return ''
+    with span('stage_tools', sensor['ip_address_sensor']):
+        # The pre-flight sweep has just reached the sensor, and it may not answer ICMP.
+        summary = detect_package_manager_and_install.process_sensor(sensor, ping=False)
+    progress.stage_done(sensor, 'tools', 'done')
+    return summary
+
+
+def run_tests_stage(sensor: dict, tests: dict, tests_sink: ResultSink, progress: PipelineProgress) -> None:
+    result = cached_stage_result(sensor, 'tests', tests)
+    if result:
+        if progress.claim(sensor, 'tests'):
+            tests_sink.write(result)
+            progress.stage_done(sensor, 'tests', 'unchanged since last run')
+        return
+    with span('stage_tests', sensor['ip_address_sensor']):
+        result = sensor_tests.run_test_on_sensor(sensor, tests)
+    if not progress.claim(sensor, 'tests'):
+        return
+    sensor_tests.record_test_result(sensor, result, tests)
+    tests_sink.write(result)
+    failed = sum(test['status'] != 'Passed' for category in result['results'].values() for test in category)
+    progress.stage_done(sensor, 'tests', f"{failed} failed")
+
+
+def run_sensor_pipeline(sensor: dict, stages: list, tests: dict, ping_sink: ResultSink, tests_sink: ResultSink,
+                        progress: PipelineProgress) -> str:
+    """Run every stage for one sensor over its shared pooled connection.
+
+    The ping test does not depend on the tools, so it runs on its own channel while the tool audit runs;
+    the test suite waits for the tools it may need.
+    """
+    sensor = dict(sensor, Password_sensorz=sensor.get('Password_sensorz') or check_ping_sensors.password_sensorz)
+    summary = ''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as side_channel:
+        ping_future = side_channel.submit(run_ping_stage, sensor, ping_sink, progress) if 'ping' in stages else None
+        if 'tools' in stages:
+            summary = run_tools_stage(sensor, progress)
+        if 'tests' in stages:
+            run_tests_stage(sensor, tests, tests_sink, progress)
+        if ping_future:
+            ping_future.result()
+    progress.sensor_done(sensor)
+    return summary
+
+
+def run_stages(sensor_details: list, stages: list, tests: dict, ping_stream: str, tests_stream: str,
+               throughput_stream: str = None) -> dict:
+    """Push the sensors through the stages, appending their results to the ping and tests result streams.
+
+    Every sensor ends up with an entry per stage in the streams, including unreachable, skipped and
+    timed out ones, so streams of disjoint sensor sets can simply be concatenated.
+
+    The throughput stage runs after the others, once iperf3 is installed and the links are quiet, on a
+    schedule of its own for the whole fleet; its schedule is returned.
+    """
+    store = get_state_store()
+    alive, dead, skipped = preflight(sensor_details)
+    negative_cache = get_negative_cache()
+    progress = PipelineProgress(len(alive))
+
+    def on_error(sensor, e):
+        # Stages the sensor did not deliver get a failed or timed out entry, so partial runs are visible.
+        negative_cache.record_failure(sensor, str(e))
+        missing = progress.abandon(sensor, stages)
+        if 'ping' in missing:
+            ping_sink.write({'group': 'Failed', 'result': check_ping_sensors.failure_entry(sensor, e)})
+        if 'tests' in missing:
+            tests_sink.write(sensor_tests.incomplete_result(sensor, e))
+        print(f"Failed operation on {sensor['ip_address_sensor']}: {e}")
+
+    def on_result(sensor, summary):
+        negative_cache.record_success(sensor)
+        store.record_inventory(sensor)
+        if summary:
+            print(summary)
+
+    # Only the selected stages get a stream, so e.g. --stages tools leaves no empty result files behind.
+    ping_context = ResultSink(ping_stream) if 'ping' in stages else nullcontext()
+    tests_context = ResultSink(tests_stream) if 'tests' in stages else nullcontext()
+    with ping_context as ping_sink, tests_context as tests_sink:
+        run_fleet(alive, run_sensor_pipeline, stages, tests, ping_sink, tests_sink, progress,
+                  on_result=on_result, on_error=on_error, collect=False)
+        if 'ping' in stages:
+            for sensor in dead:
+                ping_sink.write({'group': 'Failed', 'result': unreachable_entry(sensor)})
+            for sensor in skipped:
+                ping_sink.write({'group': 'Failed', 'result': negative_cache.skipped_entry(sensor)})
+        if 'tests' in stages:
+            for sensor in dead:
+                tests_sink.write(sensor_tests.unreachable_result(sensor, "Not reachable in pre-flight sweep", "Failed"))
+            for sensor in skipped:
+                entry = negative_cache.skipped_entry(sensor)
+                tests_sink.write(sensor_tests.unreachable_result(
+                    sensor, "{} (last state: {})".format(entry['reason'], entry['last_state']), "Skipped"))
+        for sensor in dead + skipped:
+            logging.info(f"{sensor.get('hostname', 'Unknown')} ({sensor['ip_address_sensor']}): not reachable, "
+                         f"all stages skipped")
+    if 'throughput' in stages:
+        alive = [dict(sensor, Password_sensorz=sensor.get('Password_sensorz') or check_ping_sensors.password_sensorz)
+                 for sensor in alive]
+        return run_throughput_stage(alive, throughput_stream)
+    return {}
+
+
+def build_reports(stages: list, ping_stream: str, tests_stream: str, timestamp: str, throughput_stream: str = None,
+                  schedule: dict = None) -> dict:
+    """Build the ping, test and throughput reports of the stages from their result streams; return their paths."""
+    reports = {}
+    if 'ping' in stages:
+        check_ping_sensors.save_streamed_report(ping_stream, check_ping_sensors.ping_reports_directory, timestamp)
+        reports['ping'] = f"{check_ping_sensors.ping_reports_directory}/Ping_Test_Report_{timestamp}.yaml"
+    if 'tests' in stages:
+        reports['tests'], reports['output_groups'] = sensor_tests.write_streamed_reports(
+            tests_stream, f'Sensor Test Report - {timestamp}', sensor_tests.get_report_directory(), timestamp)
+    if 'throughput' in stages:
+        reports['throughput'], reports['throughput_html'] = write_throughput_reports(
+            throughput_stream, schedule, sensor_tests.get_report_directory(), timestamp)
+    return reports
+
+
+def run_pipeline(stages: list = None, sensor_details: list = None, selector: str = None) -> dict:
+    """Load the inventory once and push every selected sensor through the selected stages in one process.
+
+    Returns the paths of the reports that were written.
+    """
+    stages = stages or STAGES
+    sensor_details = sensor_details if sensor_details is not None else \
+        select_sensors(check_ping_sensors.sensors_file_path, selector)
+    tests = sensor_tests.load_tests(os.getenv('TESTS_DEFINITIONS_PATH')) if 'tests' in stages else {}
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    ping_stream = f"{check_ping_sensors.ping_reports_directory}/Ping_Test_Results_{timestamp}.jsonl"
+    tests_stream = os.path.join(sensor_tests.get_report_directory(), f"sensor_test_results_{timestamp}.jsonl")
+    throughput_stream = os.path.join(sensor_tests.get_report_directory(), f"throughput_results_{timestamp}.jsonl")
+
+    store = get_state_store()
+    store.start_run('pipeline')
+    schedule = run_stages(sensor_details, stages, tests, ping_stream, tests_stream, throughput_stream)
+    reports = build_reports(stages, ping_stream, tests_stream, timestamp, throughput_stream, schedule)
+    store.finish_run()
+    reports['diff'] = store.write_diff_report()
+    get_tracer().export('pipeline')
+    return reports
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import time
+
+from negative_cache import get_negative_cache, sensor_key
+from state_store import get_state_store
+from tracing import span
+
+SSH_PORT = int(os.getenv('SSH_PORT', '22'))
+
+# The VPN hands sensors either a 10.8.x.x or a 10.3.x.x address.
+ALTERNATE_PREFIXES = {'10.8': '10.3', '10.3': '10.8'}
+
+
+def alternate_ip(ip_address: str) -> str:
+    """Return the same address on the other VPN prefix, or None if it has no alternate."""
+    parts = ip_address.split('.')
+    new_prefix = ALTERNATE_PREFIXES.get('.'.join(parts[:2]))
+    if not new_prefix or len(parts) != 4:
+        return None
+    return '.'.join(new_prefix.split('.') + parts[2:])
+
+
+def candidate_addresses(sensor: dict) -> list:
+    """Return the sensor's configured address followed by its alternate-prefix address."""
+    ip_address = sensor['ip_address_sensor']
+    alternate = alternate_ip(ip_address)
+    return [ip_address, alternate] if alternate else [ip_address]
+
+
+async def tcp_probe(ip_address: str, port: int = SSH_PORT, timeout: float = 5) -> bool:
+    """Check whether a TCP connection to ip:port can be opened."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip_address, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def icmp_probe(ip_address: str, timeout: float = 5) -> bool:
+    """Check whether the address answers a single ICMP echo request."""
+    if os.name == 'nt':
+        command = ['ping', '-n', '1', '-w', str(int(timeout * 1000)), ip_address]
+    else:
+        command = ['ping', '-c', '1', '-W', str(max(1, int(timeout))), ip_address]
+    try:
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.DEVNULL)
+        return await asyncio.wait_for(process.wait(), timeout + 1) == 0
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+
+async def sweep_addresses(addresses: list, port: int = SSH_PORT, timeout: float = 5, icmp: bool = False,
+                          concurrency: int = 512) -> dict:
+    """Probe every address concurrently and return {ip: reachable}."""
+    limit = asyncio.Semaphore(concurrency)
+
+    async def probe(ip_address):
+        async with limit:
+            if await tcp_probe(ip_address, port, timeout):
+                return True
+            return icmp and await icmp_probe(ip_address, timeout)
+
+    addresses = list(dict.fromkeys(addresses))
+    results = await asyncio.gather(*(probe(ip_address) for ip_address in addresses))
+    return dict(zip(addresses, results))
+
+
+def sweep(sensors: list, port: int = SSH_PORT, timeout: float = None, icmp: bool = None) -> dict:
+    """Pre-flight sweep of the whole inventory (both VPN prefixes) in one pass.
+
+    Takes roughly as long as the slowest probe rather than the sum of them.
+    """
+    timeout = timeout or float(os.getenv('REACHABILITY_TIMEOUT', '5'))
+    icmp = os.getenv('REACHABILITY_ICMP', '0') == '1' if icmp is None else icmp
+    addresses = [ip_address for sensor in sensors for ip_address in candidate_addresses(sensor)]
+    started = time.monotonic()
+    with span('sweep'):
+        reachability = asyncio.run(sweep_addresses(addresses, port, timeout, icmp))
+    logging.info(f"Reachability sweep: {sum(reachability.values())}/{len(reachability)} addresses up "
+                 f"in {time.monotonic() - started:.1f}s")
+    return reachability
+
+
+def split_reachable(sensors: list, reachability: dict) -> tuple:
+    """Split sensors into (alive, dead) using a sweep result.
+
+    Alive sensors are returned as copies pointing at their first reachable address.
+    """
+    alive, dead = [], []
+    for sensor in sensors:
+        reachable = [ip_address for ip_address in candidate_addresses(sensor) if reachability.get(ip_address)]
+        if reachable:
+            alive.append(dict(sensor, ip_address_sensor=reachable[0]))
+        else:
+            dead.append(sensor)
+    return alive, dead
+
+
+def unreachable_entry(sensor: dict, reason: str = 'Not reachable in pre-flight sweep') -> dict:
+    """Describe a dead sensor the same way the scripts record unreachable sensors."""
+    addresses = candidate_addresses(sensor)
+    return {
+        'hostname': sensor.get('hostname', 'Unknown hostname'),
+        'original_ip': addresses[0],
+        'updated_ip': addresses[-1],
+        'reason': reason
+    }
+
+
+def preflight(sensors: list) -> tuple:
+    """Sweep the fleet and apply the negative cache, returning (alive, dead, skipped).
+
+    Sensors still backing off are only probed by the sweep; the probe result is kept as their last-known
+    state and they are returned in skipped. Newly dead sensors are recorded as failures. The reachable
+    address of every swept sensor is recorded in the state store and the route cache, so the first
+    connection after a VPN prefix flip goes to the live address.
+    """
+    # route_cache builds on this module, so it is imported here.
+    from route_cache import remember_routes
+
+    negative_cache = get_negative_cache()
+    store = get_state_store()
+    alive, dead = split_reachable(sensors, sweep(sensors))
+    remember_routes(alive)
+    for sensor in alive:
+        store.set(sensor, 'ip', sensor['ip_address_sensor'])
+    for sensor in dead:
+        store.set(sensor, 'ip', None, ok=False)
+    skipped = [sensor for sensor in sensors if negative_cache.in_backoff(sensor)]
+    skipped_keys = {sensor_key(sensor) for sensor in skipped}
+    for sensor in dead:
+        if sensor_key(sensor) in skipped_keys:
+            negative_cache.record_probe(sensor, 'Not reachable in pre-flight sweep', save=False)
+        else:
+            negative_cache.record_failure(sensor, 'Not reachable in pre-flight sweep', save=False)
+    for sensor in alive:
+        if sensor_key(sensor) in skipped_keys:
+            negative_cache.record_probe(sensor, 'SSH port reachable in pre-flight sweep', save=False)
+    negative_cache.save()
+    if skipped:
+        logging.info(f"Skipping {len(skipped)} sensors that are backing off after repeated failures")
+    return ([sensor for sensor in alive if sensor_key(sensor) not in skipped_keys],
+            [sensor for sensor in dead if sensor_key(sensor) not in skipped_keys],
+            skipped)
@@ -0,0 +1,208 @@
+"""On-sensor resource sampling while a sensor's tests run.
+
+One long-lived command per sensor, started before its tests on its pooled connection, prints a line of /proc
+deltas every SAMPLER_INTERVAL seconds: CPU busy and total jiffies, MemAvailable, the first thermal zone's
+temperature and the bytes received and sent on every interface but loopback. Nothing is started per sample.
+
+The controller appends every line to array-backed series and summarises the window of each test (peak,
+mean, p50 and p95 per metric) into its result. Enabled with RESOURCE_SAMPLING=1.
+"""
+import bisect
+import logging
+import math
+import os
+import shlex
+import threading
+import time
+from array import array
+
+from ssh_pool import FullCapture
+from ssh_transport import get_transport
+from tracing import percentile
+
+METRICS = ('cpu_pct', 'mem_available_mb', 'temp_c', 'rx_kbps', 'tx_kbps')
+
+# Prints "pid <pid>" once, then "<busy> <total> <MemAvailable kB> <temp m°C or -1> <rx bytes> <tx bytes>"
+# deltas (MemAvailable and the temperature as they are) until killed or after max_samples lines.
+SAMPLER_SCRIPT = r'''
+interval=%(interval)s; left=%(max_samples)d
+echo "pid $$"
+sample() {
+    read -r _ user nice system idle iowait irq softirq steal _ < /proc/stat
+    busy=$((user + nice + system + irq + softirq + steal)); total=$((busy + idle + iowait))
+    mem=0
+    while read -r key value _; do [ "$key" = MemAvailable: ] && { mem=$value; break; }; done < /proc/meminfo
+    temp=-1
+    [ -r /sys/class/thermal/thermal_zone0/temp ] && read -r temp < /sys/class/thermal/thermal_zone0/temp
+    rx=0; tx=0
+    while IFS=: read -r interface counters; do
+        [ -n "$counters" ] || continue
+        case "$interface" in *lo) continue ;; esac
+        set -- $counters; rx=$((rx + $1)); tx=$((tx + $9))
+    done < /proc/net/dev
+}
+sample
+while [ "$left" -gt 0 ]; do
+    last_busy=$busy; last_total=$total; last_rx=$rx; last_tx=$tx
+    sleep "$interval"
+    sample
+    echo "$((busy - last_busy)) $((total - last_total)) $mem $temp $((rx - last_rx)) $((tx - last_tx))"
+    left=$((left - 1))
+done
+'''
+
+
+def sampling_enabled() -> bool:
+    return os.getenv('RESOURCE_SAMPLING') == '1'
+
+
+class ResourceSeries:
+    """Time series of every metric in flat float arrays, indexed by the controller's monotonic receive time.
+
+    A sample received at t describes the interval before it, so a window (start, end) covers the samples
+    received from start up to one interval after end.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.times = array('d')
+        self.values = {metric: array('d') for metric in METRICS}
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, timestamp: float, busy: int, total: int, mem_kb: int, temp: int, rx: int, tx: int) -> None:
+        self.times.append(timestamp)
+        self.values['cpu_pct'].append(100.0 * busy / total if total > 0 else 0.0)
+        self.values['mem_available_mb'].append(mem_kb / 1024)
+        self.values['temp_c'].append(temp / 1000 if temp >= 0 else math.nan)
+        self.values['rx_kbps'].append(rx / 1024 / self.interval)
+        self.values['tx_kbps'].append(tx / 1024 / self.interval)
+
+    def summary(self, start: float, end: float) -> dict:
+        """Return {metric: {peak, mean, p50, p95}} over the window, or {} when no sample falls in it."""
+        first = bisect.bisect_left(self.times, start)
+        last = bisect.bisect_right(self.times, end + self.interval)
+        summary = {}
+        for metric, values in self.values.items():
+            window = sorted(value for value in values[first:last] if not math.isnan(value))
+            if window:
+                summary[metric] = {'peak': round(window[-1], 1), 'mean': round(sum(window) / len(window), 1),
+                                   'p50': round(percentile(window, 0.5), 1), 'p95': round(percentile(window, 0.95), 1)}
+        if summary:
+            summary['samples'] = last - first
+        return summary
+
+
+class SamplerCapture:
+    """Capture (see output_capture) that parses the sampler's lines into a series as they arrive."""
+
+    def __init__(self, series: ResourceSeries):
+        self.series = series
+        self.pid = None
+        self.started = threading.Event()
+        self._partial = b''
+
+    def write(self, chunk: bytes) -> None:
+        received = time.monotonic()
+        *lines, self._partial = (self._partial + chunk).split(b'\n')
+        for line in lines:
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == b'pid':
+                self.pid = int(fields[1])
+                self.started.set()
+            elif len(fields) == 6:
+                try:
+                    self.series.append(received, *map(int, fields))
+                except ValueError:
+                    logging.error(f"Unreadable resource sample: {line!r}")
+
+    def finish(self) -> str:
+        self.started.set()
+        return ''
+
+
+class ResourceSampler:
+    """Stream samples from one sensor on a background thread between start() and stop()."""
+
+    def __init__(self, ip_address: str, username: str, password: str, interval: float = None,
+                 max_seconds: float = None):
+        self.ip_address = ip_address
+        self.username = username
+        self.password = password
+        self.interval = interval or float(os.getenv('SAMPLER_INTERVAL', '1'))
+        # The sampler ends on its own after this long, should stop() never reach it.
+        self.max_seconds = max_seconds or float(os.getenv('SAMPLER_MAX_SECONDS', '3600'))
+        self.series = ResourceSeries(self.interval)
+        self.capture = SamplerCapture(self.series)
+        self._thread = None
+
+    def _run(self, command: str) -> None:
+        try:
+            get_transport().exec_command(self.ip_address, self.username, self.password, command,
+                                         timeout=self.max_seconds + 60, stdout_capture=self.capture,
+                                         stderr_capture=FullCapture())
+        except Exception as e:
+            logging.error(f"Resource sampler on {self.ip_address} ended: {e}")
+        finally:
+            self.capture.started.set()
+
+    def start(self) -> 'ResourceSampler':
+        script = SAMPLER_SCRIPT % {'interval': self.interval, 'max_samples': int(self.max_seconds / self.interval)}
+        self._thread = threading.Thread(target=self._run, args=(f"sh -c {shlex.quote(script)}",),
+                                        name=f"sampler-{self.ip_address}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Kill the remote sampler and wait for its last samples."""
+        self.capture.started.wait(self.interval + 30)
+        if self.capture.pid:
+            try:
+                get_transport().exec_command(self.ip_address, self.username, self.password,
+                                             f"kill {self.capture.pid}", timeout=30)
+            except Exception as e:
+                logging.error(f"Could not stop the resource sampler on {self.ip_address}: {e}")
+        self._thread.join(self.interval + 30)
+
+
+def start_sampler(ip_address: str, username: str, password: str) -> ResourceSampler:
+    """Start sampling a sensor when RESOURCE_SAMPLING is enabled; return the sampler or None."""
+    return ResourceSampler(ip_address, username, password).start() if sampling_enabled() else None
+
+
+def attach_summaries(results: dict, series: ResourceSeries, windows: dict) -> None:
+    """Add a "resources" summary to every test result whose (start, end) window is in windows by name."""
+    for category, tests in results.items():
+        for test in tests:
+            window = windows.get((category, test['test_name']))
+            if window:
+                summary = series.summary(*window)
+                if summary:
+                    test['resources'] = summary
+
+
+def format_resources(summary: dict) -> str:
+    """One line of a summary for the reports, e.g. "cpu_pct peak 73.5 mean 19.3 p95 73.5; ..."."""
+    return '; '.join(f"{metric} peak {stats['peak']} mean {stats['mean']} p95 {stats['p95']}"
+                     for metric, stats in summary.items() if metric != 'samples')
+
+
+def with_resource_lines(test_results):
+    """Yield the sensor results with every test's resource summary appended to its output."""
+    for result in test_results:
+        yield dict(result, results={
+            category: [dict(test, output=f"{test['output']}\nResources: {format_resources(test['resources'])}")
+                       if test.get('resources') else test for test in tests]
+            for category, tests in result.get('results', {}).items()})
+
+
+def compiled_windows(results: dict, started: float) -> dict:
+    """Windows of compiled tests, laid out back to back from the suite's start by their elapsed times."""
+    windows = {}
+    for category, tests in results.items():
+        for test in tests:
+            elapsed = test.get('elapsed_ms', 0) / 1000
+            windows[(category, test['test_name'])] = (started, started + elapsed)
+            started += elapsed
+    return windows
@@ -0,0 +1,77 @@
+import json
+import logging
+import os
+import threading
+
+import yaml
+
+
+class ResultSink:
+    """Append-only JSONL sink. Every record is flushed as it is written, so a crashed run keeps its results."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'a')
+
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            self.count += 1
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_results(path: str):
+    """Yield the records of a JSONL result stream one at a time, skipping a torn final line."""
+    with open(path) as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logging.error(f"Skipping unreadable record at {path}:{line_number}")
+
+
+def write_grouped_yaml(stream_path: str, report_path: str, groups: list, group_key: str = 'group',
+                       transform=None) -> dict:
+    """Write {group: [records]} YAML from a stream, one record at a time, and return the count per group.
+
+    Produces the same document as yaml.safe_dump of the grouped dict, without holding it in memory.
+    The stream is read once per group. transform, if given, is applied to each result before it is written.
+    """
+    counts = {}
+    with open(report_path, 'w') as report:
+        for group in sorted(groups):
+            count = 0
+            for record in iter_results(stream_path):
+                if record.get(group_key) != group:
+                    continue
+                if not count:
+                    report.write(f"{group}:\n")
+                result = transform(record['result']) if transform else record['result']
+                report.write(yaml.safe_dump([result]))
+                count += 1
+            if not count:
+                report.write(f"{group}: []\n")
+            counts[group] = count
+    return counts
+
+
+def render_to_file(template, context: dict, report_path: str) -> None:
+    """Stream a Jinja template into a file with template.generate() instead of rendering one big string."""
+    with open(report_path, 'w') as report:
+        for chunk in template.generate(context):
+            report.write(chunk)
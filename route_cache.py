@@ -0,0 +1,162 @@
+import asyncio
+import atexit
+import os
+import threading
+import time
+
+from reachability import SSH_PORT, candidate_addresses, tcp_probe
+from state_files import load_json_state, save_json_state
+from tracing import span
+
+# Head start given to the preferred address before the alternate is tried in parallel.
+HAPPY_EYEBALLS_DELAY = 0.25
+
+
+class RouteCache:
+    """Persistent hostname -> winning address map, reused by later runs and rechecked once expired.
+
+    Changes are written at most once every save_interval seconds; flush() writes any that are pending.
+    """
+
+    def __init__(self, path: str = None, ttl: float = None, save_interval: float = None):
+        self.path = path or os.getenv('ROUTE_CACHE_PATH', 'state/route_cache.json')
+        self.ttl = ttl or float(os.getenv('ROUTE_CACHE_TTL', str(6 * 3600)))
+        self.save_interval = float(os.getenv('ROUTE_CACHE_SAVE_INTERVAL', '10')) if save_interval is None \
+            else save_interval
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._routes = load_json_state(self.path)
+        self._refreshing = set()
+        self._dirty = False
+        self._saved_at = 0.0
+
+    def save(self) -> None:
+        with self._lock:
+            routes = dict(self._routes)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        with self._save_lock:
+            save_json_state(self.path, routes)
+
+    def flush(self) -> None:
+        if self._dirty:
+            self.save()
+
+    def get(self, hostname: str) -> tuple:
+        """Return (ip, expired) for a hostname, or (None, True) when it has never been resolved."""
+        with self._lock:
+            entry = self._routes.get(hostname)
+        if not entry:
+            return None, True
+        return entry['ip'], time.time() - entry['resolved_at'] > self.ttl
+
+    def set(self, hostname: str, ip_address: str, save: bool = True) -> None:
+        with self._lock:
+            self._routes[hostname] = {'ip': ip_address, 'resolved_at': time.time()}
+            self._dirty = True
+            due = time.monotonic() - self._saved_at >= self.save_interval
+        if save and due:
+            self.save()
+
+    def refresh_in_background(self, hostname: str, addresses: list, timeout: float) -> None:
+        """Re-race an expired route on a daemon thread, at most once per hostname at a time."""
+        with self._lock:
+            if hostname in self._refreshing:
+                return
+            self._refreshing.add(hostname)
+
+        def refresh():
+            try:
+                _race_and_store(self, hostname, addresses, timeout)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(hostname)
+
+        threading.Thread(target=refresh, name=f"route-refresh-{hostname}", daemon=True).start()
+
+
+async def race_addresses(addresses: list, port: int = SSH_PORT, timeout: float = 10,
+                         delay: float = HAPPY_EYEBALLS_DELAY) -> str:
+    """Happy-eyeballs connect: start each address `delay` after the previous one and return the first to answer."""
+
+    async def attempt(index, ip_address):
+        await asyncio.sleep(index * delay)
+        if await tcp_probe(ip_address, port, timeout):
+            return ip_address
+        raise OSError(f"{ip_address}:{port} not reachable")
+
+    tasks = [asyncio.ensure_future(attempt(index, ip_address)) for index, ip_address in enumerate(addresses)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                return await next_done
+            except OSError:
+                continue
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _ordered_candidates(sensor: dict, preferred: str = None) -> list:
+    addresses = candidate_addresses(sensor)
+    if preferred in addresses:
+        addresses.remove(preferred)
+        addresses.insert(0, preferred)
+    return addresses
+
+
+def _race_and_store(cache: RouteCache, hostname: str, addresses: list, timeout: float) -> str:
+    with span('route', addresses[0]):
+        winner = asyncio.run(race_addresses(addresses, timeout=timeout))
+    if winner:
+        cache.set(hostname, winner)
+    return winner
+
+
+def resolve_sensor(sensor: dict, cache: RouteCache = None, timeout: float = None) -> dict:
+    """Return a copy of the sensor pointing at its best address; the input dict is never modified.
+
+    A fresh cached route is used as is; an expired one is used while it is rechecked in the background;
+    otherwise both VPN prefixes are raced and the winner is remembered.
+    """
+    cache = cache or get_route_cache()
+    timeout = timeout or float(os.getenv('REACHABILITY_TIMEOUT', '5'))
+    hostname = sensor.get('hostname') or sensor['ip_address_sensor']
+    cached_ip, expired = cache.get(hostname)
+    addresses = _ordered_candidates(sensor, cached_ip)
+    if cached_ip in addresses:
+        if expired:
+            cache.refresh_in_background(hostname, addresses, timeout)
+        return dict(sensor, ip_address_sensor=cached_ip)
+    winner = _race_and_store(cache, hostname, addresses, timeout)
+    return dict(sensor, ip_address_sensor=winner or sensor['ip_address_sensor'])
+
+
+def remember_route(sensor: dict, cache: RouteCache = None) -> None:
+    """Record the address a sensor was successfully reached on."""
+    cache = cache or get_route_cache()
+    hostname = sensor.get('hostname') or sensor['ip_address_sensor']
+    if cache.get(hostname)[0] != sensor['ip_address_sensor']:
+        cache.set(hostname, sensor['ip_address_sensor'])
+
+
+def remember_routes(sensors: list, cache: RouteCache = None) -> None:
+    """Record the addresses a sweep just reached the sensors on as fresh routes, writing the cache once."""
+    cache = cache or get_route_cache()
+    for sensor in sensors:
+        cache.set(sensor.get('hostname') or sensor['ip_address_sensor'], sensor['ip_address_sensor'], save=False)
+    cache.flush()
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_route_cache() -> RouteCache:
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = RouteCache()
+            atexit.register(_shared_cache.flush)
+        return _shared_cache
@@ -1,14 +1,25 @@
-import concurrent.futures
 import json
 import logging
 import os
+import time
 from datetime import datetime
 
-import paramiko
-import yaml
 from dotenv import load_dotenv
 from jinja2 import Environment, FileSystemLoader
 
+from compiled_tests import DEFAULT_TEST_TIMEOUT, run_compiled_tests
+from fleet_engine import StragglerTimeout, run_fleet
+from inventory import select_sensors
+from negative_cache import get_negative_cache
+from output_capture import capture_command
+from output_groups import OutputGroups
+from parallel_tests import run_in_parallel
+from reachability import preflight
+from resource_sampler import attach_summaries, compiled_windows, start_sampler, with_resource_lines
+from result_stream import ResultSink, iter_results, render_to_file
+from state_store import fingerprint, get_state_store, incremental_mode
+from tracing import get_tracer, span
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 load_dotenv(dotenv_path=r'C:\Users\Roy Avrahami\PycharmProjects\sensorz_qa_roy\config\.env')
@@ -16,6 +27,10 @@ load_dotenv(dotenv_path=r'C:\Users\Roy Avrahami\PycharmProjects\sensorz_qa_roy\c
 sensors_file_path = os.getenv('SENSOR_DETAILS_PATH')
 reports_directory = os.getenv('REPORTS_DIRECTORY')
 password_sensorz = os.getenv('PASSWORD_SENSORZ')
+# "compiled" runs all tests of a sensor as one remote script; "parallel" runs the tests of a category on
+# concurrent channels of the sensor's transport; "sequential" runs one SSH command per test.
+tests_mode = os.getenv('SENSOR_TESTS_MODE', 'compiled')
+test_channels_per_sensor = int(os.getenv('SENSOR_TEST_CHANNELS', '4'))
 
 assert sensors_file_path is not None, "SENSOR_DETAILS_PATH is not set"
 assert reports_directory is not None, "REPORTS_DIRECTORY is not set"
@@ -35,22 +50,18 @@ def load_tests(file_path):
 
 def load_sensor_details(file_path):
     assert os.path.isfile(file_path), "Sensor details file {} does not exist.".format(file_path)
-    with open(file_path) as file:
-        sensor_details = yaml.safe_load(file)
-        assert isinstance(sensor_details, list), "Sensor details file format is incorrect. Expected a list."
-        print("Sensor details loaded.")
-        return sensor_details
+    sensor_details = select_sensors(file_path)
+    assert isinstance(sensor_details, list), "Sensor details file format is incorrect. Expected a list."
+    print("Sensor details loaded.")
+    return sensor_details
 
 
-def run_ssh_command(ip_address_sensor, username_sensorz, sensorz_password, command):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+def run_ssh_command(ip_address_sensor, username_sensorz, sensorz_password, command, timeout=None):
+    timeout = timeout or float(os.getenv('SENSOR_TEST_TIMEOUT', str(DEFAULT_TEST_TIMEOUT)))
     try:
-        client.connect(hostname=ip_address_sensor, username=username_sensorz, password=sensorz_password)
-        logging.info("Connected to {}".format(ip_address_sensor))
-        stdin, stdout, stderr = client.exec_command("sudo " + command)
-        output = stdout.read().decode()
-        error = stderr.read().decode()
+        # Large outputs are truncated to head and tail here and kept in full in the output store.
+        _, output, error = capture_command(ip_address_sensor, username_sensorz, sensorz_password, "sudo " + command,
+                                           timeout=timeout)
         if error:
             logging.error("Error executing {} on {}: {}".format(command, ip_address_sensor, error))
             return False, error
@@ -59,8 +70,6 @@ def run_ssh_command(ip_address_sensor, username_sensorz, sensorz_password, comma
     except Exception as e:
         logging.error("Connection or execution failed for {}: {}".format(ip_address_sensor, str(e)))
         return False, str(e)
-    finally:
-        client.close()
 
 
 def run_test_on_sensor(sensor, tests):
@@ -75,30 +84,202 @@ def run_test_on_sensor(sensor, tests):
         "results": {}
     }
 
-    for category, test_commands in tests.items():
-        category_results = []
-        for test in test_commands:
-            logging.info("Executing test: {} on sensor: {} {}".format(test['name'], hostname_sensor, ip_address_sensor))
-            success, output = run_ssh_command(ip_address_sensor, username_sensorz, Password_sensorz, test['command'])
-            test_status = "Passed" if success else "Failed"
-            category_results.append({
-                "test_name": test['name'],
-                "output": output,
-                "status": test_status
-            })
-        sensor_result["results"][category] = category_results
+    # With RESOURCE_SAMPLING=1 the sensor's CPU, memory, temperature and traffic are streamed during the tests.
+    sampler = start_sampler(ip_address_sensor, username_sensorz, Password_sensorz)
+    started = time.monotonic()
+
+    if tests_mode == 'compiled':
+        logging.info("Executing {} compiled tests on sensor: {} {}".format(
+            sum(len(test_commands) for test_commands in tests.values()), hostname_sensor, ip_address_sensor))
+        try:
+            compiled_results = run_compiled_tests(ip_address_sensor, username_sensorz, Password_sensorz, tests)
+        except Exception:
+            if sampler:
+                sampler.stop()
+            raise
+        # None: the sensor cannot run the compiled script, so its tests run one by one below.
+        if compiled_results is not None:
+            sensor_result["results"] = compiled_results
+            if sampler:
+                sampler.stop()
+                attach_summaries(sensor_result["results"], sampler.series,
+                                 compiled_windows(sensor_result["results"], started))
+                sensor_result["resources"] = sampler.series.summary(started, time.monotonic())
+            logging.info("Tests completed for sensor: {} {}".format(hostname_sensor, ip_address_sensor))
+            return sensor_result
+
+    windows = {}
+
+    def run_test(test):
+        logging.info("Executing test: {} on sensor: {} {}".format(test['name'], hostname_sensor, ip_address_sensor))
+        test_started = time.monotonic()
+        with span('test', ip_address_sensor):
+            outcome = run_ssh_command(ip_address_sensor, username_sensorz, Password_sensorz, test['command'],
+                                      test.get('timeout'))
+        windows[id(test)] = (test_started, time.monotonic())
+        return outcome
+
+    try:
+        for category, test_commands in tests.items():
+            category_results = []
+            if tests_mode == 'parallel':
+                outcomes = run_in_parallel(run_test, test_commands, test_channels_per_sensor)
+            else:
+                outcomes = (run_test(test) for test in test_commands)
+            for test, (success, output) in zip(test_commands, outcomes):
+                test_status = "Passed" if success else "Failed"
+                category_results.append({
+                    "test_name": test['name'],
+                    "output": output,
+                    "status": test_status
+                })
+            sensor_result["results"][category] = category_results
+    finally:
+        if sampler:
+            sampler.stop()
+    if sampler:
+        attach_summaries(sensor_result["results"], sampler.series,
+                         {(category, test['name']): windows[id(test)] for category, test_commands in tests.items()
+                          for test in test_commands if id(test) in windows})
+        sensor_result["resources"] = sampler.series.summary(started, time.monotonic())
 
     logging.info("Tests completed for sensor: {} {}".format(hostname_sensor, ip_address_sensor))
     return sensor_result
 
 
-def execute_tests(sensor_details, tests):
-    """Execute tests on all sensors."""
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Map each sensor to the run_test_on_sensor function using its correct details.
-        futures = {executor.submit(run_test_on_sensor, sensor, tests): sensor for sensor in sensor_details}
-        test_results = [future.result() for future in concurrent.futures.as_completed(futures)]
-    return test_results
+def unreachable_result(sensor, output, status):
+    """Sensor result for a sensor that was not tested because it could not be reached."""
+    return {
+        "hostname": sensor['hostname'],
+        "ip_address": sensor['ip_address_sensor'],
+        "results": {"Reachability": [{
+            "test_name": "SSH reachable",
+            "output": output,
+            "status": status
+        }]}
+    }
+
+
+def incomplete_result(sensor, error):
+    """Sensor result for a sensor whose tests failed to complete or were abandoned as a straggler."""
+    return {
+        "hostname": sensor['hostname'],
+        "ip_address": sensor['ip_address_sensor'],
+        "results": {"Run": [{
+            "test_name": "Tests completed",
+            "output": str(error),
+            "status": "Timed out" if isinstance(error, StragglerTimeout) else "Failed"
+        }]}
+    }
+
+
+def record_test_result(sensor, result, tests):
+    """Store a sensor's test results, tagged with the test definitions they were run against."""
+    passed = all(test['status'] == 'Passed' for category in result['results'].values() for test in category)
+    store = get_state_store()
+    store.set(sensor, 'tests', {'suite': fingerprint(tests), 'result': result}, ok=passed)
+    store.record_inventory(sensor)
+
+
+def plan_incremental_tests(sensors, tests):
+    """Split sensors into (to_test, cached_results) using the state store.
+
+    A sensor is only tested again if its inventory entry changed, its last results failed or expired,
+    or the test definitions changed since.
+    """
+    store = get_state_store()
+    to_test, unchanged = store.plan(sensors, ['tests'])
+    cached_results = []
+    for sensor in unchanged:
+        cached = store.get(sensor, 'tests')
+        if cached['suite'] == fingerprint(tests):
+            cached_results.append(cached['result'])
+        else:
+            to_test.append(sensor)
+    return to_test, cached_results
+
+
+def execute_tests(sensor_details, tests, sink=None):
+    """Execute tests on all sensors.
+
+    With a sink each sensor result is written to it as soon as it completes, nothing is kept in memory and
+    the number of results written is returned instead of the results. In incremental mode only sensors
+    that need it are tested and the last results of the others are reused.
+    """
+    alive, dead, skipped = preflight(sensor_details)
+    negative_cache = get_negative_cache()
+    cached_results = []
+    if incremental_mode():
+        alive, cached_results = plan_incremental_tests(alive, tests)
+
+    def on_result(sensor, result):
+        negative_cache.record_success(sensor)
+        record_test_result(sensor, result, tests)
+        if sink:
+            sink.write(result)
+
+    def on_error(sensor, e):
+        # Failed and timed out sensors still get an entry, so a run cut short reports what is missing.
+        negative_cache.record_failure(sensor, str(e))
+        result = incomplete_result(sensor, e)
+        if sink:
+            sink.write(result)
+        else:
+            cached_results.append(result)
+
+    test_results = run_fleet(alive, run_test_on_sensor, tests, on_result=on_result, on_error=on_error,
+                             collect=sink is None)
+    for result in cached_results:
+        if sink:
+            sink.write(result)
+        else:
+            test_results.append(result)
+    unreachable = [(sensor, "Not reachable in pre-flight sweep", "Failed") for sensor in dead]
+    for sensor in skipped:
+        entry = negative_cache.skipped_entry(sensor)
+        unreachable.append((sensor, "{} (last state: {})".format(entry['reason'], entry['last_state']), "Skipped"))
+    for sensor, output, status in unreachable:
+        result = unreachable_result(sensor, output, status)
+        if sink:
+            sink.write(result)
+        else:
+            test_results.append(result)
+    return sink.count if sink else test_results
+
+
+def test_output_groups(test_results):
+    """Group the outputs of every test across sensors."""
+    groups = OutputGroups()
+    for result in test_results:
+        for category, tests in result['results'].items():
+            for test in tests:
+                groups.add(f"{category}/{test['test_name']}", result['hostname'], test['output'], test['status'])
+    return groups
+
+
+def compact_test_results(test_results, groups):
+    """Yield the results with outputs that other sensors share replaced by a reference to the output groups."""
+    for result in test_results:
+        for category, tests in result['results'].items():
+            for test in tests:
+                test['output'] = groups.compact(f"{category}/{test['test_name']}", test['output'])
+        yield result
+
+
+def write_streamed_reports(stream_path, title, report_directory, formatted_datetime):
+    """Build the HTML report and the output groups report from a result stream; return their paths.
+
+    Each distinct output is written once to the output groups report and the HTML report refers to it,
+    so outputs shared across the fleet are not repeated per sensor.
+    """
+    groups = test_output_groups(iter_results(stream_path))
+    groups_path = groups.write_yaml(os.path.join(report_directory,
+                                                 f"sensor_test_output_groups_{formatted_datetime}.yaml"))
+    logging.info(f"Output groups saved to {groups_path}")
+    report_path = write_html_report(compact_test_results(iter_results(stream_path), groups), title,
+                                    os.path.join(report_directory, f"sensor_test_report_{formatted_datetime}.html"),
+                                    output_groups=groups.summary())
+    return report_path, groups_path
 
 
 def generate_html_report(test_results, title, template_dir='templates', template_file='report_template.html'):
@@ -114,11 +295,38 @@ def generate_html_report(test_results, title, template_dir='templates', template
     return report_content
 
 
-def generate_report(report_content, report_filename=None):
+def write_html_report(test_results, title, report_filepath, template_dir='templates',
+                      template_file='report_template.html', output_groups=None):
+    """Stream the HTML report into a file; test_results may be a generator such as iter_results().
+
+    output_groups (OutputGroups.summary()) is passed to the template for a grouped view. With
+    RESOURCE_SAMPLING=1 a sensor result has a "resources" summary, and so does each of its tests, as
+    {metric: {peak, mean, p50, p95}, 'samples': count}; each test's summary is also appended to its
+    output, so templates that only show outputs include it.
+    """
+    env = Environment(loader=FileSystemLoader(template_dir))
+    template = env.get_template(template_file)
+    report_data = {
+        'title': title,
+        'date_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'test_results': with_resource_lines(test_results),
+        'output_groups': output_groups or []
+    }
+    render_to_file(template, report_data, report_filepath)
+    print(f"Report saved to: {report_filepath}")
+    return report_filepath
+
+
+def get_report_directory():
     report_directory = os.getenv('REPORTS_DIRECTORY',
                                  'C:\\Users\\Roy Avrahami\\OneDrive - Sensorz\\Automation SSH Sensors Run Reports')
     if not os.path.exists(report_directory):
         os.makedirs(report_directory)
+    return report_directory
+
+
+def generate_report(report_content, report_filename=None):
+    report_directory = get_report_directory()
     report_filepath = os.path.join(report_directory, report_filename if report_filename else 'report.html')
     with open(report_filepath, "w") as report_file:
         report_file.write(report_content)
@@ -126,27 +334,30 @@ def generate_report(report_content, report_filename=None):
     return report_filepath
 
 
-load_dotenv(dotenv_path=r'C:\Users\Roy Avrahami\PycharmProjects\sensorz_qa_roy\config\.env')
-print("Environment variables loaded:")
-print(os.environ)  # Print all environment variables to debug
-
-
 def main():
     print("Starting test execution...")
     sensor_details = load_sensor_details(os.getenv('SENSOR_DETAILS_PATH'))
     tests = load_tests(os.getenv('TESTS_DEFINITIONS_PATH'))
-    test_results = execute_tests(sensor_details, tests)
 
     # Format the current date and time to include in the filename
     now = datetime.now()
     formatted_datetime = now.strftime("%Y-%m-%d_%H-%M-%S")  # This is the date and time format
     title = f'Sensor Test Report - {formatted_datetime}'  # This is your title
-    report_filename = f"sensor_test_report_{formatted_datetime}.html"  # Custom report filename
 
-    report = generate_html_report(test_results, title)
-    report_filepath = generate_report(report, report_filename)
+    # Stream results to disk as sensors finish, then build the report from the stream.
+    report_directory = get_report_directory()
+    store = get_state_store()
+    store.start_run('sensor_tests')
+    stream_path = os.path.join(report_directory, f"sensor_test_results_{formatted_datetime}.jsonl")
+    with ResultSink(stream_path) as sink:
+        execute_tests(sensor_details, tests, sink)
+
+    report_filepath, _ = write_streamed_reports(stream_path, title, report_directory, formatted_datetime)
 
     logging.info("Report saved to {}".format(report_filepath))
+    store.finish_run()
+    store.write_diff_report()
+    get_tracer().export('sensor_tests')
 
 
 if __name__ == "__main__":
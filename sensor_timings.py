@@ -0,0 +1,83 @@
+import os
+import statistics
+import threading
+import time
+
+from negative_cache import sensor_key
+from state_files import load_json_state, save_json_state
+
+
+class SensorTimings:
+    """Persistent per-sensor duration and failure history of each fleet operation.
+
+    Durations are an exponentially weighted moving average, failures a count of consecutive failed or
+    timed out runs. The fleet engine uses them to start the slowest and flakiest sensors first and to
+    give every sensor a time budget proportional to how long it usually takes.
+    """
+
+    def __init__(self, path: str = None, alpha: float = None, budget_factor: float = None,
+                 min_budget: float = None):
+        self.path = path or os.getenv('SENSOR_TIMINGS_PATH', 'state/sensor_timings.json')
+        self.alpha = alpha or float(os.getenv('SENSOR_TIMINGS_ALPHA', '0.3'))
+        self.budget_factor = budget_factor or float(os.getenv('FLEET_BUDGET_FACTOR', '4'))
+        self.min_budget = min_budget or float(os.getenv('FLEET_MIN_BUDGET', '60'))
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._entries = load_json_state(self.path)
+
+    def save(self) -> None:
+        with self._lock:
+            entries = {key: dict(operations) for key, operations in self._entries.items()}
+        with self._save_lock:
+            save_json_state(self.path, entries)
+
+    def entry(self, sensor: dict, operation: str) -> dict:
+        with self._lock:
+            return self._entries.get(sensor_key(sensor), {}).get(operation)
+
+    def record(self, sensor: dict, operation: str, duration: float, ok: bool) -> None:
+        with self._lock:
+            operations = self._entries.setdefault(sensor_key(sensor), {})
+            entry = operations.get(operation)
+            if entry is None:
+                entry = operations[operation] = {'duration': duration, 'runs': 0, 'failures': 0}
+            else:
+                # A failed run's duration only counts when it took longer, e.g. a timeout.
+                if ok or duration > entry['duration']:
+                    entry['duration'] += self.alpha * (duration - entry['duration'])
+            entry['runs'] += 1
+            entry['failures'] = 0 if ok else entry['failures'] + 1
+            entry['updated_at'] = time.time()
+
+    def order(self, sensors: list, operation: str) -> list:
+        """Return the sensors slowest and flakiest first; sensors without history count as the median."""
+        entries = [self.entry(sensor, operation) for sensor in sensors]
+        known = [entry['duration'] for entry in entries if entry]
+        default = statistics.median(known) if known else 0.0
+
+        def cost(index: int) -> float:
+            entry = entries[index]
+            if not entry:
+                return default
+            return entry['duration'] * (1 + min(entry['failures'], 3))
+
+        return [sensors[index] for index in sorted(range(len(sensors)), key=cost, reverse=True)]
+
+    def budget(self, sensor: dict, operation: str, ceiling: float) -> float:
+        """Seconds a sensor gets for an operation: budget_factor times its usual duration, within limits."""
+        entry = self.entry(sensor, operation)
+        if not entry or not entry['runs']:
+            return ceiling
+        return min(ceiling, max(self.min_budget, self.budget_factor * entry['duration']))
+
+
+_shared_timings = None
+_shared_timings_lock = threading.Lock()
+
+
+def get_sensor_timings() -> SensorTimings:
+    global _shared_timings
+    with _shared_timings_lock:
+        if _shared_timings is None:
+            _shared_timings = SensorTimings()
+        return _shared_timings
@@ -0,0 +1,222 @@
+"""Sharded runs: split the inventory across worker processes or controller hosts and merge their results.
+
+Every shard runs the pipeline stages on its part of the fleet in its own process (its own GIL for the SSH
+crypto) and writes its result streams, diff and a manifest into <run dir>/shard-<i>. The merge step
+concatenates the shards' streams and builds one set of reports from them.
+
+Local shards are child processes of this one. Across controllers, run `main.py --shard i/N --run-dir DIR`
+on each host with the same inventory and strategy, collect the shard-<i> directories into one run directory
+(or use a shared one) and run `main.py --merge DIR`.
+
+Strategies (SHARD_STRATEGY, default hash):
+    hash    sensors spread by a stable hash of their hostname
+    subnet  whole subnets (FLEET_SUBNET_PREFIX) kept on one shard, balanced by size
+    tag     sensors grouped by the first of SHARD_TAGS they carry (default: their first tag), balanced by size
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+from datetime import datetime
+
+import yaml
+
+import check_ping_sensors
+import sensor_tests
+from fleet_engine import subnet_of
+from inventory import parse_tags, select_sensors
+from negative_cache import sensor_key
+from pipeline import STAGES, build_reports, run_stages
+from state_files import load_json_state, save_json_state
+from state_store import get_state_store, write_diff_yaml
+from tracing import get_tracer
+
+STRATEGIES = ('hash', 'subnet', 'tag')
+
+# Per-sensor JSON state that local shards keep in their own copy and the merge folds back.
+SHARDED_STATE_FILES = {
+    'NEGATIVE_CACHE_PATH': 'state/negative_cache.json',
+    'ROUTE_CACHE_PATH': 'state/route_cache.json',
+    'SENSOR_TIMINGS_PATH': 'state/sensor_timings.json',
+}
+
+
+def stable_hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], 'big')
+
+
+def group_key(sensor: dict, strategy: str) -> str:
+    if strategy == 'subnet':
+        return subnet_of(sensor, int(os.getenv('FLEET_SUBNET_PREFIX', '24')))
+    if strategy == 'tag':
+        tags = parse_tags(sensor)
+        preferred = [tag for tag in os.getenv('SHARD_TAGS', '').split(',') if tag and tag in tags]
+        return (preferred or tags or [sensor_key(sensor)])[0]
+    return sensor_key(sensor)
+
+
+def assign_shards(sensors: list, count: int, strategy: str = None) -> list:
+    """Split sensors into count lists. The split only depends on the inventory, so every host agrees on it.
+
+    hash spreads sensors individually; subnet and tag keep each group on one shard, assigning the largest
+    groups first to the least loaded shard.
+    """
+    strategy = strategy or os.getenv('SHARD_STRATEGY', 'hash')
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown shard strategy {strategy!r}, expected one of {', '.join(STRATEGIES)}")
+    shards = [[] for _ in range(count)]
+    if strategy == 'hash':
+        for sensor in sensors:
+            shards[stable_hash(sensor_key(sensor)) % count].append(sensor)
+        return shards
+    groups = {}
+    for sensor in sensors:
+        groups.setdefault(group_key(sensor, strategy), []).append(sensor)
+    for key, members in sorted(groups.items(), key=lambda item: (-len(item[1]), item[0])):
+        min(shards, key=len).extend(members)
+    return shards
+
+
+def parse_shard(value: str) -> tuple:
+    """Parse 'i/N' into (i, N) with 0 <= i < N."""
+    index, _, count = value.partition('/')
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f"Shard {value!r} is out of range")
+    return index, count
+
+
+def shardable_stages(stages: list) -> list:
+    """Drop the throughput stage: its endpoints are scheduled for the whole fleet, so it cannot be split."""
+    if 'throughput' in stages:
+        logging.error("The throughput stage is not run in sharded runs; run it unsharded")
+    return [stage for stage in stages if stage != 'throughput']
+
+
+def shard_directory(run_dir: str, index: int) -> str:
+    return os.path.join(run_dir, f"shard-{index}")
+
+
+def run_shard(index: int, count: int, run_dir: str, stages: list = None, selector: str = None,
+              strategy: str = None) -> str:
+    """Run the stages on shard index of count and write its streams and manifest; return the manifest path."""
+    stages = shardable_stages(stages or STAGES)
+    strategy = strategy or os.getenv('SHARD_STRATEGY', 'hash')
+    sensors = assign_shards(select_sensors(check_ping_sensors.sensors_file_path, selector), count, strategy)[index]
+    directory = shard_directory(run_dir, index)
+    os.makedirs(directory, exist_ok=True)
+    tests = sensor_tests.load_tests(os.getenv('TESTS_DEFINITIONS_PATH')) if 'tests' in stages else {}
+    logging.info(f"Shard {index}/{count} ({strategy}): {len(sensors)} sensors")
+
+    store = get_state_store()
+    run_id = store.start_run(f"pipeline-shard-{index}")
+    run_stages(sensors, stages, tests, os.path.join(directory, 'ping.jsonl'), os.path.join(directory, 'tests.jsonl'))
+    store.finish_run()
+    diff_path = store.write_diff_report(directory)
+    get_tracer().export(f"pipeline-shard-{index}")
+
+    # State files inside the shard directory are this shard's own copies, to be folded back by the merge.
+    state = {variable: os.path.relpath(os.getenv(variable), directory) for variable in SHARDED_STATE_FILES
+             if os.getenv(variable) and os.path.dirname(os.path.abspath(os.getenv(variable))) ==
+             os.path.abspath(directory)}
+    manifest = {
+        'shard': index, 'shards': count, 'strategy': strategy, 'stages': stages, 'run_id': run_id,
+        'sensors': [sensor_key(sensor) for sensor in sensors], 'ping_stream': 'ping.jsonl',
+        'tests_stream': 'tests.jsonl', 'diff': os.path.basename(diff_path), 'state': state,
+        'finished_at': datetime.now().isoformat(),
+    }
+    manifest_path = os.path.join(directory, 'manifest.json')
+    with open(manifest_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    return manifest_path
+
+
+def concatenate(paths: list, destination: str) -> None:
+    with open(destination, 'wb') as output:
+        for path in paths:
+            if os.path.exists(path):
+                with open(path, 'rb') as stream:
+                    shutil.copyfileobj(stream, output)
+
+
+def merge_state(manifest: dict, directory: str) -> None:
+    """Fold a local shard's copies of the per-sensor state files back into the main ones."""
+    keys = set(manifest['sensors'])
+    for variable, relative_path in manifest['state'].items():
+        main_path = os.getenv(variable, SHARDED_STATE_FILES[variable])
+        entries = load_json_state(main_path)
+        entries.update((key, value) for key, value in load_json_state(os.path.join(directory, relative_path)).items()
+                       if key in keys)
+        save_json_state(main_path, entries)
+
+
+def merge_shards(run_dir: str) -> dict:
+    """Merge the shards of a run directory into one set of reports and return their paths.
+
+    Missing shards are logged and left out, so a report is still produced from the shards that finished.
+    """
+    manifests = []
+    for path in sorted(glob.glob(os.path.join(run_dir, 'shard-*', 'manifest.json'))):
+        with open(path) as file:
+            manifests.append((json.load(file), os.path.dirname(path)))
+    if not manifests:
+        raise ValueError(f"No finished shards in {run_dir}")
+    count = manifests[0][0]['shards']
+    missing = sorted(set(range(count)) - {manifest['shard'] for manifest, _ in manifests})
+    if missing:
+        logging.error(f"Merging {len(manifests)} of {count} shards; shards {missing} did not finish")
+    stages = manifests[0][0]['stages']
+
+    ping_stream = os.path.join(run_dir, 'ping.jsonl')
+    tests_stream = os.path.join(run_dir, 'tests.jsonl')
+    concatenate([os.path.join(directory, manifest['ping_stream']) for manifest, directory in manifests], ping_stream)
+    concatenate([os.path.join(directory, manifest['tests_stream']) for manifest, directory in manifests],
+                tests_stream)
+    for manifest, directory in manifests:
+        merge_state(manifest, directory)
+
+    reports = build_reports(stages, ping_stream, tests_stream, datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    changes = {}
+    for manifest, directory in manifests:
+        with open(os.path.join(directory, manifest['diff'])) as file:
+            changes.update(yaml.safe_load(file).get('changes') or {})
+    reports['diff'] = write_diff_yaml(changes, [manifest['run_id'] for manifest, _ in manifests])
+    logging.info(f"Merged {sum(len(manifest['sensors']) for manifest, _ in manifests)} sensors "
+                 f"from {len(manifests)} shards")
+    return reports
+
+
+def run_local_shards(count: int, stages: list = None, selector: str = None, strategy: str = None,
+                     run_dir: str = None) -> dict:
+    """Run count shards as child processes of this controller, then merge them."""
+    stages = shardable_stages(stages or STAGES)
+    strategy = strategy or os.getenv('SHARD_STRATEGY', 'hash')
+    run_dir = run_dir or os.path.join(os.getenv('SHARD_RUN_DIRECTORY', 'state/shards'),
+                                      datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    main_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    processes = []
+    for index in range(count):
+        directory = shard_directory(run_dir, index)
+        os.makedirs(directory, exist_ok=True)
+        env = dict(os.environ, SHARD_STRATEGY=strategy)
+        for variable, default in SHARDED_STATE_FILES.items():
+            main_path = os.getenv(variable, default)
+            shard_path = os.path.join(directory, os.path.basename(main_path))
+            if os.path.exists(main_path):
+                shutil.copyfile(main_path, shard_path)
+            env[variable] = shard_path
+        command = [sys.executable, main_script, '--shard', f"{index}/{count}", '--run-dir', run_dir,
+                   '--stages', *stages]
+        if selector:
+            command += ['--select', selector]
+        with open(os.path.join(directory, 'shard.log'), 'w') as log:
+            processes.append(subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT))
+    logging.info(f"Started {count} shard processes ({strategy}), logs in {run_dir}/shard-*/shard.log")
+    for index, process in enumerate(processes):
+        if process.wait():
+            logging.error(f"Shard {index} exited with status {process.returncode}")
+    return merge_shards(run_dir)
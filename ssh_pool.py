@@ -0,0 +1,242 @@
+import atexit
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import paramiko
+
+from tracing import span
+
+SSH_PORT = int(os.getenv('SSH_PORT', '22'))
+
+READ_CHUNK_SIZE = 32768
+
+
+class SSHConnectionPool:
+    """Keep one authenticated paramiko Transport per (ip, user) and open a fresh channel per command."""
+
+    def __init__(self, max_connections: int = None, idle_timeout: float = None, connect_timeout: float = None,
+                 keepalive_interval: int = None):
+        # Defaults come from config/.env, which the scripts load before the first command runs.
+        self.max_connections = max_connections or int(os.getenv('SSH_POOL_MAX_CONNECTIONS', '64'))
+        self.idle_timeout = idle_timeout or float(os.getenv('SSH_POOL_IDLE_TIMEOUT', '300'))
+        self.connect_timeout = connect_timeout or float(os.getenv('SSH_CONNECT_TIMEOUT', '30'))
+        self.keepalive_interval = keepalive_interval or int(os.getenv('SSH_KEEPALIVE_INTERVAL', '30'))
+        self.connections_opened = 0
+        self._entries = {}
+        self._connecting = {}
+        self._condition = threading.Condition()
+
+    def _open_transport(self, ip_address: str, username: str, password: str) -> paramiko.Transport:
+        """Run TCP connect, key exchange and password auth for a new transport."""
+        with span('tcp_connect', ip_address):
+            sock = socket.create_connection((ip_address, SSH_PORT), timeout=self.connect_timeout)
+        transport = paramiko.Transport(sock)
+        try:
+            with span('kex', ip_address):
+                transport.start_client(timeout=self.connect_timeout)
+            with span('auth', ip_address):
+                transport.auth_password(username, password)
+        except Exception:
+            transport.close()
+            raise
+        if self.keepalive_interval:
+            transport.set_keepalive(self.keepalive_interval)
+        logging.info(f"Opened SSH transport to {username}@{ip_address}")
+        return transport
+
+    def _evict_one_idle(self) -> bool:
+        """Close the least recently used idle transport. Caller holds the lock."""
+        idle = [(entry['last_used'], key) for key, entry in self._entries.items() if entry['in_use'] == 0]
+        if not idle:
+            return False
+        _, key = min(idle)
+        self._entries.pop(key)['transport'].close()
+        return True
+
+    def close_idle(self) -> None:
+        """Close transports that are dead or have been idle longer than idle_timeout."""
+        now = time.monotonic()
+        with self._condition:
+            for key, entry in list(self._entries.items()):
+                if entry['in_use']:
+                    continue
+                if not entry['transport'].is_active() or now - entry['last_used'] > self.idle_timeout:
+                    self._entries.pop(key)['transport'].close()
+            self._condition.notify_all()
+
+    def acquire(self, ip_address: str, username: str, password: str) -> paramiko.Transport:
+        """Return a live transport for (ip, user), connecting if needed, and mark it in use."""
+        key = (ip_address, username)
+        self.close_idle()
+        deadline = time.monotonic() + self.connect_timeout
+        with self._condition:
+            while True:
+                entry = self._entries.get(key)
+                if entry and entry['transport'].is_active():
+                    entry['in_use'] += 1
+                    entry['last_used'] = time.monotonic()
+                    return entry['transport']
+                if entry:
+                    self._entries.pop(key)['transport'].close()
+                if key not in self._connecting:
+                    open_count = len(self._entries) + len(self._connecting)
+                    if open_count < self.max_connections or self._evict_one_idle():
+                        self._connecting[key] = True
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise paramiko.SSHException(f"Timed out waiting for a pooled connection to {ip_address}")
+                self._condition.wait(remaining)
+
+        try:
+            transport = self._open_transport(ip_address, username, password)
+        finally:
+            with self._condition:
+                self._connecting.pop(key, None)
+                self._condition.notify_all()
+        with self._condition:
+            self._entries[key] = {'transport': transport, 'in_use': 1, 'last_used': time.monotonic()}
+            self.connections_opened += 1
+        return transport
+
+    def release(self, ip_address: str, username: str) -> None:
+        """Return a transport acquired with acquire() to the pool."""
+        with self._condition:
+            entry = self._entries.get((ip_address, username))
+            if entry:
+                entry['in_use'] = max(0, entry['in_use'] - 1)
+                entry['last_used'] = time.monotonic()
+            self._condition.notify_all()
+
+    def discard(self, ip_address: str, username: str) -> None:
+        """Drop and close the transport for (ip, user), e.g. after it failed mid-command."""
+        with self._condition:
+            entry = self._entries.pop((ip_address, username), None)
+            self._condition.notify_all()
+        if entry:
+            entry['transport'].close()
+
+    def close_all(self) -> None:
+        with self._condition:
+            entries, self._entries = self._entries, {}
+            self._condition.notify_all()
+        for entry in entries.values():
+            entry['transport'].close()
+
+    def open_channel(self, ip_address: str, username: str, password: str) -> paramiko.Channel:
+        """Open a session channel on the pooled transport, reconnecting once if the transport went stale."""
+        for attempt in range(2):
+            transport = self.acquire(ip_address, username, password)
+            try:
+                return transport.open_session(timeout=self.connect_timeout)
+            except (paramiko.SSHException, EOFError, OSError):
+                self.release(ip_address, username)
+                self.discard(ip_address, username)
+                if attempt:
+                    raise
+        raise paramiko.SSHException(f"Could not open a channel to {ip_address}")
+
+    @contextmanager
+    def sftp(self, ip_address: str, username: str, password: str):
+        """Yield an SFTP client running on a channel of the pooled transport."""
+        channel = self.open_channel(ip_address, username, password)
+        try:
+            channel.invoke_subsystem('sftp')
+            client = paramiko.SFTPClient(channel)
+            yield client
+            client.close()
+        except (paramiko.SSHException, EOFError):
+            # A refused subsystem leaves the transport usable; only drop it when the connection itself died.
+            if not channel.get_transport().is_active():
+                self.discard(ip_address, username)
+            raise
+        finally:
+            channel.close()
+            self.release(ip_address, username)
+
+    def exec_command(self, ip_address: str, username: str, password: str, command: str,
+                     timeout: float = None, stdin_data: bytes = None, stdout_capture=None,
+                     stderr_capture=None) -> tuple:
+        """Run a command on a fresh channel and return (exit_status, stdout, stderr).
+
+        A capture object (write(bytes) and finish() -> str, see output_capture) replaces the default of
+        reading a stream fully into memory; the stream's result is then whatever finish() returns.
+        """
+        channel = self.open_channel(ip_address, username, password)
+        try:
+            with span('exec', ip_address):
+                channel.exec_command(command)
+                if stdin_data is not None:
+                    channel.sendall(stdin_data)
+                    channel.shutdown_write()
+            if stdout_capture or stderr_capture:
+                stdout_capture, stderr_capture = stdout_capture or FullCapture(), stderr_capture or FullCapture()
+                with span('read', ip_address):
+                    pump_channel(channel, stdout_capture.write, stderr_capture.write, timeout)
+                return channel.recv_exit_status(), stdout_capture.finish(), stderr_capture.finish()
+            with span('read', ip_address):
+                stdout, stderr = read_channel(channel, timeout)
+            return channel.recv_exit_status(), stdout.decode(errors='replace'), stderr.decode(errors='replace')
+        except socket.timeout:
+            raise
+        except (paramiko.SSHException, EOFError, OSError):
+            self.discard(ip_address, username)
+            raise
+        finally:
+            channel.close()
+            self.release(ip_address, username)
+
+
+class FullCapture:
+    """Capture that keeps a whole stream in memory, matching exec_command's default."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, chunk: bytes) -> None:
+        self._chunks.append(chunk)
+
+    def finish(self) -> str:
+        return b''.join(self._chunks).decode(errors='replace')
+
+
+def read_channel(channel: paramiko.Channel, timeout: float = None) -> tuple:
+    """Read stdout and stderr of a channel together until EOF, so neither stream can stall the other."""
+    stdout_chunks, stderr_chunks = [], []
+    pump_channel(channel, stdout_chunks.append, stderr_chunks.append, timeout)
+    return b''.join(stdout_chunks), b''.join(stderr_chunks)
+
+
+def pump_channel(channel: paramiko.Channel, on_stdout, on_stderr, timeout: float = None) -> None:
+    """Hand stdout and stderr chunks to the callbacks as they arrive until EOF."""
+    deadline = time.monotonic() + timeout if timeout else None
+    while not (channel.eof_received or channel.closed) or channel.recv_ready() or channel.recv_stderr_ready():
+        wait = None if deadline is None else deadline - time.monotonic()
+        if wait is not None and wait <= 0:
+            raise socket.timeout(f"Command did not finish within {timeout}s")
+        readable, _, _ = select.select([channel], [], [], wait)
+        if not readable:
+            continue
+        if channel.recv_ready():
+            on_stdout(channel.recv(READ_CHUNK_SIZE))
+        if channel.recv_stderr_ready():
+            on_stderr(channel.recv_stderr(READ_CHUNK_SIZE))
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_ssh_pool() -> SSHConnectionPool:
+    """Return the process-wide pool shared by every script's run_ssh_command."""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = SSHConnectionPool()
+            atexit.register(_shared_pool.close_all)
+        return _shared_pool
@@ -0,0 +1,257 @@
+"""Remote execution backends behind every script's SSH commands.
+
+SSH_TRANSPORT selects the backend:
+    paramiko  pooled paramiko transports (ssh_pool), the default
+    openssh   the system ssh client; one ControlMaster per sensor does the key exchange and crypto in C, every
+              command runs as a multiplexed session on it, and ControlPersist keeps it warm between commands
+              and between runs
+
+Both backends have the same interface (exec_command, sftp, discard, close_all, connections_opened) and return
+the same results, so they can be swapped and benchmarked against each other.
+"""
+import logging
+import os
+import selectors
+import shlex
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import paramiko
+
+from ssh_pool import READ_CHUNK_SIZE, SSH_PORT, FullCapture, get_ssh_pool
+from tracing import span
+
+TRANSPORTS = ('paramiko', 'openssh')
+
+# AES-GCM and ChaCha20 run on hardware or vector code in OpenSSH; the rest are fallbacks for old sensors.
+DEFAULT_CIPHERS = 'aes128-gcm@openssh.com,chacha20-poly1305@openssh.com,aes128-ctr,aes256-ctr'
+DEFAULT_KEX_ALGORITHMS = ('curve25519-sha256,curve25519-sha256@libssh.org,ecdh-sha2-nistp256,'
+                          'diffie-hellman-group14-sha256')
+
+# ssh's exit status for its own errors, as opposed to the remote command's.
+SSH_ERROR_STATUS = 255
+
+ASKPASS_SCRIPT = '#!/bin/sh\nprintf \'%s\\n\' "$SENSORZ_SSH_PASSWORD"\n'
+
+
+class TransportError(paramiko.SSHException):
+    """The system ssh client could not connect to or stay connected to a sensor."""
+
+
+class OpenSSHTransport:
+    """Run commands with the system ssh client over one ControlMaster socket per (ip, user).
+
+    The master authenticates with the sensor's password through an askpass helper (or with SSH_IDENTITY_FILE);
+    commands never authenticate themselves, they only attach to the master.
+    """
+
+    def __init__(self, control_directory: str = None, idle_timeout: float = None, connect_timeout: float = None,
+                 keepalive_interval: int = None, max_connections: int = None):
+        self.control_directory = os.path.abspath(control_directory or os.getenv('SSH_CONTROL_DIR', 'state/ssh'))
+        self.idle_timeout = idle_timeout or float(os.getenv('SSH_POOL_IDLE_TIMEOUT', '300'))
+        self.connect_timeout = connect_timeout or float(os.getenv('SSH_CONNECT_TIMEOUT', '30'))
+        self.keepalive_interval = keepalive_interval or int(os.getenv('SSH_KEEPALIVE_INTERVAL', '30'))
+        # Masters are separate processes that expire on their own; the limit is kept for interface parity.
+        self.max_connections = max_connections or int(os.getenv('SSH_POOL_MAX_CONNECTIONS', '64'))
+        self.known_hosts = os.getenv('SSH_KNOWN_HOSTS', os.path.join(self.control_directory, 'known_hosts'))
+        self.host_key_checking = os.getenv('SSH_STRICT_HOST_KEY_CHECKING', 'accept-new')
+        self.ciphers = os.getenv('SSH_CIPHERS', DEFAULT_CIPHERS)
+        self.kex_algorithms = os.getenv('SSH_KEX_ALGORITHMS', DEFAULT_KEX_ALGORITHMS)
+        self.connections_opened = 0
+        self._masters = {}
+        self._connecting = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.control_directory, mode=0o700, exist_ok=True)
+        self.askpass = os.path.join(self.control_directory, 'askpass')
+        if not os.path.exists(self.askpass):
+            with open(self.askpass, 'w', newline='\n') as file:
+                file.write(ASKPASS_SCRIPT)
+            os.chmod(self.askpass, 0o700)
+
+    def ssh_options(self, username: str) -> list:
+        """Options shared by the master, its commands and sftp."""
+        options = {
+            'User': username,
+            'ControlPath': os.path.join(self.control_directory, '%C'),
+            'ConnectTimeout': int(self.connect_timeout),
+            'ServerAliveInterval': self.keepalive_interval,
+            'Ciphers': self.ciphers,
+            'KexAlgorithms': self.kex_algorithms,
+            'Compression': 'no',
+            'StrictHostKeyChecking': self.host_key_checking,
+            'UserKnownHostsFile': self.known_hosts,
+            'LogLevel': 'ERROR',
+        }
+        arguments = [argument for name, value in options.items() for argument in ('-o', f"{name}={value}")]
+        if os.getenv('SSH_IDENTITY_FILE'):
+            arguments += ['-i', os.getenv('SSH_IDENTITY_FILE')]
+        return arguments + shlex.split(os.getenv('SSH_EXTRA_OPTIONS', ''))
+
+    def ssh_command(self, ip_address: str, username: str, *arguments) -> list:
+        return ['ssh', '-T', '-p', str(SSH_PORT), *self.ssh_options(username), *arguments, ip_address]
+
+    def control(self, ip_address: str, username: str, operation: str) -> bool:
+        """Send a control command (check, exit) to the master for (ip, user); return True if it succeeded."""
+        result = subprocess.run(self.ssh_command(ip_address, username, '-O', operation), stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=self.connect_timeout)
+        return result.returncode == 0
+
+    def _start_master(self, ip_address: str, username: str, password: str) -> None:
+        """Connect, authenticate and leave a persistent master in the background."""
+        command = self.ssh_command(ip_address, username, '-f', '-N', '-o', 'ControlMaster=yes',
+                                   '-o', f"ControlPersist={int(self.idle_timeout)}", '-o', 'NumberOfPasswordPrompts=1')
+        env = dict(os.environ, SSH_ASKPASS=self.askpass, SSH_ASKPASS_REQUIRE='force',
+                   DISPLAY=os.getenv('DISPLAY', ':0'), SENSORZ_SSH_PASSWORD=password or '')
+        # The backgrounded master inherits stderr, so it goes to a file rather than a pipe nobody closes.
+        with tempfile.TemporaryFile() as errors, span('connect', ip_address):
+            try:
+                result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=errors,
+                                        env=env, timeout=2 * self.connect_timeout, start_new_session=True)
+            except subprocess.TimeoutExpired:
+                raise TransportError(f"Timed out connecting to {username}@{ip_address}")
+            if result.returncode:
+                errors.seek(0)
+                message = errors.read().decode(errors='replace').strip() or f"ssh exited with {result.returncode}"
+                raise TransportError(f"Could not connect to {username}@{ip_address}: {message}")
+        logging.info(f"Opened SSH master to {username}@{ip_address}")
+
+    def acquire(self, ip_address: str, username: str, password: str) -> None:
+        """Make sure a master for (ip, user) is running, reusing one left by an earlier command or run."""
+        key = (ip_address, username)
+        with self._lock:
+            connecting = self._connecting.setdefault(key, threading.Lock())
+        with connecting:
+            last_used = self._masters.get(key)
+            # A master used within its ControlPersist window is still up; older ones are checked first.
+            if last_used is None or time.monotonic() - last_used > self.idle_timeout / 2:
+                if not self.control(ip_address, username, 'check'):
+                    self._start_master(ip_address, username, password)
+                    with self._lock:
+                        self.connections_opened += 1
+            self._masters[key] = time.monotonic()
+
+    def discard(self, ip_address: str, username: str) -> None:
+        """Stop the master for (ip, user), ending every command still running on it."""
+        if self._masters.pop((ip_address, username), None) is not None:
+            try:
+                self.control(ip_address, username, 'exit')
+            except subprocess.TimeoutExpired:
+                logging.error(f"SSH master to {username}@{ip_address} did not exit")
+
+    def close_all(self) -> None:
+        for ip_address, username in list(self._masters):
+            self.discard(ip_address, username)
+
+    def exec_command(self, ip_address: str, username: str, password: str, command: str,
+                     timeout: float = None, stdin_data: bytes = None, stdout_capture=None,
+                     stderr_capture=None) -> tuple:
+        """Run a command as a session on the sensor's master and return (exit_status, stdout, stderr).
+
+        Same contract as SSHConnectionPool.exec_command, including the capture objects.
+        """
+        self.acquire(ip_address, username, password)
+        stdout_capture, stderr_capture = stdout_capture or FullCapture(), stderr_capture or FullCapture()
+        arguments = self.ssh_command(ip_address, username, '-o', 'ControlMaster=no', '-o', 'BatchMode=yes')
+        with span('exec', ip_address):
+            process = subprocess.Popen(arguments + [command], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                       stdin=subprocess.PIPE if stdin_data is not None else subprocess.DEVNULL)
+        try:
+            with span('read', ip_address):
+                pump_process(process, stdin_data, stdout_capture.write, stderr_capture.write, timeout)
+            exit_status = process.wait()
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        stdout, stderr = stdout_capture.finish(), stderr_capture.finish()
+        if exit_status == SSH_ERROR_STATUS and not self.control(ip_address, username, 'check'):
+            self._masters.pop((ip_address, username), None)
+            raise TransportError(f"Lost the SSH master to {username}@{ip_address}: {stderr.strip()}")
+        return exit_status, stdout, stderr
+
+    @contextmanager
+    def sftp(self, ip_address: str, username: str, password: str):
+        """Yield an object with put(local_path, remote_path) that copies files over the sensor's master."""
+        self.acquire(ip_address, username, password)
+        yield OpenSSHSftp(self, ip_address, username)
+
+
+class OpenSSHSftp:
+    """The put() subset of paramiko's SFTPClient, run by the system sftp client over a master."""
+
+    def __init__(self, transport: OpenSSHTransport, ip_address: str, username: str):
+        self.transport = transport
+        self.ip_address = ip_address
+        self.username = username
+
+    def put(self, local_path: str, remote_path: str, callback=None) -> None:
+        if callback:
+            # sftp reports no progress, so the whole file is charged before it is sent.
+            callback(os.path.getsize(local_path), os.path.getsize(local_path))
+        command = ['sftp', '-q', '-b', '-', '-P', str(SSH_PORT), *self.transport.ssh_options(self.username),
+                   '-o', 'ControlMaster=no', self.ip_address]
+        batch = f'put "{local_path}" "{remote_path}"\n'.encode()
+        result = subprocess.run(command, input=batch, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode:
+            raise TransportError(f"sftp put {remote_path} to {self.ip_address} failed: "
+                                 f"{result.stderr.decode(errors='replace').strip()}")
+
+
+def pump_process(process: subprocess.Popen, stdin_data: bytes, on_stdout, on_stderr, timeout: float = None) -> None:
+    """Feed stdin_data and hand stdout and stderr chunks to the callbacks until both reach EOF.
+
+    Raises socket.timeout like ssh_pool.pump_channel when the command runs past timeout.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ, on_stdout)
+    selector.register(process.stderr, selectors.EVENT_READ, on_stderr)
+    pending = memoryview(stdin_data or b'')
+    if stdin_data is not None:
+        os.set_blocking(process.stdin.fileno(), False)
+        selector.register(process.stdin, selectors.EVENT_WRITE)
+    try:
+        while selector.get_map():
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                raise socket.timeout(f"Command did not finish within {timeout}s")
+            for key, _ in selector.select(wait):
+                if key.fileobj is process.stdin:
+                    try:
+                        pending = pending[os.write(key.fd, pending[:READ_CHUNK_SIZE]):]
+                    except BrokenPipeError:
+                        pending = pending[:0]
+                    if not pending:
+                        selector.unregister(process.stdin)
+                        process.stdin.close()
+                    continue
+                chunk = os.read(key.fd, READ_CHUNK_SIZE)
+                if chunk:
+                    key.data(chunk)
+                else:
+                    selector.unregister(key.fileobj)
+    finally:
+        selector.close()
+        for stream in (process.stdin, process.stdout, process.stderr):
+            if stream:
+                stream.close()
+
+
+_shared_transport = None
+_shared_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """Return the process-wide backend selected by SSH_TRANSPORT."""
+    global _shared_transport
+    with _shared_transport_lock:
+        if _shared_transport is None:
+            name = os.getenv('SSH_TRANSPORT', 'paramiko')
+            if name not in TRANSPORTS:
+                raise ValueError(f"Unknown SSH transport {name!r}, expected one of {', '.join(TRANSPORTS)}")
+            _shared_transport = OpenSSHTransport() if name == 'openssh' else get_ssh_pool()
+        return _shared_transport
@@ -0,0 +1,33 @@
+import json
+import logging
+import os
+
+
+def load_json_state(path: str) -> dict:
+    """Load a JSON state file, treating a missing or corrupt file as empty."""
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.error(f"Ignoring unreadable state file {path}: {e}")
+        return {}
+
+
+def save_json_state(path: str, data: dict, mode: int = None) -> None:
+    """Atomically replace a JSON state file so a crash never leaves it half written.
+
+    With a mode (e.g. 0o600 for files holding credentials) the file is created with those permissions.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    if mode is None:
+        file = open(temp_path, 'w')
+    else:
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        os.fchmod(descriptor, mode)
+        file = os.fdopen(descriptor, 'w')
+    with file:
+        json.dump(data, file, indent=2)
+    os.replace(temp_path, path)
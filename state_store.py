@@ -0,0 +1,222 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import yaml
+
+from negative_cache import sensor_key
+
+# Seconds a fact stays fresh before an incremental run re-checks it. None never expires.
+FACT_TTLS = {
+    'ip': 6 * 3600,
+    'package_manager': 30 * 24 * 3600,
+    'tools': 7 * 24 * 3600,
+    'upgradable': 24 * 3600,
+    'ping': 24 * 3600,
+    'tests': 24 * 3600,
+    'inventory': None,
+}
+
+# How a fact's value is compared in the diff report; facts not listed are compared as is.
+DIFF_VIEWS = {
+    'ping': lambda value: (value or {}).get('ping_status'),
+    'tests': lambda value: {f"{category}/{test['test_name']}": test['status']
+                            for category, tests in (value or {}).get('result', {}).get('results', {}).items()
+                            for test in tests},
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS facts (
+    sensor TEXT NOT NULL,
+    fact TEXT NOT NULL,
+    value TEXT,
+    ok INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    expires_at REAL,
+    run_id INTEGER,
+    PRIMARY KEY (sensor, fact)
+);
+CREATE TABLE IF NOT EXISTS fact_history (
+    run_id INTEGER NOT NULL,
+    sensor TEXT NOT NULL,
+    fact TEXT NOT NULL,
+    value TEXT,
+    ok INTEGER NOT NULL,
+    PRIMARY KEY (run_id, sensor, fact)
+);
+"""
+
+
+def fact_ttl(fact: str) -> float:
+    override = os.getenv(f"STATE_TTL_{fact.upper()}")
+    return float(override) if override else FACT_TTLS.get(fact, 24 * 3600)
+
+
+def incremental_mode() -> bool:
+    """True when runs should only re-check stale, failed or changed sensors (INCREMENTAL=1)."""
+    return os.getenv('INCREMENTAL', '').lower() in ('1', 'true', 'yes')
+
+
+def fingerprint(data) -> str:
+    """Stable hash of JSON-like data, used to notice changed inventory entries and test definitions."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class StateStore:
+    """SQLite store of per-sensor facts with a TTL each, plus the values every run recorded.
+
+    Facts are keyed by sensor hostname. A fact is fresh while it has not expired and its last check
+    succeeded. Every value written during a run is also kept in fact_history, which the diff report
+    compares against the latest earlier value of the same fact.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv('STATE_DB_PATH', 'state/sensor_state.db')
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        # Shard processes of a sharded run write to the same database; wait for each other's commits.
+        self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self.run_id = None
+
+    def start_run(self, name: str) -> int:
+        with self._lock, self._db:
+            self.run_id = self._db.execute('INSERT INTO runs (name, started_at) VALUES (?, ?)',
+                                           (name, time.time())).lastrowid
+        return self.run_id
+
+    def finish_run(self) -> None:
+        if self.run_id is None:
+            return
+        with self._lock, self._db:
+            self._db.execute('UPDATE runs SET finished_at = ? WHERE id = ?', (time.time(), self.run_id))
+
+    def set(self, sensor: dict, fact: str, value, ok: bool = True, ttl: float = None) -> None:
+        ttl = fact_ttl(fact) if ttl is None else ttl
+        now = time.time()
+        row = (sensor_key(sensor), fact, json.dumps(value, default=str), int(ok))
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO facts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             row + (now, None if ttl is None else now + ttl, self.run_id))
+            if self.run_id is not None:
+                self._db.execute('INSERT OR REPLACE INTO fact_history VALUES (?, ?, ?, ?, ?)', (self.run_id,) + row)
+
+    def fact(self, sensor: dict, fact: str) -> dict:
+        """Return {'value', 'ok', 'updated_at', 'expires_at'} for a fact, or None if it was never recorded."""
+        with self._lock:
+            row = self._db.execute('SELECT value, ok, updated_at, expires_at FROM facts WHERE sensor = ? AND fact = ?',
+                                   (sensor_key(sensor), fact)).fetchone()
+        if not row:
+            return None
+        return {'value': json.loads(row[0]), 'ok': bool(row[1]), 'updated_at': row[2], 'expires_at': row[3]}
+
+    def get(self, sensor: dict, fact: str, include_stale: bool = False):
+        """Return a fact's value if it is fresh (or at all with include_stale), else None."""
+        entry = self.fact(sensor, fact)
+        if not entry or not (include_stale or self._fresh(entry)):
+            return None
+        return entry['value']
+
+    @staticmethod
+    def _fresh(entry: dict) -> bool:
+        return entry['ok'] and (entry['expires_at'] is None or entry['expires_at'] > time.time())
+
+    def is_fresh(self, sensor: dict, fact: str) -> bool:
+        entry = self.fact(sensor, fact)
+        return bool(entry) and self._fresh(entry)
+
+    def inventory_changed(self, sensor: dict) -> bool:
+        return self.get(sensor, 'inventory', include_stale=True) != fingerprint(sensor)
+
+    def record_inventory(self, sensor: dict) -> None:
+        self.set(sensor, 'inventory', fingerprint(sensor))
+
+    def needs_check(self, sensor: dict, facts: list) -> bool:
+        """A sensor needs checking if its inventory entry changed or any of the facts is missing, stale or failed."""
+        return self.inventory_changed(sensor) or not all(self.is_fresh(sensor, fact) for fact in facts)
+
+    def plan(self, sensors: list, facts: list) -> tuple:
+        """Split sensors into (to_check, fresh) for an incremental run."""
+        to_check, fresh = [], []
+        for sensor in sensors:
+            (to_check if self.needs_check(sensor, facts) else fresh).append(sensor)
+        logging.info(f"Incremental run: {len(to_check)} sensors to check, {len(fresh)} unchanged")
+        return to_check, fresh
+
+    def diff(self, run_id: int = None) -> list:
+        """Return the facts a run changed as [{'sensor', 'fact', 'before', 'after'}].
+
+        'before' is the latest value recorded by any earlier run, so sensors an incremental run skipped
+        are compared against the run that last checked them.
+        """
+        run_id = run_id or self.run_id
+        with self._lock:
+            rows = self._db.execute(
+                """SELECT current.sensor, current.fact, current.value, current.ok,
+                          (SELECT previous.value FROM fact_history previous
+                           WHERE previous.sensor = current.sensor AND previous.fact = current.fact
+                             AND previous.run_id < current.run_id ORDER BY previous.run_id DESC LIMIT 1)
+                   FROM fact_history current WHERE current.run_id = ? AND current.fact != 'inventory'
+                   ORDER BY current.sensor, current.fact""", (run_id,)).fetchall()
+        changes = []
+        for sensor, fact, value, ok, previous in rows:
+            view = DIFF_VIEWS.get(fact, lambda fact_value: fact_value)
+            after = view(json.loads(value))
+            before = view(json.loads(previous)) if previous is not None else None
+            if before == after:
+                continue
+            if isinstance(before, dict) and isinstance(after, dict):
+                keys = sorted(key for key in set(before) | set(after) if before.get(key) != after.get(key))
+                before = {key: before.get(key) for key in keys}
+                after = {key: after.get(key) for key in keys}
+            changes.append({'sensor': sensor, 'fact': fact, 'before': before, 'after': after, 'ok': bool(ok)})
+        return changes
+
+    def write_diff_report(self, directory: str = None) -> str:
+        """Write this run's changes as YAML grouped by sensor and return the report path."""
+        report = {}
+        for change in self.diff():
+            report.setdefault(change.pop('sensor'), []).append(change)
+        return write_diff_yaml(report, self.run_id, directory)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def write_diff_yaml(changes: dict, run_id, directory: str = None) -> str:
+    """Write {sensor: [changes]} as a State_Diff report and return its path."""
+    directory = directory or os.getenv('STATE_DIFF_DIRECTORY', 'state/diffs')
+    os.makedirs(directory, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    report_path = os.path.join(directory, f"State_Diff_{timestamp}.yaml")
+    with open(report_path, 'w') as file:
+        yaml.safe_dump({'run_id': run_id, 'changed_sensors': len(changes), 'changes': changes}, file)
+    logging.info(f"{sum(len(sensor_changes) for sensor_changes in changes.values())} changed facts on "
+                 f"{len(changes)} sensors since the previous run, diff saved to {report_path}")
+    return report_path
+
+
+_shared_store = None
+_shared_store_lock = threading.Lock()
+
+
+def get_state_store() -> StateStore:
+    global _shared_store
+    with _shared_store_lock:
+        if _shared_store is None:
+            _shared_store = StateStore()
+        return _shared_store
@@ -0,0 +1,250 @@
+"""Coordinated iperf3 uplink/downlink throughput tests.
+
+Every client sensor runs an uplink test (the sensor sends) and a downlink test (-R, the server sends)
+against an iperf3 server endpoint. An iperf3 server runs one test at a time, so an endpoint is a
+(host, port) pair and a server carries IPERF_SERVER_CAPACITY tests at once on consecutive ports from
+IPERF_PORT.
+
+Servers are the IPERF_SERVERS hosts ("controller" is the controller itself, as the sensors reach it at
+IPERF_CONTROLLER_ADDRESS) plus the sensors tagged IPERF_SERVER_TAG, which get their iperf3 servers started
+over SSH and are not tested themselves. With IPERF_LOCAL_SERVER=1 the controller runs its own iperf3
+servers for the duration of the stage.
+
+Tests run in time slots: in a slot every endpoint carries at most one test and every link class at most
+its IPERF_LINK_CAPACITY ("class=count,...", see link_throttle). plan_slots() reaches the fewest slots the
+limits allow.
+"""
+import json
+import logging
+import math
+import os
+import shlex
+import subprocess
+import time
+from contextlib import contextmanager, nullcontext
+
+import yaml
+
+import sensor_tests
+from fleet_engine import run_fleet
+from inventory import parse_tags
+from link_throttle import link_class, parse_limits
+from negative_cache import sensor_key
+from output_capture import capture_command
+from result_stream import ResultSink, iter_results, write_grouped_yaml
+
+DIRECTIONS = (('uplink', ''), ('downlink', ' -R'))
+
+DEFAULT_LINK_CAPACITY = {'cell': 1, 'openvpn': 2}
+
+# Seconds allowed on top of the test duration for connecting and the JSON summary.
+IPERF_MARGIN = 30
+
+
+def link_capacity() -> dict:
+    """Throughput tests each link class may carry at once; classes without a limit are only bound by servers."""
+    return parse_limits(os.getenv('IPERF_LINK_CAPACITY', ''), DEFAULT_LINK_CAPACITY)
+
+
+def server_ports() -> list:
+    port = int(os.getenv('IPERF_PORT', '5201'))
+    return list(range(port, port + int(os.getenv('IPERF_SERVER_CAPACITY', '4'))))
+
+
+def is_server_sensor(sensor: dict) -> bool:
+    return os.getenv('IPERF_SERVER_TAG', 'iperf-server') in parse_tags(sensor)
+
+
+def server_endpoints(server_sensors: list) -> list:
+    """Return the (host, port) endpoints, interleaved across servers so a partly filled slot spreads out."""
+    hosts = []
+    for host in filter(None, (host.strip() for host in os.getenv('IPERF_SERVERS', '').split(','))):
+        if host == 'controller':
+            host = os.getenv('IPERF_CONTROLLER_ADDRESS')
+            if not host:
+                logging.error("IPERF_SERVERS lists the controller but IPERF_CONTROLLER_ADDRESS is not set")
+                continue
+        hosts.append(host)
+    hosts.extend(sensor['ip_address_sensor'] for sensor in server_sensors)
+    return [(host, port) for port in server_ports() for host in hosts]
+
+
+def plan_slots(clients: list, endpoint_count: int, capacity: dict) -> list:
+    """Split the clients into the fewest time slots that keep every endpoint and link class within its limit.
+
+    The slot count is the larger of the clients per endpoint and, for every limited link class, its sensors
+    per allowed test. Dealing the clients, grouped by link class, round-robin over that many slots never puts
+    more than that share of a group or of the fleet into one slot, so the lower bound is always reached.
+    """
+    if not clients or not endpoint_count:
+        return []
+    groups = {}
+    for sensor in clients:
+        groups.setdefault(link_class(sensor), []).append(sensor)
+    count = max([math.ceil(len(clients) / endpoint_count)] +
+                [math.ceil(len(members) / int(capacity[name])) for name, members in groups.items()
+                 if capacity.get(name)])
+    slots = [[] for _ in range(count)]
+    ordered = [sensor for _, members in sorted(groups.items(), key=lambda item: (-len(item[1]), item[0]))
+               for sensor in members]
+    for index, sensor in enumerate(ordered):
+        slots[index % count].append(sensor)
+    return slots
+
+
+def parse_iperf_json(output: str) -> dict:
+    """Summarise an `iperf3 --json` run: receiver-side Mbit/s, sender Mbit/s and retransmits, or its error."""
+    try:
+        data = json.loads(output)
+    except ValueError:
+        return {'error': (output.strip() or 'no output')[:200]}
+    if data.get('error'):
+        return {'error': data['error']}
+    end = data.get('end', {})
+    sent, received = end.get('sum_sent', {}), end.get('sum_received', {})
+    return {
+        'mbps': round(received.get('bits_per_second', 0) / 1e6, 2),
+        'sent_mbps': round(sent.get('bits_per_second', 0) / 1e6, 2),
+        'retransmits': sent.get('retransmits'),
+        'seconds': round(received.get('seconds', 0), 2),
+    }
+
+
+def run_iperf(sensor: dict, password: str, host: str, port: int, duration: int, flag: str) -> dict:
+    """Run one iperf3 client test from the sensor, retrying while the endpoint is still busy."""
+    command = f"iperf3 -c {shlex.quote(host)} -p {port} -t {duration} -J{flag} {os.getenv('IPERF_OPTIONS', '')}"
+    for attempt in range(int(os.getenv('IPERF_BUSY_RETRIES', '3')) + 1):
+        # The JSON is parsed, so it is kept whole rather than truncated.
+        _, stdout, stderr = capture_command(sensor['ip_address_sensor'], sensor['username_sensorz'], password,
+                                            command.strip(), timeout=duration + IPERF_MARGIN, bounded=False)
+        result = parse_iperf_json(stdout or stderr)
+        if 'busy' not in result.get('error', ''):
+            break
+        time.sleep(1 + attempt)
+    return result
+
+
+def run_throughput_test(sensor: dict, assignment: dict, duration: int) -> dict:
+    """Run the sensor's uplink and then its downlink test against its endpoint in this slot."""
+    host, port = assignment[sensor_key(sensor)]
+    password = sensor.get('Password_sensorz') or os.getenv('PASSWORD_SENSORZ')
+    result = {'hostname': sensor.get('hostname', 'Unknown'), 'ip': sensor['ip_address_sensor'],
+              'link': link_class(sensor), 'server': f"{host}:{port}"}
+    for direction, flag in DIRECTIONS:
+        result[direction] = run_iperf(sensor, password, host, port, duration, flag)
+    return result
+
+
+def throughput_passed(result: dict) -> bool:
+    minimums = {'uplink': float(os.getenv('IPERF_MIN_UPLINK_MBPS', '0')),
+                'downlink': float(os.getenv('IPERF_MIN_DOWNLINK_MBPS', '0'))}
+    return all('error' not in result[direction] and result[direction]['mbps'] > 0 and
+               result[direction]['mbps'] >= minimums[direction] for direction, _ in DIRECTIONS)
+
+
+@contextmanager
+def local_servers(ports: list):
+    """Run iperf3 servers on the controller for the duration of the block."""
+    processes = [subprocess.Popen(['iperf3', '-s', '-p', str(port)], stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL) for port in ports]
+    try:
+        yield
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+@contextmanager
+def sensor_servers(server_sensors: list, ports: list):
+    """Start iperf3 servers as daemons on the server sensors and stop them afterwards."""
+    def run(sensor, command):
+        password = sensor.get('Password_sensorz') or os.getenv('PASSWORD_SENSORZ')
+        capture_command(sensor['ip_address_sensor'], sensor['username_sensorz'], password, command, timeout=30)
+
+    pidfiles = [f"/tmp/sensorz-iperf3-{port}.pid" for port in ports]
+    start = '; '.join(f"iperf3 -s -D -p {port} -I {pidfile}" for port, pidfile in zip(ports, pidfiles))
+    stop = '; '.join(f"kill $(cat {pidfile}) 2>/dev/null; rm -f {pidfile}" for pidfile in pidfiles)
+    for sensor in server_sensors:
+        run(sensor, start)
+    try:
+        yield
+    finally:
+        for sensor in server_sensors:
+            try:
+                run(sensor, stop)
+            except Exception as e:
+                logging.error(f"Could not stop the iperf3 servers on {sensor['ip_address_sensor']}: {e}")
+
+
+def failed_entry(sensor: dict, error: str) -> dict:
+    return {'hostname': sensor.get('hostname', 'Unknown'), 'ip': sensor['ip_address_sensor'],
+            'link': link_class(sensor), 'uplink': {'error': error}, 'downlink': {'error': error}}
+
+
+def run_throughput_stage(sensors: list, stream_path: str, duration: int = None) -> dict:
+    """Test every reachable sensor slot by slot and append the results to stream_path; return the schedule."""
+    duration = duration or int(os.getenv('IPERF_DURATION', '10'))
+    server_sensors = [sensor for sensor in sensors if is_server_sensor(sensor)]
+    clients = [sensor for sensor in sensors if not is_server_sensor(sensor)]
+    endpoints = server_endpoints(server_sensors)
+    slots = plan_slots(clients, len(endpoints), link_capacity())
+    schedule = {'endpoints': [f"{host}:{port}" for host, port in endpoints], 'slots': len(slots),
+                'slot_sizes': [len(slot) for slot in slots], 'duration': duration}
+    logging.info(f"Throughput: {len(clients)} sensors in {len(slots)} slots over {len(endpoints)} endpoints")
+
+    with ResultSink(stream_path) as sink:
+        def write(result):
+            sink.write({'group': 'Passed' if throughput_passed(result) else 'Failed', 'result': result})
+
+        if not endpoints:
+            for sensor in clients:
+                write(failed_entry(sensor, 'No iperf3 server endpoints configured'))
+            return schedule
+        local = local_servers(server_ports()) if os.getenv('IPERF_LOCAL_SERVER') == '1' else nullcontext()
+        with local, sensor_servers(server_sensors, server_ports()):
+            for index, slot in enumerate(slots):
+                assignment = {sensor_key(sensor): endpoint for sensor, endpoint in zip(slot, endpoints)}
+                run_fleet(slot, run_throughput_test, assignment, duration, collect=False,
+                          on_result=lambda sensor, result: write(dict(result, slot=index)),
+                          on_error=lambda sensor, e: write(dict(failed_entry(sensor, str(e)), slot=index)),
+                          operation_name='throughput')
+    return schedule
+
+
+def throughput_test_result(result: dict) -> dict:
+    """Shape a throughput result like a sensor test result for the HTML report."""
+    tests = []
+    for direction, _ in DIRECTIONS:
+        outcome = result[direction]
+        output = outcome.get('error') or (f"{outcome['mbps']} Mbit/s via {result.get('server')} "
+                                          f"(retransmits: {outcome.get('retransmits')})")
+        tests.append({'test_name': f"{direction.capitalize()} throughput", 'output': output,
+                      'status': 'Failed' if 'error' in outcome else 'Passed'})
+    return {'hostname': result['hostname'], 'ip_address': result['ip'], 'results': {'Throughput': tests}}
+
+
+def link_summary(stream_path: str) -> dict:
+    """Median uplink and downlink Mbit/s per link class."""
+    rates = {}
+    for record in iter_results(stream_path):
+        result = record['result']
+        for direction, _ in DIRECTIONS:
+            if 'mbps' in result[direction]:
+                rates.setdefault(result['link'], {}).setdefault(direction, []).append(result[direction]['mbps'])
+    return {link: {f"median_{direction}_mbps": sorted(values)[len(values) // 2]
+                   for direction, values in directions.items()}
+            for link, directions in sorted(rates.items())}
+
+
+def write_throughput_reports(stream_path: str, schedule: dict, report_directory: str, timestamp: str) -> tuple:
+    """Write the YAML report (results by outcome, per-link medians, schedule) and the HTML report."""
+    report_path = os.path.join(report_directory, f"Throughput_Report_{timestamp}.yaml")
+    write_grouped_yaml(stream_path, report_path, ['Passed', 'Failed'])
+    with open(report_path, 'a') as file:
+        yaml.safe_dump({'Links': link_summary(stream_path), 'Schedule': schedule}, file, sort_keys=False)
+    logging.info(f"Report saved to {report_path}")
+    html_path = sensor_tests.write_html_report(
+        (throughput_test_result(record['result']) for record in iter_results(stream_path)),
+        f'Throughput Report - {timestamp}', os.path.join(report_directory, f"throughput_report_{timestamp}.html"))
+    return report_path, html_path
@@ -0,0 +1,217 @@
+import logging
+import shlex
+
+from link_throttle import get_link_throttle
+from package_cache import distribution_mode, stage_packages
+from ssh_transport import get_transport
+from state_store import get_state_store, incremental_mode
+from tracing import span
+
+TOOLS_TO_CHECK = ['stress', 'iperf3', 'mtr', 'dnsutils']
+
+# Packages whose binary is not named after the package.
+TOOL_BINARIES = {'dnsutils': 'dig'}
+
+# Tools whose package is named differently under a package manager (tools are named after the Debian package).
+PACKAGE_NAMES = {'yum': {'dnsutils': 'bind-utils'}}
+
+# Skip `apt-get update` when the package lists were refreshed within this many minutes.
+APT_LISTS_MAX_AGE_MINUTES = 24 * 60
+
+INSTALL_TIMEOUT = 900
+
+
+def package_name(package_manager: str, tool: str) -> str:
+    return PACKAGE_NAMES.get(package_manager, {}).get(tool, tool)
+
+
+def build_probe_script(tools: list) -> str:
+    """Build a shell snippet that reports the package manager, every tool's presence and installed versions."""
+    lines = [
+        'if command -v apt-get >/dev/null 2>&1; then echo "pm=apt";'
+        ' elif command -v yum >/dev/null 2>&1; then echo "pm=yum"; else echo "pm=none"; fi'
+    ]
+    for tool in tools:
+        binary = TOOL_BINARIES.get(tool, tool)
+        package, rpm_package = shlex.quote(package_name('apt', tool)), shlex.quote(package_name('yum', tool))
+        lines.append(f'if command -v {shlex.quote(binary)} >/dev/null 2>&1; then echo "tool={tool}=1";'
+                     f' echo "version={tool}=$(dpkg-query -W -f=\'${{Version}}\' {package} 2>/dev/null'
+                     f' || rpm -q --qf \'%{{VERSION}}\' {rpm_package} 2>/dev/null | grep -v \'not installed\')";'
+                     f' else echo "tool={tool}=0"; fi')
+    return '\n'.join(lines)
+
+
+def parse_probe_output(output: str) -> dict:
+    """Parse the `pm=`/`tool=`/`version=` lines printed by build_probe_script."""
+    audit = {'package_manager': None, 'present': [], 'missing': [], 'versions': {}}
+    for line in output.splitlines():
+        key, _, value = line.strip().partition('=')
+        if key == 'pm':
+            audit['package_manager'] = None if value == 'none' else value
+        elif key == 'tool':
+            tool, _, present = value.rpartition('=')
+            audit['present' if present == '1' else 'missing'].append(tool)
+        elif key == 'version':
+            tool, _, version = value.partition('=')
+            audit['versions'][tool] = version
+    return audit
+
+
+def download_limit_options(package_manager: str, download_limit_kb: int) -> str:
+    """Package manager options capping its downloads at download_limit_kb KiB/s (0: no cap)."""
+    if not download_limit_kb:
+        return ''
+    if package_manager == 'apt':
+        return f" -o Acquire::http::Dl-Limit={download_limit_kb} -o Acquire::https::Dl-Limit={download_limit_kb}"
+    return f" --setopt=throttle={download_limit_kb}k"
+
+
+def build_install_command(package_manager: str, tools: list, refresh: bool = True,
+                          download_limit_kb: int = 0) -> str:
+    """Build one install transaction for all tools, refreshing the package lists at most once."""
+    packages = ' '.join(shlex.quote(package_name(package_manager, tool)) for tool in tools)
+    if package_manager == 'apt':
+        options = download_limit_options(package_manager, download_limit_kb)
+        install = f"sudo DEBIAN_FRONTEND=noninteractive apt-get{options} install -y {packages}"
+        if not refresh:
+            return install
+        refresh_lists = (f"[ -n \"$(find /var/lib/apt/lists -maxdepth 0 -mmin -{APT_LISTS_MAX_AGE_MINUTES})\" ]"
+                         f" || sudo apt-get{options} update")
+        return f"{{ {refresh_lists}; }} && {install}"
+    if package_manager == 'yum':
+        options = download_limit_options(package_manager, download_limit_kb)
+        install = f"sudo yum{options} install -y {packages}"
+        return f"sudo yum{options} makecache fast && {install}" if refresh else install
+    raise ValueError(f"Unsupported package manager: {package_manager}")
+
+
+def build_sensor_install_command(ip_address_sensor: str, username_sensorz: str, password_sensorz: str,
+                                 package_manager: str, tools: list, refresh: bool, sensor: dict = None) -> str:
+    """Install command for the missing tools, using pushed packages in PACKAGE_DISTRIBUTION=sftp mode.
+
+    Tools the controller has no packages for still go through the sensor's package manager, downloading at
+    the sensor's share of its link class's bandwidth.
+    """
+    download_limit_kb = get_link_throttle().download_limit_kb(ip_address_sensor)
+    if distribution_mode() != 'sftp':
+        return build_install_command(package_manager, tools, refresh=refresh, download_limit_kb=download_limit_kb)
+    offline_command, uncached_tools = stage_packages(ip_address_sensor, username_sensorz, password_sensorz,
+                                                     package_manager, tools, sensor)
+    commands = [offline_command] if offline_command else []
+    if uncached_tools:
+        commands.append(build_install_command(package_manager, uncached_tools, refresh=refresh,
+                                              download_limit_kb=download_limit_kb))
+    return '; '.join(f"( {command} )" for command in commands)
+
+
+def probe_tools(ip_address_sensor: str, username_sensorz: str, password_sensorz: str, tools: list) -> dict:
+    """Probe every tool and the package manager in a single round trip."""
+    command = f"sh -c {shlex.quote(build_probe_script(tools))}"
+    with span('tool_probe', ip_address_sensor):
+        _, stdout, _ = get_transport().exec_command(ip_address_sensor, username_sensorz, password_sensorz, command,
+                                                   timeout=30)
+    return parse_probe_output(stdout)
+
+
+def cached_audit(sensor: dict, tools: list) -> dict:
+    """Audit result built from the state store when every tool was recorded as installed and is still fresh."""
+    store = get_state_store()
+    known_tools = store.get(sensor, 'tools')
+    if known_tools is None or not all(tool in known_tools for tool in tools):
+        return None
+    return {
+        'package_manager': store.get(sensor, 'package_manager', include_stale=True),
+        'already_installed': list(tools),
+        'installed': [],
+        'failed': [],
+        'output': '',
+        'error': '',
+        'versions': {tool: known_tools[tool] for tool in tools},
+    }
+
+
+def record_audit(sensor: dict, result: dict) -> None:
+    store = get_state_store()
+    store.set(sensor, 'package_manager', result['package_manager'], ok=bool(result['package_manager']))
+    present = result['already_installed'] + result['installed']
+    store.set(sensor, 'tools', {tool: result['versions'].get(tool, '') for tool in present},
+              ok=not result['failed'])
+
+
+def audit_and_install(ip_address_sensor: str, username_sensorz: str, password_sensorz: str,
+                      tools: list = None, refresh: bool = True, sensor: dict = None) -> dict:
+    """Probe the tools, install all missing ones in one transaction and re-probe in the same round trip.
+
+    Returns a dict with the package manager, the tools that were already installed, installed in this
+    cycle or failed to install, the installed versions and the install command's output. With a sensor
+    the outcome is recorded in the state store, and an incremental run skips sensors whose tools are all
+    known to be installed.
+    """
+    tools = tools or TOOLS_TO_CHECK
+    if sensor and incremental_mode():
+        cached = cached_audit(sensor, tools)
+        if cached:
+            logging.info(f"{ip_address_sensor}: all tools recorded as installed, skipping the probe")
+            return cached
+    result = run_audit(ip_address_sensor, username_sensorz, password_sensorz, tools, refresh, sensor)
+    if sensor:
+        record_audit(sensor, result)
+    return result
+
+
+def install_and_probe(ip_address_sensor: str, username_sensorz: str, password_sensorz: str, install_command: str,
+                      tools: list) -> tuple:
+    """Run an install command and re-probe the tools in the same round trip; return (output, error, probe)."""
+    # Success is judged by the tools being present, not by parsing the package manager's output.
+    command = f"{install_command}; echo '--- probe ---'; sh -c {shlex.quote(build_probe_script(tools))}"
+    with span('install', ip_address_sensor):
+        _, stdout, stderr = get_transport().exec_command(ip_address_sensor, username_sensorz, password_sensorz,
+                                                        command, timeout=INSTALL_TIMEOUT)
+    install_output, _, probe_output = stdout.rpartition('--- probe ---')
+    return install_output.strip(), stderr.strip(), parse_probe_output(probe_output)
+
+
+def run_audit(ip_address_sensor: str, username_sensorz: str, password_sensorz: str, tools: list,
+              refresh: bool, sensor: dict = None) -> dict:
+    audit = probe_tools(ip_address_sensor, username_sensorz, password_sensorz, tools)
+    result = {
+        'package_manager': audit['package_manager'],
+        'already_installed': audit['present'],
+        'installed': [],
+        'failed': [],
+        'output': '',
+        'error': '',
+        'versions': audit['versions'],
+    }
+    if not audit['missing']:
+        return result
+    if not audit['package_manager']:
+        result['failed'] = audit['missing']
+        result['error'] = 'No supported package manager found'
+        return result
+
+    install_command = build_sensor_install_command(ip_address_sensor, username_sensorz, password_sensorz,
+                                                   audit['package_manager'], audit['missing'], refresh, sensor)
+    install_output, error, after = install_and_probe(ip_address_sensor, username_sensorz, password_sensorz,
+                                                     install_command, audit['missing'])
+    still_missing = [tool for tool in audit['missing'] if tool not in after['present']]
+    if still_missing and len(audit['missing']) > 1:
+        # apt and dnf refuse a whole transaction over one unknown package, so the tools it held back get
+        # one transaction each.
+        download_limit_kb = get_link_throttle().download_limit_kb(ip_address_sensor)
+        retry_commands = [build_install_command(audit['package_manager'], [tool], refresh=False,
+                                                download_limit_kb=download_limit_kb) for tool in still_missing]
+        retry_command = '; '.join(f"( {command} )" for command in retry_commands)
+        retry_output, retry_error, retried = install_and_probe(ip_address_sensor, username_sensorz,
+                                                               password_sensorz, retry_command, still_missing)
+        install_output, error = f"{install_output}\n{retry_output}", f"{error}\n{retry_error}".strip()
+        after['present'] += retried['present']
+        after['versions'].update(retried['versions'])
+    result['installed'] = [tool for tool in audit['missing'] if tool in after['present']]
+    result['failed'] = [tool for tool in audit['missing'] if tool not in after['present']]
+    result['output'] = install_output.strip()
+    result['error'] = error
+    result['versions'].update(after['versions'])
+    if result['failed']:
+        logging.error(f"Failed to install {', '.join(result['failed'])} on {ip_address_sensor}: {result['error']}")
+    return result
@@ -0,0 +1,119 @@
+import collections
+import json
+import logging
+import math
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Tracer:
+    """Cheap in-memory collector of timed spans per sensor and phase.
+
+    Sampling is decided per sensor, so a sampled sensor keeps all of its phases. Spans live in a bounded
+    deque of tuples and are only turned into JSON when exported.
+    """
+
+    def __init__(self, sample_rate: float = None, max_spans: int = None):
+        self.sample_rate = float(os.getenv('TRACE_SAMPLE_RATE', '1.0')) if sample_rate is None else sample_rate
+        self.spans = collections.deque(maxlen=max_spans or int(os.getenv('TRACE_MAX_SPANS', '200000')))
+        self._lock = threading.Lock()
+
+    def sampled(self, sensor: str = None) -> bool:
+        if self.sample_rate >= 1:
+            return True
+        if self.sample_rate <= 0:
+            return False
+        return zlib.crc32((sensor or '').encode()) % 10000 < self.sample_rate * 10000
+
+    def record(self, phase: str, sensor: str, started: float, duration: float, ok: bool = True) -> None:
+        if self.sampled(sensor):
+            with self._lock:
+                self.spans.append((sensor, phase, started, duration, ok))
+
+    @contextmanager
+    def span(self, phase: str, sensor: str = None):
+        """Time the enclosed block as one span; a raised exception marks it as failed."""
+        started, clock = time.time(), time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            self.record(phase, sensor, started, time.perf_counter() - clock, ok)
+
+    def summary(self) -> dict:
+        """Return {phase: {count, errors, p50, p95, max}} with durations in seconds."""
+        with self._lock:
+            spans = list(self.spans)
+        durations, errors = collections.defaultdict(list), collections.Counter()
+        for _, phase, _, duration, ok in spans:
+            durations[phase].append(duration)
+            errors[phase] += not ok
+        summary = {}
+        for phase, values in durations.items():
+            values.sort()
+            summary[phase] = {
+                'count': len(values),
+                'errors': errors[phase],
+                'p50': round(percentile(values, 0.50), 4),
+                'p95': round(percentile(values, 0.95), 4),
+                'max': round(values[-1], 4),
+            }
+        return summary
+
+    def slowest(self, phase: str, limit: int = 5) -> list:
+        """Return the sensors with the slowest spans in a phase as [(sensor, seconds)]."""
+        with self._lock:
+            spans = [(duration, sensor) for sensor, span_phase, _, duration, _ in self.spans if span_phase == phase]
+        return [(sensor, round(duration, 4)) for duration, sensor in sorted(spans, reverse=True)[:limit]]
+
+    def export(self, run_name: str, directory: str = None) -> str:
+        """Write the spans as JSONL plus a per-phase summary JSON and log the summary. Returns the JSONL path."""
+        directory = directory or os.getenv('TRACE_DIRECTORY', 'state/traces')
+        os.makedirs(directory, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        spans_path = os.path.join(directory, f"{run_name}_{timestamp}.jsonl")
+        with self._lock:
+            spans = list(self.spans)
+        with open(spans_path, 'w') as file:
+            for sensor, phase, started, duration, ok in spans:
+                file.write(json.dumps({'sensor': sensor, 'phase': phase, 'start': round(started, 6),
+                                       'duration': round(duration, 6), 'ok': ok}) + '\n')
+        summary = self.summary()
+        with open(os.path.join(directory, f"{run_name}_{timestamp}_summary.json"), 'w') as file:
+            json.dump(summary, file, indent=2)
+        for phase, stats in sorted(summary.items()):
+            logging.info(f"Phase {phase}: n={stats['count']} errors={stats['errors']} p50={stats['p50']}s "
+                         f"p95={stats['p95']}s max={stats['max']}s")
+        return spans_path
+
+
+_shared_tracer = None
+_shared_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    global _shared_tracer
+    with _shared_tracer_lock:
+        if _shared_tracer is None:
+            _shared_tracer = Tracer()
+        return _shared_tracer
+
+
+def span(phase: str, sensor: str = None):
+    """Shortcut for get_tracer().span(...)."""
+    return get_tracer().span(phase, sensor)